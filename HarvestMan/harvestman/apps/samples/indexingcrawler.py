@@ -49,8 +49,7 @@ class IndexingCrawler(HarvestMan):
         lucene_writer.setMaxFieldLength(1048576)
         
         
-        for node in urldb.preorder():
-            urlobj = node.get()
+        for urlobj in urldb.itervalues():
 
             # Only index if web-page or document
             if not urlobj.is_webpage() and not urlobj.is_document(): continue
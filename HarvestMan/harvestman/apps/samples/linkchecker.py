@@ -25,12 +25,8 @@ class LinkChecker(HarvestMan):
         super(LinkChecker, self).__init__()
 
     def find_broken_links(self, event, *args, **kwargs):
-        urldb = objects.datamgr.get_urldb()
-
-        for node in urldb.preorder():
-            urlobj = node.get()
-            if urlobj.status == 404:
-                self.broken.append(urlobj.get_full_url())
+        for urlobj in objects.datamgr.get_broken_urls():
+            self.broken.append(urlobj.get_full_url())
 
         # Write to a file
         baseurl = objects.queuemgr.get_base_url()
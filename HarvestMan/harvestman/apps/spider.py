@@ -98,6 +98,8 @@ from harvestman.lib import rules
 from harvestman.lib import datamgr
 from harvestman.lib import utils
 from harvestman.lib import urlparser
+from harvestman.lib import checkpoint
+from harvestman.lib import linkrank
 from harvestman.lib.db import HarvestManDbManager
 from harvestman.lib.methodwrapper import MethodWrapperMetaClass
 
@@ -134,11 +136,17 @@ class HarvestMan(HarvestManAppBase):
         """ Initializing method """
 
         self._projectstartpage = 'file://'
+        # Crawl state loaded from a checkpoint
+        self.savedstate = None
         super(HarvestMan, self).__init__()
         
     def finish_project(self):
         """ Actions to take after download is over for the current project """
 
+        # Stop checkpointing, this keeps the checkpoint
+        # only if the crawl was interrupted.
+        objects.checkpoint.close()
+        
         if objects.eventmgr.raise_event('beforefinish', objects.queuemgr.baseurl, None)==False:
             return
         
@@ -175,6 +183,7 @@ class HarvestMan(HarvestManAppBase):
         globaldata.userdebug = []
         logconsole('HarvestMan session finished.')
 
+        objects.checkpoint.close()
         objects.datamgr.clean_up()
         objects.rulesmgr.clean_up()
         objects.logger.shutdown()
@@ -182,35 +191,16 @@ class HarvestMan(HarvestManAppBase):
     def save_current_state(self):
         """ Save state of objects to disk so program can be restarted from saved state """
 
-        # If savesession is disabled, return
-        if not objects.config.savesessions:
-            extrainfo('Session save feature is disabled.')
+        # If checkpointing is disabled, return
+        if not objects.config.checkpoint:
+            extrainfo('Checkpoint feature is disabled.')
             return
         
-        # Top-level state dictionary
-        state = {}
-        # All state objects are dictionaries
-
-        # Get state of queue & tracker threads
-        state['trackerqueue'] = objects.queuemgr.get_state()
-        # Get state of datamgr
-        state['datamanager'] = objects.datamgr.get_state()
-        # Get state of urlthreads 
-
-        #if p: state['threadpool'] = p.get_state()
-        #state['ruleschecker'] = objects.rulesmgr.get_state()
-
-        # Get config object
-        #state['configobj'] = objects.config.copy()
-        
-        # Dump with time-stamp 
-        fname = os.path.join(objects.config.usersessiondir, '.harvestman_saves#' + str(int(time.time())))
-        extrainfo('Saving run-state to file %s...' % fname)
+        extrainfo('Saving run-state...')
 
         try:
-            cPickle.dump(state, open(fname, 'wb'), pickle.HIGHEST_PROTOCOL)
-            extrainfo('Saved run-state to file %s.' % fname)
-        except (pickle.PicklingError, RuntimeError), e:
+            objects.checkpoint.save()
+        except (IOError, OSError, checkpoint.HarvestManCheckpointError), e:
             logconsole(e)
             error('Could not save run-state !')
         
@@ -244,12 +234,19 @@ class HarvestMan(HarvestManAppBase):
         SetAlias(connmgr)
 
         # Connector factory
-        conn_factory = connector.HarvestManUrlConnectorFactory(objects.config.connections)
+        conn_factory = connector.HarvestManUrlConnectorFactory(objects.config.connections,
+                                                               objects.config.hostconnections)
         SetAlias(conn_factory)
 
         queuemgr = urlqueue.HarvestManCrawlerQueue()
         SetAlias(queuemgr)
 
+        # Checkpoint of the crawl state
+        SetAlias(checkpoint.HarvestManCheckpoint())
+
+        # Link rank of URLs
+        SetAlias(linkrank.HarvestManLinkRank())
+
         SetAlias(HarvestManEvent())
         
     def start_project(self):
@@ -285,6 +282,7 @@ class HarvestMan(HarvestManAppBase):
         objects.datamgr.clean_up()
         objects.datamgr.initialize()
         objects.rulesmgr.reset()
+        objects.linkrank.reset()
             
         # Read the project cache file, if any
         if objects.config.pagecache:
@@ -293,10 +291,21 @@ class HarvestMan(HarvestManAppBase):
         if not objects.config.resuming:
             # Configure tracker manager for this project
             if objects.queuemgr.configure():
+                objects.checkpoint.open()
                 # start the project
                 objects.queuemgr.crawl()
         else:
-            objects.queuemgr.restart()
+            # Configure tracker manager and restore the
+            # state of the interrupted crawl on top
+            if objects.queuemgr.configure():
+                if self.restore_state(self.savedstate) == RESTORE_STATE_OK:
+                    objects.checkpoint.open(resume=True)
+                    objects.queuemgr.restart()
+                else:
+                    # Don't try this checkpoint again
+                    logconsole('Could not resume project, it will be started afresh in the next run.')
+                    objects.checkpoint.remove()
+            self.savedstate = None
 
         objects.eventmgr.raise_event('afterstart', objects.queuemgr.baseurl, None)
         
@@ -514,121 +523,56 @@ class HarvestMan(HarvestManAppBase):
 
         SetLogFile()
 
+        # Resume the crawl if this project was interrupted
+        self.run_saved_state()
+        
         if not objects.config.testnocrawl:
             self.start_project()
 
         self.finish_project()
             
-    def restore_state(self, state_file):
-        """ Restore state of some objects from the most recent run of the program.
-        This helps to re-run the program from where it left off """
+    def restore_state(self, state):
+        """ Restore state of objects from the state saved by an interrupted
+        run of the program. This helps to re-run the program from where it left off """
 
         try:
-            state = cPickle.load(open(state_file, 'rb'))
-            # This has six keys - configobj, threadpool, ruleschecker,
-            # datamanager, common and trackerqueue.
-
-            # First update config object
-            localcfg = {}
-            cfg = state.get('configobj')
-            if cfg:
-                for key,val in cfg.items():
-                    localcfg[key] = val
-            else:
-                print 'Config corrupted'
-                return RESTORE_STATE_NOT_OK
-
-            # Now update trackerqueue
-            ret = objects.queuemgr.set_state(state.get('trackerqueue'))
-            if ret == -1:
-                logconsole("Error restoring state in 'urlqueue' module - cannot proceed further!")
-                return RESTORE_STATE_NOT_OK                
-            else:
-                logconsole("Restored state in urlqueue module.")
-            
-            # Now update datamgr
-            ret = objects.datamgr.set_state(state.get('datamanager'))
-            if ret == -1:
-                logconsole("Error restoring state in 'datamgr' module - cannot proceed further!")
-                return RESTORE_STATE_NOT_OK                
-            else:
-                dm.initialize()
-                logconsole("Restored state in datamgr module.")                
-            
-            # Update threadpool if any
-            pool = None
-            if state.has_key('threadpool'):
-                pool = dm._urlThreadPool
-                ret = pool.set_state(state.get('threadpool'))
-                logconsole('Restored state in urlthread module.')
-            
-            # Update ruleschecker
-            ret = objects.rulesmgr.set_state(state.get('ruleschecker'))
+            objects.datamgr.set_state(state['datamanager'])
+            logconsole("Restored state in datamgr module.")
+            objects.rulesmgr.set_state(state['ruleschecker'])
             logconsole('Restored state in rules module.')
+            # Queues are refilled when crawling is restarted
+            objects.queuemgr.set_state(state['trackerqueue'])
+            logconsole("Restored state in urlqueue module.")
+        except (KeyError, TypeError, AttributeError), e:
+            logconsole("Error restoring state =>", e)
+            return RESTORE_STATE_NOT_OK
 
-            # Everything is fine, copy localcfg to config object
-            for key,val in localcfg.items():
-                objects.config[key] = val
-
-            # Open stream to log file
-            SetLogFile()
-                
-            return RESTORE_STATE_OK
-        except (pickle.UnpicklingError, AttributeError, IndexError, EOFError), e:
-            return RESTORE_STATE_NOT_OK            
+        return RESTORE_STATE_OK
 
     def run_saved_state(self):
-        """ Restart the program from a previous state, from state saved during
-        the most recent run of the program, if any """
-        
-        # If savesession is disabled, return
-        #if not objects.config.savesessions:
-        extrainfo('Session save feature is disabled, ignoring save files')
-        return SAVE_STATE_NOT_OK
+        """ Restart the current project from a previous state, from the
+        checkpoint saved by an interrupted run of the project, if any """
+
+        objects.config.resuming = False
         
-        # Set locale - To fix errors with
-        # regular expressions on non-english web
-        # sites.
-        # See if there is a file named .harvestman_saves#...
-  ##       sessions_dir = objects.config.usersessiondir
-
-##         files = glob.glob(os.path.join(sessions_dir, '.harvestman_saves#*'))
-
-##         # Get the last dumped file
-##         if files:
-##             runfile = max(files)
-##             res = raw_input('Found HarvestMan save file %s. Do you want to re-run it ? [y/n]' % runfile)
-##             if res.lower()=='y':
-##                 if self.restore_state(runfile) == RESTORE_STATE_OK:
-##                     objects.config.resuming = True
-##                     objects.config.runfile = runfile
-
-##                     if objects.config.verbosity:
-##                         self.welcome_message()
-        
-##                     if not objects.config.testnocrawl:
-##                         try:
-##                             self.start_project()
-##                         except Exception, e:
-##                             self.handle_interrupts(-1, None, e)
-
-##                     try:
-##                         self.finish_project()
-##                         return SAVE_STATE_OK
-                    
-##                     except Exception, e:
-##                         # To catch errors at interpreter shutdown
-##                         pass
-##                 else:
-##                     logconsole('Could not re-run saved state, defaulting to standard configuration...')
-##                     objects.config.resuming = False
-##                     return SAVE_STATE_NOT_OK
-##             else:
-##                 logconsole('OK, falling back to default configuration...')
-##                 return SAVE_STATE_NOT_OK
-##         else:
-##             return SAVE_STATE_NOT_OK
-##         pass
+        if not objects.config.checkpoint:
+            return SAVE_STATE_NOT_OK
+
+        state = objects.checkpoint.load()
+        if state is None:
+            return SAVE_STATE_NOT_OK
+
+        # A checkpoint of another starting url is
+        # removed when the new crawl starts.
+        if state['config'].get('url') != objects.config.url:
+            extrainfo('Ignoring checkpoint of a crawl of', state['config'].get('url'))
+            return SAVE_STATE_NOT_OK
+
+        logconsole('Found checkpoint of interrupted crawl, resuming project %s...' % objects.config.project)
+        self.savedstate = state
+        objects.config.resuming = True
+
+        return SAVE_STATE_OK
 
     def handle_interrupts(self, signum, frame, e=None):
         """ Method which is called to handle program interrupts such as a Ctrl-C (interrupt) """
@@ -642,10 +586,7 @@ class HarvestMan(HarvestManAppBase):
             print_traceback()
 
         logtraceback()
-        # dont allow to write cache, since it
-        # screws up existing cache.
-        objects.datamgr.conditional_cache_set()
-        # self.save_current_state()
+        self.save_current_state()
         self.clean_up()
 
     def bind_event(self, event, funktion, *args):
@@ -661,12 +602,9 @@ class HarvestMan(HarvestManAppBase):
         # sys.stderr = DummyStderr()
         signal.signal(signal.SIGINT, self.handle_interrupts)
         
-        # See if a crash file is there, then try to load it and run
-        # program from crashed state.
-        if self.run_saved_state() == SAVE_STATE_NOT_OK:
-            # No such crashed state or user refused to run
-            # from crashed state. So do the usual run.
-            self.run_projects()
+        # Projects which were interrupted are resumed
+        # from their saved state, if any.
+        self.run_projects()
             
         # Final cleanup
         self.finalize()
@@ -0,0 +1,149 @@
+# -- coding: utf-8
+""" bench_bandwidth.py - Benchmark of limiting the bandwidth of
+connectors reading at once, comparing the token buckets of
+bandwidth.py with the throttle the connector used before,
+which compared the bytes of the files downloaded so far with
+the time since the crawl began.
+
+Usage: python bench_bandwidth.py [limit [threads [filesize [seconds]]]]
+
+The limit is in KB/sec (default 256), the threads read files
+of 'filesize' KB (default 64) for about 'seconds' seconds
+(default 8) from an in-memory stand-in for the network, which
+is faster than any limit. Shows the rate achieved against the
+limit, its overshoot, and the lowest, highest and standard
+deviation of the rate over each second.
+"""
+
+import sys, os
+import time
+import math
+import threading
+import cStringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from harvestman.lib.common.common import SetAlias
+from harvestman.lib.common.macros import *
+from harvestman.lib import config
+
+SetAlias(config.HarvestManStateObject())
+
+from harvestman.lib.connector import HarvestManFileObject
+from harvestman.lib.bandwidth import HarvestManBandwidthLimiter
+
+class Network(object):
+    """ Stand-in for the file object of a response, which
+    records the time and size of every block read """
+
+    def __init__(self, data, samples):
+        self._f = cStringIO.StringIO(data)
+        self._samples = samples
+
+    def read(self, n):
+        block = self._f.read(n)
+        self._samples.append((time.time(), len(block)))
+        return block
+
+    def close(self):
+        self._f.close()
+
+class Crawl(object):
+    """ Bytes of the files downloaded so far and the start
+    time, as the data manager and config kept them """
+
+    def __init__(self, bwlimit, nthreads, factor=1.5):
+        self.bytes = 0
+        self.starttime = time.time()
+        self.bwlimit = float(bwlimit)
+        self.nthreads = nthreads
+        self.factor = factor
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        self.lock.acquire()
+        self.bytes += nbytes
+        self.lock.release()
+
+class OldFileObject(HarvestManFileObject):
+    """ File object with the throttle of the connector before
+    the token buckets """
+
+    crawl = None
+
+    def throttle(self, bytecount):
+        crawl = self.crawl
+        diff = float(crawl.bytes)/crawl.bwlimit - (time.time() - crawl.starttime)
+        diff = crawl.factor*diff/crawl.nthreads
+
+        if diff>0:
+            if self._bs>=256:
+                self._bs -= 128
+            time.sleep(diff)
+        elif diff<0:
+            self._bs += int(crawl.bwlimit*abs(diff))
+
+def download(method, limit, nthreads, filesize, seconds):
+    """ Download files with 'method' from 'nthreads' threads for
+    about 'seconds' seconds and return the samples read """
+
+    samples = []
+    data = 'x'*filesize
+    crawl = Crawl(limit, nthreads)
+    OldFileObject.crawl = crawl
+    limiter = HarvestManBandwidthLimiter(limit)
+    end = crawl.starttime + seconds
+
+    def worker():
+        while time.time() < end:
+            if method == 'old':
+                fo = OldFileObject(Network(data, samples), '', 0, CONNECTOR_DATA_MODE_INMEM, True)
+            else:
+                fo = HarvestManFileObject(Network(data, samples), '', 0, CONNECTOR_DATA_MODE_INMEM, limiter)
+            fo.read()
+            # The bytes of a file are counted once it is saved
+            crawl.add(len(fo.get_data()))
+
+    threads = [threading.Thread(target=worker) for i in range(nthreads)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    return crawl.starttime, samples
+
+def report(method, limit, start, samples):
+    """ Print the rates achieved by the samples read """
+
+    last = max([t for t, n in samples])
+    total = sum([n for t, n in samples])
+    achieved = total/(last - start)
+
+    # Rate over each whole second
+    persec = [0]*int(last - start)
+    for t, n in samples:
+        i = int(t - start)
+        if i < len(persec):
+            persec[i] += n
+    mean = float(sum(persec))/len(persec)
+    stddev = math.sqrt(sum([(x - mean)**2 for x in persec])/len(persec))
+
+    print '%-6s %10.1f %10.1f %9.1f%% %10.1f %10.1f %10.1f' % (method, limit/1024.0, achieved/1024.0,
+                                                               100.0*(achieved - limit)/limit,
+                                                               min(persec)/1024.0, max(persec)/1024.0,
+                                                               stddev/1024.0)
+    sys.stdout.flush()
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    limit = ((args and args[0]) or 256)*1024
+    nthreads = (len(args) > 1 and args[1]) or 4
+    filesize = ((len(args) > 2 and args[2]) or 64)*1024
+    seconds = (len(args) > 3 and args[3]) or 8
+
+    print '%d threads reading files of %d KB for %d seconds' % (nthreads, filesize/1024, seconds)
+    print '%-6s %10s %10s %10s %10s %10s %10s' % ('method', 'limit', 'achieved', 'overshoot',
+                                                  'min/sec', 'max/sec', 'stddev')
+    for method in ('old', 'bucket'):
+        start, samples = download(method, limit, nthreads, filesize, seconds)
+        report(method, limit, start, samples)
+
+if __name__ == "__main__":
+    main()
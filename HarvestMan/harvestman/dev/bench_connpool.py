@@ -0,0 +1,159 @@
+# -- coding: utf-8
+""" bench_connpool.py - Benchmark of fetching pages over HTTP
+and HTTPS with the pooled keep-alive handlers of keepalive.py,
+compared with the handlers of urllib2 which open a connection
+for every request.
+
+Usage: python bench_connpool.py [requests [threads [size]]]
+
+Starts a local HTTP/1.1 server, and an HTTPS server with a
+certificate made by the openssl command if it is found, as a
+stand-in for web servers. Each handler fetches 'requests'
+pages (default 500) of 'size' KB (default 10) from 'threads'
+threads (default 4). The pool keeps at most 'threads'
+connections to the server.
+"""
+
+import sys, os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from harvestman.lib.common import keepalive
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    size = 10240
+    # Send small writes at once, as web servers do on
+    # keep-alive connections, rather than waiting for
+    # the client to acknowledge the previous write
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        data = 'x'*self.size
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections kept open
+        # without a word are to be expected
+        pass
+
+def make_certificate(directory):
+    """ Make a self-signed certificate in 'directory' and
+    return its file name, or None if it cannot be made """
+
+    certfile = os.path.join(directory, 'cert.pem')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-keyout', certfile, '-out', certfile, '-days', '1',
+                               '-subj', '/CN=127.0.0.1'],
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile
+
+def start_server(certfile=None):
+    """ Start a server in a thread and return its URL """
+
+    server = Server(('127.0.0.1', 0), Handler)
+    scheme = 'http'
+    if certfile:
+        server.socket = ssl.wrap_socket(server.socket, certfile=certfile, server_side=True)
+        scheme = 'https'
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return '%s://127.0.0.1:%d/' % (scheme, server.server_address[1])
+
+def fetch(opener, url, nrequests, nthreads):
+    """ Fetch 'url' 'nrequests' times from 'nthreads'
+    threads and return the time taken """
+
+    counts = [nrequests/nthreads]*nthreads
+    counts[0] += nrequests % nthreads
+
+    def worker(count):
+        for i in xrange(count):
+            f = opener.open(url + str(i))
+            f.read()
+            f.close()
+
+    threads = [threading.Thread(target=worker, args=(count,)) for count in counts]
+    t = time.time()
+    for th in threads: th.start()
+    for th in threads: th.join()
+    return time.time() - t
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    nrequests = (args and args[0]) or 500
+    nthreads = (len(args) > 1 and args[1]) or 4
+    Handler.size = ((len(args) > 2 and args[2]) or 10)*1024
+
+    directory = tempfile.mkdtemp(prefix='hm-bench-')
+    try:
+        servers = [('http', start_server())]
+        certfile = ssl and make_certificate(directory)
+        if certfile:
+            servers.append(('https', start_server(certfile)))
+        else:
+            print 'No ssl module or openssl command, HTTPS is skipped'
+
+        context = None
+        if certfile and hasattr(ssl, '_create_unverified_context'):
+            # The certificate is self-signed
+            context = ssl._create_unverified_context()
+
+        print '%d requests of %d KB from %d threads' % (nrequests, Handler.size/1024, nthreads)
+        print '%-6s %-8s %10s %10s %8s %8s' % ('scheme', 'handler', 'time(s)', 'req/s', 'hits', 'misses')
+        for scheme, url in servers:
+            if scheme == 'http':
+                plain = urllib2.HTTPHandler()
+                pooled = keepalive.HTTPHandler(nthreads, 30)
+            else:
+                if context:
+                    plain = urllib2.HTTPSHandler(context=context)
+                else:
+                    plain = urllib2.HTTPSHandler()
+                pooled = keepalive.HTTPSHandler(nthreads, 30, context)
+
+            for name, handler in (('urllib2', plain), ('pooled', pooled)):
+                t = fetch(urllib2.build_opener(handler), url, nrequests, nthreads)
+                stats = (hasattr(handler, 'get_stats') and handler.get_stats()) or {}
+                print '%-6s %-8s %10.2f %10.1f %8s %8s' % (scheme, name, t, nrequests/t,
+                                                           stats.get('hits', '-'), stats.get('misses', '-'))
+                sys.stdout.flush()
+            pooled.close_all()
+
+        # Let the threads of the servers see the
+        # connections closed before exiting
+        end = time.time() + 5
+        while threading.activeCount() > len(servers) + 1 and time.time() < end:
+            time.sleep(0.01)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -- coding: utf-8
+""" bench_decode.py - Benchmark of reading gzip compressed
+pages with HarvestManFileObject, comparing decoding the data
+as it is read with decoding the whole of it after reading,
+as the connector did before.
+
+Usage: python bench_decode.py [size1 size2 ...]
+
+Sizes are of the decoded pages in MB and default to 10, 50
+and 200. Each page is compressed to a temporary file which
+stands in for the network, and read in memory mode and in
+flush mode by each method in a process of its own, so that
+its peak resident memory can be measured. The memory shown
+is the peak less the memory of the process before reading.
+"""
+
+import sys, os
+import time
+import random
+import gzip
+import shutil
+import tempfile
+import resource
+import subprocess
+import cStringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from harvestman.lib.common.common import SetAlias
+from harvestman.lib.common.macros import *
+from harvestman.lib import config
+
+SetAlias(config.HarvestManStateObject())
+
+from harvestman.lib.connector import HarvestManFileObject
+
+WORDS = ['harvest', 'spider', 'crawl', 'page', 'link', 'anchor', 'mirror', 'offline',
+         'python', 'thread', 'queue', 'server', 'connector', 'parser', 'data', 'cache']
+
+def make_page(filename, size):
+    """ Write a gzip compressed page of 'size' MB to 'filename' """
+
+    g = gzip.GzipFile(filename, 'wb')
+    rnd = random.Random(size)
+    para = 0
+    while g.tell() < size*1048576:
+        words = [rnd.choice(WORDS) for i in xrange(rnd.randint(20, 80))]
+        g.write('<p id="p%d">%s <a href="/%s/%d.html">%s</a></p>\n' % (para, ' '.join(words),
+                                                                  words[0], para, words[-1]))
+        para += 1
+    g.close()
+
+def read_old(fobj, mode, tmpfname, outfname):
+    """ Read and decode the way the connector did before """
+
+    fo = HarvestManFileObject(fobj, tmpfname, 0, mode)
+    fo.read()
+    if mode == CONNECTOR_DATA_MODE_INMEM:
+        data = fo.get_data()
+        g = gzip.GzipFile(fileobj=cStringIO.StringIO(data))
+        data = g.read()
+        g.close()
+        return len(data)
+    else:
+        g = gzip.GzipFile(fileobj=open(tmpfname, 'rb'))
+        f = open(outfname, 'wb')
+        while True:
+            block = g.read(8192)
+            if block == '': break
+            f.write(block)
+        f.close()
+        g.close()
+        os.remove(tmpfname)
+        return os.path.getsize(outfname)
+
+def read_new(fobj, mode, tmpfname, outfname):
+    """ Read and decode as blocks are read """
+
+    fo = HarvestManFileObject(fobj, tmpfname, 0, mode, None, 'gzip')
+    fo.read()
+    if mode == CONNECTOR_DATA_MODE_INMEM:
+        return len(fo.get_data())
+    else:
+        shutil.move(tmpfname, outfname)
+        return os.path.getsize(outfname)
+
+def child(method, mode, gzfname, directory):
+    """ Run one method in this process and print
+    the time taken and peak memory used """
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tmpfname = os.path.join(directory, 'page.tmp')
+    outfname = os.path.join(directory, 'page.html')
+    func = {'old': read_old, 'new': read_new}[method]
+
+    t = time.time()
+    size = func(open(gzfname, 'rb'), int(mode), tmpfname, outfname)
+    t = time.time() - t
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print t, (peak - base)/1024.0, size
+    if os.path.isfile(outfname):
+        os.remove(outfname)
+
+def main():
+    if sys.argv[1:2] == ['-c']:
+        child(*sys.argv[2:])
+        return
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 50, 200]
+    directory = tempfile.mkdtemp(prefix='hm-bench-')
+    try:
+        print '%8s %8s %-6s %-6s %10s %10s %10s' % ('size(MB)', 'gz(MB)', 'mode', 'method',
+                                                   'time(s)', 'MB/s', 'peak(MB)')
+        for size in sizes:
+            gzfname = os.path.join(directory, 'page.gz')
+            make_page(gzfname, size)
+            gzsize = os.path.getsize(gzfname)/1048576.0
+            for mode, modename in ((CONNECTOR_DATA_MODE_INMEM, 'inmem'),
+                                   (CONNECTOR_DATA_MODE_FLUSH, 'flush')):
+                sizes = []
+                for method in ('old', 'new'):
+                    output = subprocess.Popen([sys.executable, __file__, '-c', method, str(mode),
+                                               gzfname, directory], stdout=subprocess.PIPE).communicate()[0]
+                    t, peak, outsize = output.split()
+                    t, peak = float(t), float(peak)
+                    sizes.append(int(outsize))
+                    print '%8d %8.1f %-6s %-6s %10.2f %10.1f %10.1f' % (size, gzsize, modename, method,
+                                                                        t, int(outsize)/1048576.0/t, peak)
+                    sys.stdout.flush()
+                assert sizes[0] == sizes[1]
+            os.remove(gzfname)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -- coding: utf-8
+""" bench_fileobject.py - Throughput benchmark of reading
+response bodies with HarvestManFileObject, comparing the
+buffering in connector.py with the string concatenation
+used before it.
+
+Usage: python bench_fileobject.py [-a] [size1 size2 ...]
+
+Sizes are in KB and default to 10 KB, 100 KB, 1 MB, 10 MB
+and 100 MB. Bodies are read from an in-memory file in 4 KB
+blocks, in memory mode and in flush mode. The old way of
+concatenating the blocks is quadratic in the body size and
+is skipped for sizes above 10 MB unless -a is passed.
+"""
+
+import sys, os
+import time
+import tempfile
+import cStringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from harvestman.lib.common.common import SetAlias
+from harvestman.lib.common.macros import *
+from harvestman.lib import config
+
+SetAlias(config.HarvestManStateObject())
+
+from harvestman.lib.connector import HarvestManFileObject
+
+def read_concat(fobj, bs=4096):
+    """ Read the way HarvestManFileObject did before, into
+    an attribute so that the string is copied every time """
+
+    class Buffer(object): pass
+    data = Buffer()
+    data._data = ''
+    while True:
+        block = fobj.read(bs)
+        if block == '': break
+        data._data = data._data + block
+    return data._data
+
+def run(size, tmpfile, concat):
+    body = os.urandom(1024)*size
+    results = []
+
+    for mode in (CONNECTOR_DATA_MODE_INMEM, CONNECTOR_DATA_MODE_FLUSH):
+        fo = HarvestManFileObject(cStringIO.StringIO(body), tmpfile, len(body), mode)
+        t = time.time()
+        fo.read()
+        if mode == CONNECTOR_DATA_MODE_INMEM:
+            assert fo.get_data() == body
+        results.append(time.time() - t)
+        if mode == CONNECTOR_DATA_MODE_FLUSH:
+            assert os.path.getsize(tmpfile) == len(body)
+
+    if concat:
+        t = time.time()
+        assert read_concat(cStringIO.StringIO(body)) == body
+        results.append(time.time() - t)
+    else:
+        results.append(None)
+
+    def rate(t):
+        if t is None: return '%12s' % 'skipped'
+        return '%12.1f' % (len(body)/1048576.0/max(t, 1e-6))
+
+    print '%10d %s %s %s' % (size, rate(results[0]), rate(results[1]), rate(results[2]))
+    sys.stdout.flush()
+
+def main():
+    args = sys.argv[1:]
+    all = '-a' in args
+    sizes = [int(arg) for arg in args if arg != '-a'] or [10, 100, 1024, 10240, 102400]
+
+    fd, tmpfile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        print '%10s %12s %12s %12s' % ('size(KB)', 'inmem(MB/s)', 'flush(MB/s)', 'concat(MB/s)')
+        for size in sizes:
+            run(size, tmpfile, all or size <= 10240)
+    finally:
+        os.remove(tmpfile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# -- coding: utf-8
+""" bench_linkrank.py - Benchmark of the fetch order given by
+the link rank (OPIC) in linkrank.py against the default order
+by generation, on a synthetic link graph.
+
+Usage: python bench_linkrank.py [pages] [outlinks]
+
+The graph has 'pages' pages (default 100000), each with about
+'outlinks' links (default 8). Pages are reachable from page 0
+through a random tree, and the other links point to pages
+picked with a Zipf distribution, so that a few pages, at any
+depth, get most of the links. The crawl is simulated without
+any network access, with the url queue of urlqueue.py.
+
+For fetch budgets of a fraction of the pages, prints the share
+of all links which point to the pages fetched (link coverage)
+and the share of the 1% most linked pages fetched.
+"""
+
+import sys, os
+import time
+import random
+import bisect
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from harvestman.lib.common.common import SetAlias, objects
+from harvestman.lib import config
+
+SetAlias(config.HarvestManStateObject())
+
+from harvestman.lib.urlqueue import PriorityQueue
+from harvestman.lib.linkrank import HarvestManLinkRank
+
+budgets = (0.01, 0.05, 0.1, 0.25, 0.5)
+
+class Frontier(object):
+    """ Url queue standing in for the queue manager """
+
+    alias = 'queuemgr'
+
+    def __init__(self):
+        self.q = PriorityQueue(key=lambda (prio, index): index)
+
+    def reprioritize(self, deltas):
+        return len(self.q.reprioritize(deltas))
+
+def make_graph(n, outlinks):
+    """ Return the list of out-links of each page """
+
+    # Zipf weights over a random order of the pages
+    order = range(n)
+    random.shuffle(order)
+    cumulative, total = [], 0.0
+    for rank in xrange(n):
+        total += 1.0/(rank+1)
+        cumulative.append(total)
+
+    links = [[] for x in xrange(n)]
+    for page in xrange(1, n):
+        links[random.randrange(page)].append(page)
+
+    for page in xrange(n):
+        for x in xrange(outlinks - 1):
+            target = order[bisect.bisect(cumulative, random.random()*total)]
+            if target != page:
+                links[page].append(target)
+
+    return links
+
+def crawl(links, budget, linkrank):
+    """ Simulate a crawl of at most 'budget' pages, returning
+    the list of pages in the order fetched """
+
+    frontier = Frontier()
+    SetAlias(frontier)
+    q = frontier.q
+    lr = HarvestManLinkRank()
+
+    generation = {0: 0}
+    q.put((0, 0))
+    fetched = []
+
+    while q.qsize() and len(fetched)<budget:
+        prio, page = q.get()
+        fetched.append(page)
+
+        children = links[page]
+        if linkrank:
+            lr.add_links(page, children)
+
+        new = []
+        for child in children:
+            if child in generation: continue
+            generation[child] = generation[page] + 1
+            new.append(child)
+
+        for child in new:
+            if linkrank:
+                prio = lr.priority(child)
+            else:
+                prio = generation[page]
+            q.put((prio, child))
+
+    return fetched
+
+class Index(int):
+    """ Page number with the index attribute of URL objects """
+
+    @property
+    def index(self):
+        return self
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    n = (args + [100000])[0]
+    outlinks = (args[1:] + [8])[0]
+
+    random.seed(0)
+    t = time.time()
+    links = make_graph(n, outlinks)
+    links = [[Index(x) for x in l] for l in links]
+    print 'Graph of %d pages, %d links made in %.2f s' % (n, sum(map(len, links)), time.time()-t)
+
+    indegree = [0]*n
+    for l in links:
+        for x in l:
+            indegree[x] += 1
+    totallinks = float(sum(indegree))
+    top = set(sorted(range(n), key=indegree.__getitem__, reverse=True)[:n/100])
+
+    print '%8s %8s %12s %12s %10s' % ('order','fetches','coverage(%)','top1%(%)','time(s)')
+    for name, linkrank in (('depth', False), ('linkrank', True)):
+        for budget in budgets:
+            fetches = int(n*budget)
+            t = time.time()
+            fetched = crawl(links, fetches, linkrank)
+            t = time.time() - t
+            coverage = 100*sum([indegree[x] for x in fetched])/totallinks
+            topshare = 100.0*len(top.intersection(fetched))/len(top)
+            print '%8s %8d %12.1f %12.1f %10.2f' % (name, fetches, coverage, topshare, t)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# -- coding: utf-8
+""" bench_localise.py - Benchmark of link localisation,
+comparing the single-pass localiser (lib.localiser) with the
+per-link regular expressions used before it.
+
+Usage: python bench_localise.py [pages [links [workers]]]
+
+Writes 'pages' pages (default 200) with 'links' links each
+(default 1200) to a temporary directory and localises them
+three times: with a regular expression compiled and run over
+the whole page for every link as localise_file_links did, with
+the single-pass localiser in this process, and with the
+single-pass localiser in a pool of 'workers' processes (default
+one per CPU). The pages are written again before each run.
+"""
+
+import sys, os
+import re
+import time
+import shutil
+import tempfile
+
+path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, path)
+
+from harvestman.lib import localiser
+
+SITE = 'http://www.example.com/'
+
+def make_page(n, links):
+    """ Return the content of page 'n' and its links as
+    written in the page """
+
+    hrefs = []
+    parts = ['<html><head><title>Page %d</title></head><body>\n' % n]
+    for i in xrange(links):
+        href = 'dir%d/page%d.html' % (i % 20, (n*links + i) % 5000)
+        hrefs.append(href)
+        parts.append('<p>Some text about item %d <a href="%s">link %d</a></p>\n' % (i, href, i))
+    parts.append('</body></html>\n')
+    return ''.join(parts), hrefs
+
+def localise_regex(filename, hrefs, linkmap):
+    """ Localise links the way localise_file_links did,
+    with a regular expression for every link """
+
+    data = open(filename).read()
+    for v in hrefs:
+        target = linkmap.get(localiser.link_key(SITE + v))
+        newurl = ''.join(('href="', os.path.relpath(target, os.path.dirname(filename)), '"'))
+        oldurlre = re.compile(''.join(('href', '=', '\\"?', v, '\\"?')))
+        data = re.sub(oldurlre, newurl, data, 1)
+    open(filename, 'w').write(data)
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    npages = (args and args[0]) or 200
+    nlinks = (len(args) > 1 and args[1]) or 1200
+    workers = (len(args) > 2 and args[2]) or 0
+
+    directory = tempfile.mkdtemp(prefix='hm-bench-')
+    try:
+        pages = [make_page(n, nlinks) for n in xrange(npages)]
+        linkmap = {}
+        for d in xrange(20):
+            for p in xrange(5000):
+                url = SITE + 'dir%d/page%d.html' % (d, p)
+                linkmap[localiser.link_key(url)] = os.path.join(directory, 'dir%d' % d, 'page%d.html' % p)
+
+        filenames = [os.path.join(directory, 'page%d.html' % n) for n in xrange(npages)]
+        size = sum([len(data) for data, hrefs in pages])
+        print '%d pages, %d links each, %.1f KB a page' % (npages, nlinks, size/1024.0/npages)
+
+        def write_pages():
+            for filename, (data, hrefs) in zip(filenames, pages):
+                open(filename, 'w').write(data)
+
+        write_pages()
+        t = time.time()
+        for filename, (data, hrefs) in zip(filenames, pages):
+            localise_regex(filename, hrefs, linkmap)
+        tregex = time.time() - t
+        expected = [open(filename).read() for filename in filenames]
+
+        tasks = [(filename, SITE, False) for filename in filenames]
+        results = []
+        for nworkers in (1, workers):
+            write_pages()
+            t = time.time()
+            for result in localiser.localise_files(tasks, linkmap, 2, nworkers):
+                assert result[1] == nlinks
+            results.append(time.time() - t)
+            assert [open(filename).read() for filename in filenames] == expected
+
+        tsingle, tpool = results
+        print '%-24s %10s %12s' % ('method', 'time(s)', 'pages/s')
+        for name, t in (('regex per link', tregex), ('single pass', tsingle),
+                        ('single pass, pool', tpool)):
+            print '%-24s %10.2f %12.1f' % (name, t, npages/t)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
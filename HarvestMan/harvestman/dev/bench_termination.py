@@ -0,0 +1,97 @@
+# -- coding: utf-8
+""" bench_termination.py - Benchmark of the fixed wall-clock
+overhead of a crawl. Serves a single page from a local HTTP
+server and times complete runs of the spider application
+crawling it, so the time measured is almost entirely start-up,
+end-of-crawl detection and thread shut-down.
+
+Usage: python bench_termination.py [-n runs] [-t tree]
+
+The tree option points to the top-level directory of another
+HarvestMan source tree (the one containing the harvestman
+package) whose spider should be timed, for comparing two
+versions, for example a git worktree of an older revision.
+"""
+
+import sys, os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import optparse
+import BaseHTTPServer
+import SimpleHTTPServer
+
+PAGE = '<html><head><title>Bench</title></head><body>A single page.</body></html>'
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """ Request handler which does not log requests """
+
+    def log_message(self, *args):
+        pass
+
+def serve(root):
+    """ Serve files from 'root' in a background thread.
+    Returns the server object """
+
+    os.chdir(root)
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), QuietHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+def run_spider(tree, url, basedir):
+    """ Run one crawl of 'url' and return its wall-clock time """
+
+    spider = os.path.join(tree, 'harvestman', 'apps', 'spider.py')
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join([tree] + filter(None, [env.get('PYTHONPATH')]))
+    # Keep user configuration and session files out of $HOME
+    env['HOME'] = basedir
+
+    cmd = [sys.executable, spider, '-p', 'bench', '-b', basedir, url]
+    t = time.time()
+    p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    t = time.time() - t
+
+    if p.returncode != 0:
+        print out
+        raise SystemExit, 'Spider exited with status %d' % p.returncode
+
+    return t
+
+def main():
+    default = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    parser = optparse.OptionParser(usage='%prog [-n runs] [-t tree]')
+    parser.add_option('-n', dest='runs', type='int', default=5, help='number of runs')
+    parser.add_option('-t', dest='tree', default=default, help='HarvestMan source tree')
+    options, args = parser.parse_args()
+
+    tree = os.path.abspath(options.tree)
+    root = tempfile.mkdtemp(prefix='hm-bench-')
+    try:
+        site = os.path.join(root, 'site')
+        os.makedirs(site)
+        open(os.path.join(site, 'index.html'), 'w').write(PAGE)
+        server = serve(site)
+        url = 'http://127.0.0.1:%d/index.html' % server.server_port
+
+        print 'Timing %d crawls of a 1-page site using %s' % (options.runs, tree)
+        times = []
+        for x in range(options.runs):
+            basedir = os.path.join(root, 'run%d' % x)
+            os.makedirs(basedir)
+            t = run_spider(tree, url, basedir)
+            print 'run %2d: %.3f s' % (x+1, t)
+            times.append(t)
+
+        print 'min %.3f s, mean %.3f s, max %.3f s' % (min(times), sum(times)/len(times), max(times))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
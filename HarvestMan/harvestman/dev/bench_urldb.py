@@ -0,0 +1,111 @@
+# -- coding: utf-8
+""" bench_urldb.py - Benchmark of the URL database, comparing
+the hash-indexed store (common.hashdb) with the binary search
+tree (common.bst) used before it.
+
+Usage: python bench_urldb.py [count ...]
+
+For every count (default 100000 and 1000000) and store, inserts
+'count' records keyed by random 64-bit fingerprints, the way URL
+objects are keyed, then looks up random keys, 90% of them among
+the last tenth of the records inserted and the rest among all,
+and iterates over all the records. The BST is set up as the
+data manager did, dumping its nodes to bsddb as they are added,
+and the hash store keeps 100000 records in memory. Each run
+is done in a separate process so that the growth of its
+resident set size can be reported.
+"""
+
+import sys, os
+import time
+import random
+import subprocess
+
+MEMSIZE = 100000
+LOOKUPS = 100000
+
+def rss():
+    """ Return the resident set size of this process in bytes """
+
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        # Peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def make_record(key):
+    """ Return a record of about the size of a pickled URL object """
+
+    url = 'http://www.example.com/dir%d/page%d.html' % (key % 17, key)
+    return {'url': url, 'index': key, 'status': 0, 'filename': url[7:],
+            'headers': {'content-type': 'text/html', 'content-length': str(key % 50000)},
+            'padding': 'x'*400}
+
+def run(store, count):
+    path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, path)
+
+    if store == 'bst':
+        from harvestman.lib.common.bst import BST
+        db = BST()
+        db.set_auto(2)
+        lookup, iterate = db.lookup, lambda: (node.get() for node in db.preorder())
+    else:
+        from harvestman.lib.common.hashdb import HashDB
+        db = HashDB(MEMSIZE, prefix='bench')
+        lookup, iterate = db.lookup, db.itervalues
+
+    rnd = random.Random(count)
+    keys = [rnd.getrandbits(64) for x in xrange(count)]
+    base = rss()
+
+    t = time.time()
+    for key in keys:
+        db.insert(key, make_record(key))
+    tinsert = time.time() - t
+
+    recent = keys[-count/10:]
+    probes = [rnd.choice(recent) if rnd.random() < 0.9 else rnd.choice(keys) for x in xrange(LOOKUPS)]
+    t = time.time()
+    for key in probes:
+        assert lookup(key)['index'] == key
+    tlookup = time.time() - t
+
+    t = time.time()
+    n = 0
+    for record in iterate():
+        n += 1
+    assert n == count
+    titer = time.time() - t
+
+    size = rss() - base
+    print '%-8s %10d %12.1f %12.1f %12.1f %12.0f' % (store, count, 1e6*tinsert/count,
+                                                      1e6*tlookup/LOOKUPS, 1e6*titer/count,
+                                                      float(size)/count)
+    sys.stdout.flush()
+    if store == 'bst':
+        # The BST leaves its cache file behind
+        db.clear()
+        for name in ('cache.db',):
+            if os.path.isfile(name):
+                os.remove(name)
+    else:
+        db.close()
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '-run':
+        run(args[1], int(args[2]))
+        return
+
+    counts = [int(arg) for arg in args] or [100000, 1000000]
+    print '%-8s %10s %12s %12s %12s %12s' % ('store', 'records', 'insert(us)', 'lookup(us)',
+                                             'iterate(us)', 'rss/rec(B)')
+    for count in counts:
+        for store in ('bst', 'hashdb'):
+            subprocess.call([sys.executable, os.path.abspath(__file__), '-run', store, str(count)])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -- coding: utf-8
+""" bench_urlmem.py - Benchmark of the memory used by
+HarvestManUrl objects.
+
+Usage: python bench_urlmem.py [-p path] [count]
+
+Creates 'count' URL objects (default 1000000) the way a crawl
+does, as links relative to parent pages, keeps all of them in
+a list like the URL database does and reports the growth of
+the resident set size per URL, the size of a pickled URL and
+the time to create a URL.
+
+The harvestman package is imported from the tree this script
+is in, or from the directory given with -p, so that the numbers
+for an older tree can be compared with the current one.
+"""
+
+import sys, os
+import time
+import cPickle
+import gc
+
+def rss():
+    """ Return the resident set size of this process in bytes """
+
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        # Peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def main():
+    args = sys.argv[1:]
+    path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if '-p' in args:
+        i = args.index('-p')
+        path = args[i+1]
+        del args[i:i+2]
+    count = int((args + [1000000])[0])
+
+    sys.path.insert(0, path)
+
+    from harvestman.lib.common.common import SetAlias
+    from harvestman.lib import config
+    SetAlias(config.HarvestManStateObject())
+    from harvestman.lib.urlparser import HarvestManUrl
+
+    gc.collect()
+    base = rss()
+    t = time.time()
+
+    root = HarvestManUrl('http://www.example.com/index.html')
+    urls = [root]
+    for x in xrange(1, count):
+        # Pages with 50 links each, as a tree
+        parent = urls[(x - 1)/50]
+        urls.append(HarvestManUrl('/dir%d/page%d.html' % (x % 17, x), 'webpage', 0, parent))
+        # Full URLs are computed as for the queue
+        # and the rules checks
+        urls[-1].get_full_url()
+
+    t = time.time() - t
+    gc.collect()
+    size = rss() - base
+
+    sample = urls[count/2:count/2 + 1000]
+    pickled = sum([len(cPickle.dumps(u, cPickle.HIGHEST_PROTOCOL)) for u in sample])/float(len(sample))
+
+    print 'Tree: %s' % path
+    print '%10s %14s %14s %14s' % ('urls', 'rss/url(B)', 'pickle/url(B)', 'create(us)')
+    print '%10d %14.0f %14.0f %14.1f' % (count, float(size)/count, pickled, 1e6*t/count)
+
+if __name__ == "__main__":
+    main()
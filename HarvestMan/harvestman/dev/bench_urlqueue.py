@@ -0,0 +1,82 @@
+# -- coding: utf-8
+""" bench_urlqueue.py - Microbenchmark comparing the heap based
+PriorityQueue in urlqueue.py with the older bisect based queue.
+
+Usage: python bench_urlqueue.py [size1 size2 ...]
+
+By default runs with 10k, 100k and 1M items. The bisect queue
+is quadratic in the number of items and is skipped for sizes
+above 100k unless -a is passed.
+"""
+
+import sys, os
+import time
+import random
+import bisect
+
+from Queue import Queue
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from harvestman.lib.common.common import SetAlias
+from harvestman.lib import config
+
+SetAlias(config.HarvestManStateObject())
+
+from harvestman.lib.urlqueue import PriorityQueue
+
+class BisectPriorityQueue(Queue):
+    """ The old bisect based priority queue """
+
+    def _init(self, maxsize):
+        self.maxsize = maxsize
+        self.queue = []
+
+    def _put(self, item):
+        bisect.insort(self.queue, item)
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _get(self):
+        return self.queue.pop(0)
+
+class Item(object):
+    """ Stand-in for a HarvestManUrl object """
+    pass
+
+def run(klass, items):
+    q = klass(0)
+    t1 = time.time()
+    for item in items:
+        q.put(item)
+    t2 = time.time()
+    while q.qsize():
+        q.get()
+    t3 = time.time()
+
+    return t2-t1, t3-t2
+
+def main():
+    args = sys.argv[1:]
+    all = '-a' in args
+    sizes = [int(x) for x in args if x != '-a']
+    if not sizes:
+        sizes = [10000, 100000, 1000000]
+
+    random.seed(0)
+    print '%10s %10s %10s %10s %10s' % ('queue','items','put(s)','get(s)','total(s)')
+
+    for size in sizes:
+        # Priorities in a small range as generated by the crawler
+        items = [(random.randint(-5, 10), Item()) for x in xrange(size)]
+
+        for name, klass in (('heap', PriorityQueue), ('bisect', BisectPriorityQueue)):
+            if klass is BisectPriorityQueue and size>100000 and not all:
+                print '%10s %10d %10s' % (name, size, 'skipped')
+                continue
+            tput, tget = run(klass, items)
+            print '%10s %10d %10.3f %10.3f %10.3f' % (name, size, tput, tget, tput+tget)
+
+if __name__ == "__main__":
+    main()
@@ -52,8 +52,7 @@ def create_index(self, arg):
 
     urllist = []
     
-    for node in self._urldb.preorder():
-        urlobj = node.get()
+    for urlobj in self._urldb.itervalues():
 
         # Only index if web-page or document
         if not urlobj.is_webpage() and not urlobj.is_document(): continue
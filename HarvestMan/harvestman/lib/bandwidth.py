@@ -0,0 +1,141 @@
+# -- coding: utf-8
+""" bandwidth.py - Module which limits the bandwidth used by
+the connectors of HarvestMan. This is part of the HarvestMan
+program.
+
+The bandwidth is limited with token buckets, one for all the
+connectors and optionally one for each server. A bucket fills
+with tokens, one per byte, at the rate of the limit, and holds
+at most a short burst of them. A reader takes tokens for every
+block it reads. When the bucket runs short it goes into debt,
+and the reader sleeps until the debt it made is paid off, so
+readers are served in the order in which they came and the
+rate over any period is at most the limit plus the burst.
+"""
+
+import time
+import threading
+
+# Seconds of data at the rate of a bucket it can hold
+BURST_TIME = 0.1
+# Smallest burst in bytes, so that a block can always
+# be read at once
+MIN_BURST = 8192
+
+class HarvestManTokenBucket(object):
+    """ Thread-safe token bucket limiting a rate of bytes """
+
+    def __init__(self, rate, burst=0):
+        # Rate in bytes per second
+        self.rate = float(rate)
+        # Capacity of the bucket
+        self.burst = float(burst or max(self.rate*BURST_TIME, MIN_BURST))
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+        # Bytes consumed and the time of the first
+        # and last consumption, for the achieved rate
+        self.bytes = 0
+        self.first = 0.0
+        self.last = 0.0
+
+    def reserve(self, nbytes):
+        """ Takes 'nbytes' tokens from the bucket and returns
+        the time to wait until they are available """
+
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+            self._last = now
+            self._tokens -= nbytes
+
+            if not self.first:
+                self.first = now
+            self.bytes += nbytes
+            wait = max(0.0, -self._tokens/self.rate)
+            self.last = now + wait
+            return wait
+        finally:
+            self._lock.release()
+
+    def consume(self, nbytes):
+        """ Takes 'nbytes' tokens from the bucket, waiting
+        until they are available. Returns the time waited """
+
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def get_rate(self):
+        """ Returns the rate achieved in bytes per second """
+
+        if self.last > self.first:
+            return self.bytes/(self.last - self.first)
+        return 0.0
+
+class HarvestManBandwidthLimiter(object):
+    """ Limiter of the bandwidth of all connectors and of the
+    connectors to each server """
+
+    def __init__(self, rate=0, hostrate=0):
+        # Bucket for all connectors
+        self.bucket = None
+        if rate:
+            self.bucket = HarvestManTokenBucket(rate)
+        # Rate for each server
+        self.hostrate = hostrate
+        # Buckets by server
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, host):
+        """ Returns the bucket for the server 'host' or
+        None if the servers are not limited """
+
+        if not self.hostrate or host is None:
+            return None
+
+        self._lock.acquire()
+        try:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = HarvestManTokenBucket(self.hostrate)
+            return bucket
+        finally:
+            self._lock.release()
+
+    def consume(self, nbytes, host=None):
+        """ Accounts for 'nbytes' bytes read from the server
+        'host', waiting as long as the limits ask for """
+
+        wait = 0.0
+        # The tokens of both buckets are taken before waiting,
+        # so the wait is for the bucket which is shorter
+        bucket = self.get_bucket(host)
+        if bucket is not None:
+            wait = bucket.reserve(nbytes)
+        if self.bucket is not None:
+            wait = max(wait, self.bucket.reserve(nbytes))
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def get_stats(self):
+        """ Returns a dictionary with the configured and achieved
+        rates, for all connectors and by server """
+
+        rate = achieved = 0.0
+        if self.bucket is not None:
+            rate, achieved = self.bucket.rate, self.bucket.get_rate()
+
+        self._lock.acquire()
+        try:
+            hosts = dict([(host, bucket.get_rate()) for host, bucket in self.buckets.items()])
+        finally:
+            self._lock.release()
+
+        return {'rate': rate, 'achieved': achieved,
+                'hostrate': self.hostrate, 'hosts': hosts}
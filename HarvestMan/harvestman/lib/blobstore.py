@@ -0,0 +1,181 @@
+# -- coding: utf-8
+""" blobstore.py - Module which stores the files downloaded
+by HarvestMan by the SHA-1 hash of their content. This is
+part of the HarvestMan program.
+
+Every distinct content is written once, to a blob file named
+by its hash in a directory of the project cache. The files of
+the mirrored site are hard links, or symbolic links if asked
+for, to the blobs, so files with the same content downloaded
+from different URLs share their disk space and inode. Where
+links cannot be made, the blob is copied.
+
+A file which is going to be modified in place, such as a page
+whose links are localised, must first be given a copy of its
+own with unshare_file.
+"""
+
+import os
+import sha
+import shutil
+import tempfile
+import threading
+
+from harvestman.lib.common.common import *
+
+class HarvestManBlobStoreError(Exception):
+    pass
+
+def unshare_file(filename):
+    """ Replace 'filename' by a copy of its own if it is
+    a link to a file shared with other names. Return True
+    if the file was replaced """
+
+    if os.path.islink(filename):
+        target = os.path.realpath(filename)
+    elif os.path.isfile(filename) and os.stat(filename).st_nlink > 1:
+        target = filename
+    else:
+        return False
+
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename))
+    os.close(fd)
+    shutil.copyfile(target, tmpfile)
+    os.remove(filename)
+    os.rename(tmpfile, filename)
+    return True
+
+class HarvestManBlobStore(object):
+    """ Content-addressed store of downloaded files """
+
+    def __init__(self, directory, links='hard'):
+        self.directory = directory
+        # 'hard' or 'sym'
+        self.links = links
+        self.lock = threading.Lock()
+        # Number of files stored
+        self.files = 0
+        # Number of distinct contents
+        self.blobs = 0
+        # Files and bytes which were not written
+        # since their content was already stored
+        self.dupfiles = 0
+        self.dupbytes = 0
+        # Files copied from the blob since a
+        # link could not be made
+        self.copies = 0
+
+    def blob_file(self, digest):
+        """ Return the file name of the blob with hash 'digest' """
+
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def store(self, filename, data):
+        """ Store the string 'data' as the content of the
+        file 'filename'. Return True if the content was
+        already in the store """
+
+        digest = sha.new(data).hexdigest()
+        return self._store(filename, digest, len(data), data=data)
+
+    def store_file(self, filename, srcfile):
+        """ Store the content of the file 'srcfile' as the
+        content of the file 'filename', removing 'srcfile'.
+        Return True if the content was already in the store """
+
+        sh = sha.new()
+        f = open(srcfile, 'rb')
+        try:
+            while True:
+                block = f.read(65536)
+                if not block: break
+                sh.update(block)
+        finally:
+            f.close()
+
+        return self._store(filename, sh.hexdigest(), os.path.getsize(srcfile), srcfile=srcfile)
+
+    def _store(self, filename, digest, size, data=None, srcfile=None):
+        blob = self.blob_file(digest)
+
+        self.lock.acquire()
+        try:
+            found = os.path.isfile(blob)
+            if found:
+                if srcfile:
+                    os.remove(srcfile)
+                self.dupfiles += 1
+                self.dupbytes += size
+            else:
+                directory = os.path.dirname(blob)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                # Written under another name first, so that a
+                # blob is never seen half written
+                tmpfile = blob + '.tmp'
+                if srcfile:
+                    shutil.move(srcfile, tmpfile)
+                else:
+                    f = open(tmpfile, 'wb')
+                    f.write(data)
+                    f.close()
+                os.rename(tmpfile, blob)
+                self.blobs += 1
+
+            self.files += 1
+        finally:
+            self.lock.release()
+
+        self.link(blob, filename)
+        return found
+
+    def link(self, blob, filename):
+        """ Make 'filename' a link to the file 'blob' """
+
+        if os.path.lexists(filename):
+            os.remove(filename)
+
+        try:
+            if self.links == 'sym':
+                os.symlink(os.path.abspath(blob), filename)
+            else:
+                os.link(blob, filename)
+        except (OSError, AttributeError), e:
+            # No links on this platform or file system
+            debug('Could not link %s to blob %s: %s' % (filename, blob, e))
+            shutil.copyfile(blob, filename)
+            self.copies += 1
+
+    def prune(self):
+        """ Remove the blobs which no file links to any more,
+        such as those of pages whose links were localised.
+        This works only with hard links. Return the number
+        of blobs removed """
+
+        if self.links == 'sym' or not os.path.isdir(self.directory):
+            return 0
+
+        count = 0
+        self.lock.acquire()
+        try:
+            for subdir in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, subdir)
+                for name in os.listdir(subdir):
+                    blob = os.path.join(subdir, name)
+                    if os.stat(blob).st_nlink == 1:
+                        os.remove(blob)
+                        count += 1
+                if not os.listdir(subdir):
+                    os.rmdir(subdir)
+        finally:
+            self.lock.release()
+
+        return count
+
+    def get_stats(self):
+        """ Return a dictionary with the number of files and
+        blobs stored and of files and bytes not written
+        since they were duplicates """
+
+        return {'files': self.files, 'blobs': self.blobs, 'dupfiles': self.dupfiles,
+                'dupbytes': self.dupbytes, 'copies': self.copies}
@@ -0,0 +1,435 @@
+# -- coding: utf-8
+""" checkpoint.py - Module which saves the state of a crawl
+to disk while it runs, so that an interrupted crawl can be
+resumed where it left off. This is part of the HarvestMan
+program.
+
+The state is kept in the 'hm-checkpoint' folder of the project
+directory as a snapshot file plus a number of journal files.
+The objects which own the state record each change to it in
+the journal as it happens, so checkpointing costs in proportion
+to the changes and not to the size of the crawl. A background
+thread writes the journal to disk every second and from time
+to time folds the journal into a fresh snapshot, working only
+on the files. Loading the checkpoint replays the journal on
+top of the snapshot.
+
+The state is a dictionary with these keys.
+
+ 'datamanager' - State of the data manager: the URL objects
+                 by index, the URL collections by index of
+                 their source URL and the counters.
+ 'trackerqueue'- State of the queue manager: the URLs queued
+                 for fetching but not fetched yet and the
+                 sources of the collections queued for
+                 crawling but not crawled yet.
+ 'ruleschecker'- State of the rules checker: the filtered
+                 URLs and its caches.
+ 'config'      - Starting URL and project of the crawl.
+
+"""
+
+import os
+import glob
+import time
+import shutil
+import cPickle
+import threading
+
+from harvestman.lib import urlparser
+from harvestman.lib.common.common import *
+from harvestman.lib.common.seglog import HEADER
+
+SNAPSHOT = 'snapshot'
+JOURNAL = 'journal'
+
+def journal(kind, *args):
+    """ Record a change of the crawl state in the
+    journal of the current checkpoint, if any """
+
+    cp = objects.checkpoint
+    if cp and cp.active:
+        cp.record(kind, args)
+
+def replay(state, kind, args):
+    """ Apply a journal record to a crawl state """
+
+    dmstate, tqstate, rcstate = state['datamanager'], state['trackerqueue'], state['ruleschecker']
+
+    if kind == 'url':
+        url, = args
+        dmstate['urls'][url.index] = url
+    elif kind == 'links':
+        index, coll = args
+        dmstate['links'][index] = coll
+    elif kind == 'queued':
+        # A list of (index, priority, generation)
+        for index, prio, generation in args[0]:
+            tqstate['pending'][index] = (prio, generation)
+    elif kind == 'fetched':
+        url, = args
+        dmstate['urls'][url.index] = url
+        tqstate['pending'].pop(url.index, None)
+    elif kind == 'data':
+        # A list of (index, priority)
+        for index, prio in args[0]:
+            tqstate['tocrawl'][index] = prio
+    elif kind == 'crawled':
+        tqstate['tocrawl'].pop(args[0], None)
+    elif kind == 'filter':
+        rcstate['filter'][args[0]] = 1
+    elif kind == 'counters':
+        dmstate['counters'] = args[0]
+    elif kind == 'caches':
+        rcstate['caches'] = args[0]
+
+def reindex(state):
+    """ Change the URL indices of a crawl state saved with
+    another index scheme to the current one """
+
+    dmstate, tqstate, rcstate = state['datamanager'], state['trackerqueue'], state['ruleschecker']
+
+    indexmap = {}
+    for index, url in dmstate['urls'].items():
+        if index != 0:
+            url.index = urlparser.url_fingerprint(url.get_canonical_url())
+        indexmap[index] = url.index
+
+    def remap(d):
+        return dict([(indexmap[index], value) for index, value in d.iteritems() if index in indexmap])
+
+    dmstate['urls'] = remap(dmstate['urls'])
+    dmstate['links'] = remap(dmstate['links'])
+    for coll in dmstate['links'].itervalues():
+        coll.reindex(indexmap)
+    tqstate['pending'] = remap(tqstate['pending'])
+    tqstate['tocrawl'] = remap(tqstate['tocrawl'])
+    rcstate['filter'] = remap(rcstate['filter'])
+    
+    state['urlindex'] = urlparser.INDEX_SCHEME
+
+class HarvestManCheckpointError(Exception):
+    pass
+
+class HarvestManCheckpoint(object):
+    """ Checkpoint of the state of the crawl of
+    the current project """
+
+    alias = 'checkpoint'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._cfg = objects.config
+        # Directory of the checkpoint files
+        self.directory = ''
+        # Flag set when changes are being journalled
+        self.active = False
+        # Flag set to keep the checkpoint on disk
+        # at close, for resuming the crawl
+        self.keep = False
+        # Records not yet written to disk
+        self.records = []
+        self.rlock = threading.Lock()
+        # Lock for the journal file
+        self.lock = threading.Lock()
+        # Lock for taking snapshots
+        self.slock = threading.Lock()
+        # Current journal file and its number
+        self.jfile = None
+        self.jseq = 0
+        # Bytes written to the journal since
+        # the last snapshot, and snapshot size
+        self.jbytes = 0
+        self.sbytes = 0
+        # Time of last snapshot
+        self.snaptime = 0
+        # Last counters recorded
+        self.counters = None
+        # Writer thread
+        self.thread = None
+        self.evnt = threading.Event()
+        # Flag set when the last checkpoint loaded
+        # was re-indexed
+        self.reindexed = False
+        # Stats
+        self.nrecords = 0
+        self.nsnapshots = 0
+
+    def get_directory(self):
+        """ Return the checkpoint directory for the current project """
+
+        if self._cfg.projdir and self._cfg.project:
+            return os.path.join(self._cfg.projdir, 'hm-checkpoint')
+        else:
+            return ''
+
+    def _snapshot_file(self):
+        return os.path.join(self.directory, SNAPSHOT)
+
+    def _journal_file(self, seq):
+        return os.path.join(self.directory, '%s-%06d.log' % (JOURNAL, seq))
+
+    def _journal_seqs(self):
+        """ Return the sorted numbers of the journal files on disk """
+
+        seqs = []
+        for f in glob.glob(os.path.join(self.directory, JOURNAL + '-*.log')):
+            try:
+                seqs.append(int(os.path.basename(f)[len(JOURNAL)+1:-4]))
+            except ValueError:
+                pass
+
+        return sorted(seqs)
+
+    def load(self, upto=None):
+        """ Load the crawl state from the checkpoint of the current
+        project, replaying the journal files up to number 'upto'
+        (default all). Returns None if there is no checkpoint """
+
+        self.directory = self.get_directory()
+        try:
+            state = cPickle.load(open(self._snapshot_file(), 'rb'))
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            return None
+
+        for seq in self._journal_seqs():
+            if seq < state['journal']: continue
+            if upto is not None and seq > upto: break
+            for kind, args in self._read_journal(seq):
+                replay(state, kind, args)
+
+        self.reindexed = False
+        if state.get('urlindex') != urlparser.INDEX_SCHEME:
+            extrainfo('Changing URL indices of checkpoint to the current scheme...')
+            reindex(state)
+            self.reindexed = True
+            
+        return state
+
+    def _read_journal(self, seq):
+        """ Generator yielding the records in the journal file
+        with number 'seq'. A record cut short by a crash ends
+        the journal """
+
+        f = open(self._journal_file(seq), 'rb')
+        try:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) != HEADER.size: break
+                size, = HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) != size: break
+                try:
+                    records = cPickle.loads(data)
+                    for i in range(len(records)):
+                        # The arguments are pickled on their own,
+                        # but not in journals of earlier versions
+                        kind, args = records[i]
+                        if type(args) is str:
+                            records[i] = (kind, cPickle.loads(args))
+                except Exception, e:
+                    break
+                for record in records:
+                    yield record
+        finally:
+            f.close()
+
+    def open(self, resume=False):
+        """ Start checkpointing the crawl. For a new crawl any
+        old checkpoint is removed and a snapshot of the current
+        state is written. For a resumed crawl the checkpoint
+        on disk is continued """
+
+        if not self._cfg.checkpoint: return
+
+        # A checkpoint which was re-indexed cannot
+        # be continued, since its journal has the
+        # old indices
+        resume = resume and not self.reindexed
+        
+        self.reset()
+        self.directory = self.get_directory()
+        if not self.directory: return
+
+        if resume:
+            seqs = self._journal_seqs()
+            if seqs: self.jseq = seqs[-1] + 1
+            self.sbytes = os.path.getsize(self._snapshot_file())
+        else:
+            self.remove()
+            os.makedirs(self.directory)
+
+            state = {'datamanager': objects.datamgr.get_state(),
+                     'trackerqueue': objects.queuemgr.get_state(),
+                     'ruleschecker': objects.rulesmgr.get_state(),
+                     'config': {'url': self._cfg.url, 'project': self._cfg.project},
+                     'urlindex': urlparser.INDEX_SCHEME,
+                     'journal': 0}
+            self._write_snapshot(state)
+
+        self.snaptime = time.time()
+        self.jfile = open(self._journal_file(self.jseq), 'ab')
+        self.keep = False
+        self.active = True
+
+        self.evnt.clear()
+        self.thread = threading.Thread(None, self.run, 'HarvestMan Checkpoint Writer')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def record(self, kind, args):
+        """ Add a record to the journal """
+
+        # The arguments are pickled right away, since the
+        # objects may change before the writer thread
+        # writes them out.
+        args = cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)
+        self.rlock.acquire()
+        self.records.append((kind, args))
+        self.nrecords += 1
+        self.rlock.release()
+
+    def run(self):
+        """ Writer thread, which writes the journal to disk every
+        second and takes a snapshot of the state every
+        'checkpointinterval' seconds """
+
+        while not self.evnt.isSet():
+            self.evnt.wait(1.0)
+            try:
+                self.flush()
+                if time.time() - self.snaptime >= self._cfg.checkpointinterval and \
+                       self.jbytes >= self.sbytes/4:
+                    # The snapshot is rewritten only after the journal
+                    # has grown to a quarter of its size, so that the
+                    # cost of snapshots stays proportional to the changes.
+                    self.snapshot()
+            except (IOError, OSError, HarvestManCheckpointError), e:
+                error('Error writing checkpoint:', e)
+                self.active = False
+                break
+
+    def flush(self):
+        """ Write the pending journal records to disk """
+
+        counters = objects.datamgr.get_counters()
+        if counters != self.counters:
+            self.counters = counters
+            self.record('counters', (counters,))
+
+        self.rlock.acquire()
+        records, self.records = self.records, []
+        self.rlock.release()
+
+        self.lock.acquire()
+        try:
+            if not records or not self.jfile: return
+
+            data = cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
+            self.jfile.write(HEADER.pack(len(data)))
+            self.jfile.write(data)
+            self.jfile.flush()
+            os.fsync(self.jfile.fileno())
+            self.jbytes += len(data) + HEADER.size
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """ Fold the journal into a new snapshot """
+
+        self.slock.acquire()
+        try:
+            self._snapshot()
+        finally:
+            self.slock.release()
+
+    def _snapshot(self):
+        # Record the caches of the rules checker which are
+        # small enough to not be worth journalling
+        self.record('caches', (objects.rulesmgr.get_caches(),))
+        self.flush()
+
+        # Switch to a new journal file, the closed ones
+        # are then folded into the snapshot.
+        self.lock.acquire()
+        try:
+            self.jfile.close()
+            seq = self.jseq
+            self.jseq += 1
+            self.jfile = open(self._journal_file(self.jseq), 'ab')
+            self.jbytes = 0
+        finally:
+            self.lock.release()
+
+        state = self.load(seq)
+        if state is None:
+            raise HarvestManCheckpointError, 'cannot load snapshot'
+
+        state['journal'] = seq + 1
+        self._write_snapshot(state)
+
+        for s in self._journal_seqs():
+            if s <= seq:
+                os.remove(self._journal_file(s))
+
+    def _write_snapshot(self, state):
+        """ Write the snapshot file atomically """
+
+        tmpfile = self._snapshot_file() + '.tmp'
+        f = open(tmpfile, 'wb')
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        # Rename does not replace an existing file on Windows
+        if os.name == 'nt' and os.path.isfile(self._snapshot_file()):
+            os.remove(self._snapshot_file())
+        os.rename(tmpfile, self._snapshot_file())
+
+        self.sbytes = os.path.getsize(self._snapshot_file())
+        self.snaptime = time.time()
+        self.nsnapshots += 1
+
+    def save(self):
+        """ Write the checkpoint to disk and keep it for
+        resuming the crawl """
+
+        if not self.active: return
+
+        # Everything is in the journal already, so writing
+        # out the last records is enough.
+        self.keep = True
+        self.flush()
+        extrainfo('Saved checkpoint of project to %s.' % self.directory)
+
+    def close(self):
+        """ Stop checkpointing. The checkpoint is removed unless
+        the crawl was interrupted """
+
+        if self.thread:
+            self.evnt.set()
+            self.thread.join()
+            self.thread = None
+
+        if self.active:
+            try:
+                self.flush()
+            except (IOError, OSError, HarvestManCheckpointError), e:
+                error('Error writing checkpoint:', e)
+            self.active = False
+
+        if self.jfile:
+            self.jfile.close()
+            self.jfile = None
+
+        if not self.keep:
+            self.remove()
+
+    def remove(self):
+        """ Remove the checkpoint from disk """
+
+        if self.directory and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory, True)
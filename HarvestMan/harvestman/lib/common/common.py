@@ -86,6 +86,11 @@ class SleepEvent(object):
         self.evt.wait(self._sleeptime)
         self.evt.set()
 
+    def wake(self):
+        """ Cut short a sleep in progress """
+        
+        self.evt.set()
+
 class RandomSleepEvent(SleepEvent):
     """ A class representing a timeout event. This can be
     used to passively wait for a given time-period instead of
@@ -96,6 +101,34 @@ class RandomSleepEvent(SleepEvent):
         self.evt.wait(random.random()*self._sleeptime)
         self.evt.set()
     
+class AtomicCounter(object):
+    """ An integer counter which can be updated from many
+    threads. Every counter has its own lock which is held
+    only for the update, so unrelated counters never
+    contend with each other """
+
+    __slots__ = ('value', 'lock')
+    
+    def __init__(self, value=0):
+        self.value = value
+        self.lock = threading.Lock()
+
+    def add(self, n=1):
+        """ Add 'n' to the counter and return the new value """
+        
+        self.lock.acquire()
+        try:
+            self.value += n
+            return self.value
+        finally:
+            self.lock.release()
+
+    def __int__(self):
+        return self.value
+
+    def __repr__(self):
+        return str(self.value)
+    
 class DummyStderr(object):
     """ A dummy class to imitate stderr """
     
@@ -551,7 +584,8 @@ def set_aliases(path=None):
     SetAlias(connmgr)
     
     # Connector factory
-    conn_factory = connector.HarvestManUrlConnectorFactory(objects.config.connections)
+    conn_factory = connector.HarvestManUrlConnectorFactory(objects.config.connections,
+                                                           objects.config.hostconnections)
     SetAlias(conn_factory)
     
     queuemgr = urlqueue.HarvestManCrawlerQueue()
@@ -0,0 +1,320 @@
+"""
+hashdb.py - Hash-indexed store of pickled objects with a
+bounded in-memory working set. Objects are looked up by key
+in a dictionary. When more than a given number of objects are
+in memory, the least recently used ones are pickled to
+append-only segment files on disk and loaded back when looked
+up again. Keys are iterated in the order they were inserted.
+
+A segment file is removed as soon as none of its records are
+current, so disk usage is bounded by the number of objects
+on disk.
+"""
+
+import os
+import cPickle
+import struct
+import tempfile
+import threading
+
+from harvestman.lib.common.lrucache import LRU
+
+HEADER = struct.Struct('!I')
+
+# Position of a record on disk, as segment number
+# and offset packed in one integer
+OFFSET_BITS = 40
+OFFSET_MASK = (1L << OFFSET_BITS) - 1
+
+class HashDBError(Exception):
+    pass
+
+class HashDB(object):
+    """ Dictionary-like store which spills the least recently
+    used objects to segment files on disk """
+
+    def __init__(self, memsize=0, directory='', prefix='db',
+                 segsize=32*1024*1024, syncsize=1000):
+        # Maximum number of objects in memory,
+        # 0 means no limit
+        self.memsize = memsize
+        # Directory for the segment files, a
+        # temporary one is created if needed.
+        self.directory = directory
+        self.prefix = prefix
+        # Size of a segment file in bytes
+        self.segsize = segsize
+        # Number of records written between syncs
+        self.syncsize = syncsize
+        # Flag indicating we created the directory
+        self.tempdir = False
+        self.lock = threading.Lock()
+        self._init()
+
+    def _init(self):
+        # Objects in memory, in order of use if
+        # their number is limited
+        if self.memsize:
+            self.mem = LRU(self.memsize)
+        else:
+            self.mem = {}
+        # Positions of the objects on disk
+        self.disk = {}
+        # Keys in the order of insertion
+        self.order = []
+        # Number of objects
+        self.size = 0
+        # Segment numbers mapped to their
+        # number of current records
+        self.segments = {}
+        # Files opened for reading, by segment
+        self.rfiles = {}
+        # Writer state
+        self.wseg = -1
+        self.wfile = None
+        self.woffset = 0
+        # Number of records written since the last sync
+        self.unsynced = 0
+        # Stats
+        self.hits = 0
+        self.loads = 0
+        self.spills = 0
+        self.syncs = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return key in self.mem or key in self.disk
+
+    def _segment_file(self, seg):
+        return os.path.join(self.directory, '%s-%06d.seg' % (self.prefix, seg))
+
+    def _open_writer(self):
+        if not self.directory:
+            self.directory = tempfile.mkdtemp(prefix='hm-' + self.prefix + '-')
+            self.tempdir = True
+        elif not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        oldfile, oldseg = self.wfile, self.wseg
+        self.wseg += 1
+        self.wfile = open(self._segment_file(self.wseg), 'wb')
+        self.woffset = 0
+        self.segments[self.wseg] = 0
+
+        if oldfile:
+            oldfile.flush()
+            os.fsync(oldfile.fileno())
+            oldfile.close()
+            self.unsynced = 0
+            # Drop the segment if all its
+            # records were loaded back
+            self._release(oldseg, 0)
+
+    def _release(self, seg, count=1):
+        """ Mark 'count' records of segment 'seg' as no
+        longer current and remove the segment file if it has
+        none left """
+
+        live = self.segments[seg] - count
+        self.segments[seg] = live
+        if live==0 and seg != self.wseg:
+            del self.segments[seg]
+            f = self.rfiles.pop(seg, None)
+            if f: f.close()
+            try:
+                os.remove(self._segment_file(seg))
+            except OSError:
+                pass
+
+    def _sync(self):
+        if self.unsynced:
+            self.wfile.flush()
+            os.fsync(self.wfile.fileno())
+            self.unsynced = 0
+            self.syncs += 1
+
+    def _write(self, key, obj):
+        """ Write an object to the current segment """
+
+        if self.wfile is None or self.woffset >= self.segsize:
+            self._open_writer()
+
+        data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        self.wfile.write(HEADER.pack(len(data)))
+        self.wfile.write(data)
+        self.disk[key] = (self.wseg << OFFSET_BITS) | self.woffset
+        self.woffset += HEADER.size + len(data)
+        self.segments[self.wseg] += 1
+        self.spills += 1
+
+        # Syncs are done once per batch of records
+        # instead of once per record
+        self.unsynced += 1
+        if self.unsynced >= self.syncsize:
+            self._sync()
+
+    def _read(self, key):
+        """ Read the object for 'key' from disk """
+
+        pos = self.disk[key]
+        seg, offset = int(pos >> OFFSET_BITS), pos & OFFSET_MASK
+        if seg == self.wseg and self.unsynced:
+            # Reading the segment being written
+            self.wfile.flush()
+
+        f = self.rfiles.get(seg)
+        if f is None:
+            f = self.rfiles[seg] = open(self._segment_file(seg), 'rb')
+        f.seek(offset)
+        header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise HashDBError, 'truncated record in segment %d' % seg
+        size, = HEADER.unpack(header)
+        return cPickle.loads(f.read(size))
+
+    def _load(self, key):
+        """ Move the object for 'key' from disk to memory """
+
+        obj = self._read(key)
+        pos = self.disk.pop(key)
+        self._release(int(pos >> OFFSET_BITS))
+        self.loads += 1
+        self._put(key, obj)
+        return obj
+
+    def _put(self, key, obj):
+        mem = self.mem
+        if self.memsize and len(mem) >= self.memsize:
+            # Spill the least recently used object
+            oldkey, oldobj = mem.popitem()
+            self._write(oldkey, oldobj)
+        mem[key] = obj
+
+    def insert(self, key, obj):
+        """ Add object 'obj' with key 'key', replacing
+        the object with this key if any. The object
+        may not be None """
+
+        self.lock.acquire()
+        try:
+            mem = self.mem
+            if key in mem:
+                del mem[key]
+            elif key in self.disk:
+                pos = self.disk.pop(key)
+                self._release(int(pos >> OFFSET_BITS))
+            else:
+                self.order.append(key)
+                self.size += 1
+            self._put(key, obj)
+        finally:
+            self.lock.release()
+
+    def update(self, key, obj):
+        """ Replace the object with key 'key', if there
+        is one, by 'obj' """
+
+        if key in self:
+            self.insert(key, obj)
+
+    def lookup(self, key):
+        """ Return the object with key 'key' or None
+        if not found """
+
+        self.lock.acquire()
+        try:
+            mem = self.mem
+            obj = mem.get(key)
+            if obj is None:
+                if key in self.disk:
+                    return self._load(key)
+                return None
+
+            if self.memsize:
+                # Most recently used now
+                del mem[key]
+                mem[key] = obj
+            self.hits += 1
+            return obj
+        finally:
+            self.lock.release()
+
+    def iterkeys(self):
+        """ Iterate over the keys in order of insertion """
+
+        return iter(self.order)
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        """ Iterate over the (key, object) pairs in order of
+        insertion. Objects on disk are read without moving
+        them to memory, so the working set is not changed """
+
+        for key in self.order:
+            self.lock.acquire()
+            try:
+                obj = self.mem.get(key)
+                if obj is None and key in self.disk:
+                    obj = self._read(key)
+            finally:
+                self.lock.release()
+
+            yield key, obj
+
+    def itervalues(self):
+        """ Iterate over the objects in order of insertion """
+
+        for key, obj in self.iteritems():
+            yield obj
+
+    def sync(self):
+        """ Flush the records written so far to disk """
+
+        self.lock.acquire()
+        try:
+            if self.wfile:
+                self._sync()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ Return a dictionary of statistics """
+
+        return {'size': self.size, 'memory': len(self.mem),
+                'disk': len(self.disk), 'hits': self.hits,
+                'loads': self.loads, 'spills': self.spills,
+                'syncs': self.syncs, 'segments': len(self.segments)}
+
+    def clear(self):
+        """ Remove all objects """
+
+        self.lock.acquire()
+        try:
+            files = self.rfiles.values()
+            if self.wfile: files.append(self.wfile)
+            for f in files:
+                f.close()
+            for seg in self.segments:
+                try:
+                    os.remove(self._segment_file(seg))
+                except OSError:
+                    pass
+            self._init()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """ Remove all objects and the directory if it
+        was created by us """
+
+        self.clear()
+        if self.tempdir:
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+            self.directory = ''
+            self.tempdir = False
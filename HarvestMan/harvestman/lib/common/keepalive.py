@@ -120,7 +120,9 @@ EXTRA ATTRIBUTES AND METHODS
 import urllib2
 import httplib
 import socket
+import select
 import thread
+import time
 
 class FakeLogger:
     def debug(self, msg, *args): print msg % args
@@ -138,23 +140,47 @@ class ConnectionManager:
     """
     The connection manager must be able to:
       * keep track of all existing
+      * keep at most maxconns connections to a host (0 for no limit)
+      * close connections which were idle for longer than idletime
+        seconds (0 for no limit)
+      * check that an idle connection is still alive before it is
+        reused
+      * count the connections reused (hits), made (misses), closed
+        for being idle (evictions) and found dead (stale)
       """
-    def __init__(self):
+    def __init__(self, maxconns=0, idletime=0):
         self._lock = thread.allocate_lock()
         self._hostmap = {} # map hosts to a list of connections
         self._connmap = {} # map connections to host
         self._readymap = {} # map connection to ready state
+        self._idlemap = {} # map connection to time it became ready
+        self.maxconns = maxconns
+        self.idletime = idletime
+        self._lastsweep = time.time()
+        self.hits = self.misses = self.evictions = self.stale = 0
 
     def add(self, host, connection, ready):
+        """ add the connection to the pool and return True, or
+        return False if the pool has no room for it """
         self._lock.acquire()
         try:
-            if not self._hostmap.has_key(host): self._hostmap[host] = []
-            self._hostmap[host].append(connection)
+            self.misses += 1
+            conns = self._hostmap.get(host)
+            if conns is None:
+                conns = self._hostmap[host] = []
+            elif self.maxconns and len(conns) >= self.maxconns:
+                return False
+            conns.append(connection)
             self._connmap[connection] = host
             self._readymap[connection] = ready
+            if ready: self._idlemap[connection] = time.time()
+            return True
         finally:
             self._lock.release()
 
+    def has(self, connection):
+        return self._connmap.has_key(connection)
+
     def remove(self, connection):
         self._lock.acquire()
         try:
@@ -165,38 +191,118 @@ class ConnectionManager:
             else:
                 del self._connmap[connection]
                 del self._readymap[connection]
+                self._idlemap.pop(connection, None)
                 self._hostmap[host].remove(connection)
                 if not self._hostmap[host]: del self._hostmap[host]
         finally:
             self._lock.release()
 
     def set_ready(self, connection, ready):
-        try: self._readymap[connection] = ready
-        except KeyError: pass
-        
+        self._lock.acquire()
+        try:
+            if self._readymap.has_key(connection):
+                self._readymap[connection] = ready
+                if ready: self._idlemap[connection] = time.time()
+        finally:
+            self._lock.release()
+
     def get_ready_conn(self, host):
+        """ return an idle connection to host which is still
+        alive, marking it busy, or None """
         conn = None
+        dead = []
         self._lock.acquire()
         try:
-            if self._hostmap.has_key(host):
-                for c in self._hostmap[host]:
-                    if self._readymap[c]:
-                        self._readymap[c] = 0
-                        conn = c
-                        break
+            now = time.time()
+            if self.idletime and now - self._lastsweep > self.idletime:
+                dead.extend(self._sweep(now))
+            for c in list(self._hostmap.get(host, [])):
+                if not self._readymap[c]: continue
+                if self.idletime and now - self._idlemap[c] > self.idletime:
+                    self.evictions += 1
+                elif not is_alive(c):
+                    self.stale += 1
+                else:
+                    self._readymap[c] = 0
+                    self.hits += 1
+                    conn = c
+                    break
+                self._remove(c)
+                dead.append(c)
         finally:
             self._lock.release()
+
+        for c in dead: c.close()
         return conn
 
+    def sweep(self):
+        """ close the connections idle for longer than idletime """
+        self._lock.acquire()
+        try:
+            dead = self._sweep(time.time())
+        finally:
+            self._lock.release()
+        for c in dead: c.close()
+        return len(dead)
+
+    def _sweep(self, now):
+        # the lock must be held
+        self._lastsweep = now
+        dead = []
+        for c, t in self._idlemap.items():
+            if self._readymap[c] and now - t > self.idletime:
+                self.evictions += 1
+                self._remove(c)
+                dead.append(c)
+        return dead
+
+    def _remove(self, connection):
+        # the lock must be held
+        host = self._connmap.pop(connection)
+        del self._readymap[connection]
+        self._idlemap.pop(connection, None)
+        self._hostmap[host].remove(connection)
+        if not self._hostmap[host]: del self._hostmap[host]
+
+    def get_stats(self):
+        """ return a dictionary of the pool counters and
+        the number of connections open """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'stale': self.stale,
+                'open': len(self._connmap)}
+
     def get_all(self, host=None):
-        if host:
-            return list(self._hostmap.get(host, []))
-        else:
-            return dict(self._hostmap)
+        # copies, since the caller may remove connections
+        self._lock.acquire()
+        try:
+            if host:
+                return list(self._hostmap.get(host, []))
+            else:
+                return dict([(h, list(conns)) for h, conns in self._hostmap.items()])
+        finally:
+            self._lock.release()
+
+def is_alive(connection):
+    """ check that an idle connection was not closed by the
+    server. An idle socket should have nothing to read, so
+    if it is readable the server has closed it (or sent
+    something unexpected) and it cannot be reused """
+    sock = connection.sock
+    if sock is None: return False
+    try:
+        if hasattr(sock, 'pending') and sock.pending(): return False
+        readable = select.select([sock], [], [], 0)[0]
+    except (socket.error, select.error, ValueError):
+        return False
+    return not readable
 
 class KeepAliveHandler:
-    def __init__(self):
-        self._cm = ConnectionManager()
+    def __init__(self, maxconns=0, idletime=0):
+        self._cm = ConnectionManager(maxconns, idletime)
+
+    def get_stats(self):
+        """return a dictionary of the connection pool counters"""
+        return self._cm.get_stats()
         
     #### Connection Management
     def open_connections(self):
@@ -222,7 +328,11 @@ class KeepAliveHandler:
     def _request_closed(self, request, host, connection):
         """tells us that this request is now closed and the the
         connection is ready for another request"""
-        self._cm.set_ready(connection, 1)
+        if self._cm.has(connection):
+            self._cm.set_ready(connection, 1)
+        else:
+            # not pooled, since the pool was full
+            connection.close()
 
     def _remove_connection(self, host, connection, close=0):
         if close: connection.close()
@@ -247,19 +357,23 @@ class KeepAliveHandler:
                 # discard it and ask for the next free connection
                 h.close()
                 self._cm.remove(h)
+                self._cm.stale += 1
                 h = self._cm.get_ready_conn(host)
             else:
                 # no (working) free connections were found.  Create a new one.
                 h = self._get_connection(host)
                 if DEBUG: DEBUG.info("creating new connection to %s (%d)" % (host, id(h)))
-                self._cm.add(host, h, 0)
+                if not self._cm.add(host, h, 0):
+                    if DEBUG: DEBUG.info("pool full for %s, not keeping (%d)" % (host, id(h)))
                 self._start_transaction(h, req)
                 r = h.getresponse()
         except (socket.error, httplib.HTTPException), err:
             raise urllib2.URLError(err)
             
         # if not a persistent connection, don't try to reuse it
-        if r.will_close: self._cm.remove(h)
+        if r.will_close:
+            self._cm.remove(h)
+            # the response object closes the socket
 
         if DEBUG: DEBUG.info("STATUS: %s, %s" % (r.status, r.reason))
         r._handler = self
@@ -345,8 +459,8 @@ class KeepAliveHandler:
         return NotImplementedError
 
 class HTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
-    def __init__(self):
-        KeepAliveHandler.__init__(self)
+    def __init__(self, maxconns=0, idletime=0):
+        KeepAliveHandler.__init__(self, maxconns, idletime)
 
     def http_open(self, req):
         return self.do_open(req)
@@ -355,17 +469,17 @@ class HTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
         return HTTPConnection(host)
 
 class HTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
-    def __init__(self, ssl_factory=None):
-        KeepAliveHandler.__init__(self)
-        #if not ssl_factory:
-        #    ssl_factory = sslfactory.get_factory()
-        #self._ssl_factory = ssl_factory
+    def __init__(self, maxconns=0, idletime=0, context=None):
+        KeepAliveHandler.__init__(self, maxconns, idletime)
+        # ssl context, as for urllib2.HTTPSHandler
+        self._context = context
     
     def https_open(self, req):
         return self.do_open(req)
 
     def _get_connection(self, host):
-        # return self._ssl_factory.create_https_connection(host)
+        if self._context is not None:
+            return HTTPSConnection(host, context=self._context)
         return HTTPSConnection(host)
 
 class HTTPResponse(httplib.HTTPResponse):
@@ -471,22 +585,12 @@ class HTTPConnection(httplib.HTTPConnection):
     response_class = HTTPResponse
 
 class HTTPSConnection(httplib.HTTPSConnection):
+    # the connect method of httplib wraps the socket
+    # with the ssl module, so only the response class
+    # needs to be changed
     response_class = HTTPResponse
 
-    def connect(self):
-        import _socket
-        
-        # For fixing #503
-        sock = _socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.host, self.port))
-        # Change this to certicate paths where you have your SSL client certificates
-        # to be able to download URLs producing SSL errors.
-        ssl = socket.ssl(sock, None, None)
-        
-        self.sock = httplib.FakeSocket(sock, ssl)
-    
-    
-    
+
 #########################################################################
 #####   TEST FUNCTIONS
 #########################################################################
@@ -109,6 +109,25 @@ class LRU(object):
             self.last = nobj.prev
         del self.d[obj]
 
+    def get(self, obj, default=None):
+        """ Return the value of 'obj' or 'default', without
+        making it the most recently used """
+
+        try:
+            return self.d[obj].me[1]
+        except KeyError:
+            return default
+
+    def popitem(self):
+        """ Remove and return the least recently used
+        (key, value) pair """
+
+        if self.first is None:
+            raise KeyError, 'popitem(): LRU is empty'
+        a = self.first.me
+        del self[a[0]]
+        return a
+
     def __iter__(self):
         cur = self.first
         while cur != None:
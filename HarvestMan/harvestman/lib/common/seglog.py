@@ -0,0 +1,188 @@
+"""
+seglog.py - Append-only, segmented on-disk log of pickled
+records which are read back in the order they were written.
+The log is split into segment files holding a fixed number
+of records each. A segment file is removed as soon as all
+its records have been read, so disk usage is bounded by
+the number of unread records.
+"""
+
+import os
+import cPickle
+import struct
+import tempfile
+import threading
+
+HEADER = struct.Struct('!I')
+
+class SegmentLogError(Exception):
+    pass
+
+class SegmentLog(object):
+    """ A FIFO of pickled objects stored in append-only
+    segment files on disk """
+
+    def __init__(self, directory='', prefix='seg', segsize=10000):
+        # Directory for the segment files, a
+        # temporary one is created if not given.
+        self.directory = directory
+        self.prefix = prefix
+        # Number of records per segment
+        self.segsize = segsize
+        # Flag indicating we created the directory
+        self.tempdir = False
+        self.lock = threading.Lock()
+        self._init()
+
+    def _init(self):
+        # Segment numbers currently on disk
+        self.segments = []
+        # Writer state
+        self.wseg = -1
+        self.wfile = None
+        self.wcount = 0
+        # Reader state
+        self.rseg = -1
+        self.rfile = None
+        self.rcount = 0
+        # Number of unread records
+        self.count = 0
+        # Stats
+        self.written = 0
+        self.read = 0
+
+    def __len__(self):
+        return self.count
+
+    def _segment_file(self, seg):
+        return os.path.join(self.directory, '%s-%06d.log' % (self.prefix, seg))
+
+    def _open_writer(self):
+        if not self.directory:
+            self.directory = tempfile.mkdtemp(prefix='hm-' + self.prefix + '-')
+            self.tempdir = True
+        elif not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if self.wfile:
+            self.wfile.close()
+        self.wseg += 1
+        self.wfile = open(self._segment_file(self.wseg), 'wb')
+        self.wcount = 0
+        self.segments.append(self.wseg)
+
+    def _open_reader(self):
+        if self.rfile:
+            self.rfile.close()
+            # Done with this segment
+            os.remove(self._segment_file(self.rseg))
+            self.segments.remove(self.rseg)
+
+        self.rseg = self.segments[0]
+        self.rfile = open(self._segment_file(self.rseg), 'rb')
+        self.rcount = 0
+
+    def _append(self, obj):
+        if self.wfile is None or self.wcount >= self.segsize:
+            self._open_writer()
+
+        data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        self.wfile.write(HEADER.pack(len(data)))
+        self.wfile.write(data)
+        self.wcount += 1
+        self.count += 1
+        self.written += 1
+
+    def _next(self):
+        if self.rfile is None or \
+               (self.rcount >= self.segsize and self.rseg != self.wseg):
+            self._open_reader()
+
+        if self.rseg == self.wseg:
+            # Reading the segment being written
+            self.wfile.flush()
+
+        header = self.rfile.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise SegmentLogError, 'truncated record in segment %d' % self.rseg
+        size, = HEADER.unpack(header)
+        obj = cPickle.loads(self.rfile.read(size))
+        self.rcount += 1
+        self.count -= 1
+        self.read += 1
+
+        return obj
+
+    def append(self, obj):
+        """ Append an object to the log """
+
+        self.lock.acquire()
+        try:
+            self._append(obj)
+        finally:
+            self.lock.release()
+
+    def extend(self, objs):
+        """ Append a sequence of objects to the log """
+
+        self.lock.acquire()
+        try:
+            for obj in objs:
+                self._append(obj)
+        finally:
+            self.lock.release()
+
+    def pop(self, n=1):
+        """ Read and return a list of at most 'n' of the
+        oldest unread objects from the log """
+
+        items = []
+        self.lock.acquire()
+        try:
+            while self.count and len(items)<n:
+                items.append(self._next())
+            if self.count==0 and self.segments:
+                # Everything read, start afresh so that
+                # the segment files can be removed.
+                self._reset()
+        finally:
+            self.lock.release()
+
+        return items
+
+    def _reset(self):
+        for f in (self.rfile, self.wfile):
+            if f: f.close()
+        for seg in self.segments:
+            try:
+                os.remove(self._segment_file(seg))
+            except OSError:
+                pass
+        wseg = self.wseg
+        written, read = self.written, self.read
+        self._init()
+        # Keep numbering and stats across resets
+        self.wseg = wseg
+        self.written, self.read = written, read
+
+    def clear(self):
+        """ Drop all unread records """
+
+        self.lock.acquire()
+        try:
+            self._reset()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """ Drop all records and remove the directory
+        if it was created by us """
+
+        self.clear()
+        if self.tempdir:
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+            self.directory = ''
+            self.tempdir = False
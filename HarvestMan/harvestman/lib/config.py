@@ -108,6 +108,7 @@ CONFIG_XML_TEMPLATE="""\
       </types> 
       <cache status="%(pagecache)s">
         <datacache value="%(datacache)s" />
+        <blobstore status="%(blobstore)s" links="%(bloblinks)s" />
       </cache>
       <protocol>
         <http compress="%(httpcompress)s" />
@@ -134,14 +135,15 @@ CONFIG_XML_TEMPLATE="""\
         <maxfiles value="%(maxfiles)s" />
         <maxfilesize value="%(maxfilesize)s" />
         <maxbytes value="%(maxbytes)s" />
-        <maxconnections value="%(connections)s" />
-        <maxbandwidth value="%(bandwidthlimit)s" factor="%(throttlefactor)s" />
+        <maxconnections value="%(connections)s" perhost="%(hostconnections)s" />
+        <maxbandwidth value="%(bandwidthlimit)s" perhost="%(hostbandwidthlimit)s" />
         <timelimit value="%(timelimit)s" />
       </limits>
       <rules>
         <robots value="%(robots)s" />
         <urlpriority>%(urlpriority)s</urlpriority>
         <serverpriority>%(serverpriority)s</serverpriority>
+        <linkrank value="%(linkrank)s" />
       </rules>
       <filters>
         <urlfilter>%(urlfilter)s</urlfilter>
@@ -181,6 +183,15 @@ CONFIG_XML_TEMPLATE="""\
       <workers status="%(usethreads)s" size="%(threadpoolsize)s" timeout="%(timeout)s" />
       <trackers value="%(maxtrackers)s" timeout="%(fetchertimeout)s" />
       <timegap value="%(sleeptime)s" random="%(randomsleep)s" />
+      <hostqueues status="%(hostqueues)s" delay="%(hostdelay)s" />
+      <queuespill status="%(queuespill)s" batch="%(spillbatch)s" />
+      <queuebatch value="%(queuebatch)s" />
+      <adaptivethreads status="%(adaptivethreads)s" period="%(adaptiveperiod)s" minfetchers="%(minfetchers)s" mincrawlers="%(mincrawlers)s" />
+      <urlverify value="%(urlverify)s" />
+      <linkcache size="%(linkcachesize)s" />
+      <urldb backend="%(urldbbackend)s" memsize="%(urldbsize)s" batch="%(urldbbatch)s" interval="%(urldbinterval)s" />
+      <checkpoint status="%(checkpoint)s" interval="%(checkpointinterval)s" />
+      <connpool status="%(connpool)s" size="%(poolsize)s" idletime="%(poolidletime)s" />
       <connections type="%(datamodename)s" />
     </system>
     
@@ -188,7 +199,7 @@ CONFIG_XML_TEMPLATE="""\
       <urltreefile status="%(urltreefile)s" />
       <archive status="%(archive)s" format="%(archformat)s" />
       <urlheaders status="%(urlheaders)s" />
-      <localise value="%(localise)s" />
+      <localise value="%(localise)s" workers="%(localiseworkers)s" />
     </files>
     
     <display>
@@ -276,6 +287,9 @@ class HarvestManStateObject(dict, Singleton):
         self.proxyport=80
         self.errorfile='errors.log'
         self.localise=2
+        # Number of processes localising links,
+        # 0 for one per CPU
+        self.localiseworkers=0
         self.images=1
         self.movies=0
         self.flash=0
@@ -315,6 +329,10 @@ class HarvestManStateObject(dict, Singleton):
         self.serverpriority = ''
         self.urlprioritydict = {}
         self.serverprioritydict = {}
+        # Prioritize URLs by their importance estimated
+        # from the links seen so far (OPIC) instead of
+        # by their generation
+        self.linkrank = 0
         self.verbosity=logger.INFO
         self.verbosity_default=logger.INFO
         # Override project verbosity - done
@@ -338,8 +356,6 @@ class HarvestManStateObject(dict, Singleton):
         self.browsepage=0
         self.checkfiles=1
         self.pagecache=1
-        # Internal variable telling whether to write cache
-        self.writecache=True
         self.cachefound=0
         self._error=''
         self.starttime=0
@@ -347,9 +363,14 @@ class HarvestManStateObject(dict, Singleton):
         self.javascript = 1
         self.javaapplet = 1
         self.connections=5
+        # Maximum connections to a server at a
+        # time, 0 means no limit
+        self.hostconnections = 0
         # Bandwidth limit, 0 means no limit
         self.bandwidthlimit = 0
-        self.throttlefactor = 1.5
+        # Bandwidth limit for each server,
+        # 0 means no limit
+        self.hostbandwidthlimit = 0
         self.cachefileformat='pickled' 
         self.testing = 0
         self.testnocrawl = 0
@@ -372,6 +393,12 @@ class HarvestManStateObject(dict, Singleton):
         self.timelimit = -1
         self.terminate = 0
         self.datacache = 0
+        # Store downloaded files once by content hash
+        # in the project cache directory, and make the
+        # files of the mirrored site 'hard' or 'sym'
+        # links to them
+        self.blobstore = 0
+        self.bloblinks = 'hard'
         self.blocking = 0
         self.junkfilter = 1
         self.junkfilterdomains = 1
@@ -400,6 +427,72 @@ class HarvestManStateObject(dict, Singleton):
         self.queuetime = 1.0
         # Queue size - fixed...
         self.queuesize = 5000
+        # Use per-host (politeness) queues
+        # for the url queue
+        self.hostqueues = 0
+        # Minimum time between two fetches
+        # from the same host when using
+        # per-host queues
+        self.hostdelay = 1.0
+        # Spill url and data queue items
+        # which overflow queuesize to disk
+        self.queuespill = 0
+        # Number of spilled items moved back
+        # to memory at a time
+        self.spillbatch = 500
+        # Maximum number of items a crawler
+        # or fetcher takes from its queue
+        # at a time
+        self.queuebatch = 10
+        # Adapt the ratio of fetcher and
+        # crawler threads during the crawl
+        self.adaptivethreads = 0
+        # Period in seconds between changes
+        # of the ratio
+        self.adaptiveperiod = 2.0
+        # Minimum number of fetchers and
+        # crawlers when adapting the ratio
+        self.minfetchers = 1
+        self.mincrawlers = 1
+        # Compare the URL strings of URLs having
+        # the same fingerprint for detecting
+        # duplicates
+        self.urlverify = 0
+        # Number of links of crawled pages whose
+        # URLs are cached, for finding duplicate
+        # links without resolving them again
+        self.linkcachesize = 10000
+        # Number of URL objects and of link collections
+        # kept in memory by the URL database. The least
+        # recently used ones beyond this are spilled to disk.
+        self.urldbsize = 100000
+        # Backend of the URL database, 'hash' for
+        # the hash table of common.hashdb, 'sqlite' for
+        # an sqlite database in the project cache directory
+        self.urldbbackend = 'hash'
+        # Number of writes and maximum time in seconds
+        # between commits of the sqlite URL database
+        self.urldbbatch = 1000
+        self.urldbinterval = 1.0
+        # Journal the crawl state to the project
+        # directory so that an interrupted crawl
+        # resumes where it left off
+        self.checkpoint = 0
+        # Minimum time in seconds between two
+        # snapshots of the crawl state
+        self.checkpointinterval = 300.0
+        # Keep connections to servers open for
+        # reuse in a pool of limited size per
+        # server, for HTTP and HTTPS. Otherwise
+        # only HTTP connections are kept open,
+        # without limits.
+        self.connpool = 0
+        # Maximum connections kept open to
+        # a server, 0 for no limit
+        self.poolsize = 4
+        # Time after which a connection
+        # which was not used is closed
+        self.poolidletime = 30.0
         self.randomsleep = 1
         # For http compression
         self.httpcompress = 1
@@ -493,6 +586,8 @@ class HarvestManStateObject(dict, Singleton):
 
                          'cache_status' : ('pagecache','int'),
                          'datacache_value' : ('datacache','int'),
+                         'blobstore_status' : ('blobstore','int'),
+                         'blobstore_links' : ('bloblinks','str'),
 
                          'urllist': ('urlfile', 'str'),
                          'urltreefile_status' : ('urltreefile', 'int'),
@@ -517,12 +612,14 @@ class HarvestManStateObject(dict, Singleton):
                          'maxfilesize_value' : ('maxfilesize','int'),
                          'maxbytes_value' : ('maxbytes', 'func:set_maxbytes'),
                          'maxconnections_value' : ('connections','int'),
+                         'maxconnections_perhost' : ('hostconnections','int'),
                          'maxbandwidth_value' : ('bandwidthlimit','func:set_maxbandwidth'),
-                         'maxbandwidth_factor': ('throttlefactor','float'),
+                         'maxbandwidth_perhost': ('hostbandwidthlimit','func:set_maxbandwidth'),
                          'robots_value' : ('robots','int'),
                          'timelimit_value' : ('timelimit','float'),
                          'urlpriority' : ('urlpriority','str'),
                          'serverpriority' : ('serverpriority','str'),
+                         'linkrank_value' : ('linkrank','int'),
                          'serverfilter' : ('serverfilter','str'),
                          'wordfilter' : ('wordfilter','str'),
                          'junkfilter_value' : ('junkfilter','int'),
@@ -536,10 +633,31 @@ class HarvestManStateObject(dict, Singleton):
                          'savesessions_value': ('savesessions','int'),
                          'timegap_value': ('sleeptime', 'float'),
                          'timegap_random': ('randomsleep', 'int'),
+                         'hostqueues_status': ('hostqueues', 'int'),
+                         'hostqueues_delay': ('hostdelay', 'float'),
+                         'queuespill_status': ('queuespill', 'int'),
+                         'queuespill_batch': ('spillbatch', 'int'),
+                         'queuebatch_value': ('queuebatch', 'int'),
+                         'adaptivethreads_status': ('adaptivethreads', 'int'),
+                         'adaptivethreads_period': ('adaptiveperiod', 'float'),
+                         'adaptivethreads_minfetchers': ('minfetchers', 'int'),
+                         'adaptivethreads_mincrawlers': ('mincrawlers', 'int'),
+                         'urlverify_value': ('urlverify', 'int'),
+                         'linkcache_size': ('linkcachesize', 'int'),
+                         'urldb_memsize': ('urldbsize', 'int'),
+                         'urldb_backend': ('urldbbackend', 'str'),
+                         'urldb_batch': ('urldbbatch', 'int'),
+                         'urldb_interval': ('urldbinterval', 'float'),
+                         'checkpoint_status': ('checkpoint', 'int'),
+                         'checkpoint_interval': ('checkpointinterval', 'float'),
+                         'connpool_status': ('connpool', 'int'),
+                         'connpool_size': ('poolsize', 'int'),
+                         'connpool_idletime': ('poolidletime', 'float'),
                          'connections_type' : ('datamode', 'func:set_datamode'),
                          'feature_name' : ('htmlfeatures', 'func:set_parse_features'),
                          'simulate_value': ('simulate', 'int'),
                          'localise_value' : ('localise','int'),
+                         'localise_workers' : ('localiseworkers','int'),
                          'browsepage_value' : ('browsepage','int'),
 
                          'configfile_value': ('configfile', 'str'),
@@ -817,8 +935,8 @@ class HarvestManStateObject(dict, Singleton):
                 elif spec.startswith('g'):
                     limit *= pow(1024, 3)
 
-            # Set maxbandwidth
-            self.bandwidthlimit = float(limit)
+            # Set maxbandwidth, or the limit per server
+            self[key] = float(limit)
 
     def set_urlfilter(self, key, val, filterdict):
 
@@ -1638,7 +1756,8 @@ def set_aliases():
     SetAlias(connmgr)
 
     # Connector factory
-    conn_factory = connector.HarvestManUrlConnectorFactory(objects.config.connections)
+    conn_factory = connector.HarvestManUrlConnectorFactory(objects.config.connections,
+                                                           objects.config.hostconnections)
     SetAlias(conn_factory)
 
     queuemgr = urlqueue.HarvestManCrawlerQueue()
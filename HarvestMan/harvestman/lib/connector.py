@@ -72,8 +72,7 @@ import threading
 
 import urllib2 
 import urlparse
-import gzip
-import cStringIO
+import zlib
 import os
 import shutil
 import glob
@@ -127,6 +126,76 @@ class HarvestManFileObjectException(Exception):
     """ Exception class for HarvestManFileObject class """
     pass
 
+class HarvestManDecoder(object):
+    """ A class which decodes data compressed with the gzip
+    or deflate content-encodings a block at a time, as it
+    is read from the network """
+
+    def __init__(self, encoding):
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            # Deflate is meant to be zlib format, but some
+            # servers send a raw deflate stream
+            self._obj = zlib.decompressobj()
+        # Data read until the first decoded bytes
+        self._head = ''
+        self._decoded = False
+
+    def decompress(self, block):
+        """ Returns the decoded data for the block 'block' """
+
+        if self._obj is None:
+            return block
+
+        try:
+            data = self._obj.decompress(block)
+        except zlib.error, e:
+            if not self._decoded:
+                block = self._head + block
+                self._head = ''
+                if self._encoding == 'deflate':
+                    # Try again as a raw deflate stream
+                    self._encoding = 'raw'
+                    self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                    return self.decompress(block)
+            # Not really compressed, so the rest of
+            # the data is kept as it is.
+            debug('Error in decoding %s data: %s' % (self._encoding, str(e)))
+            self._obj = None
+            return block
+
+        if data:
+            self._decoded = True
+            self._head = ''
+        elif not self._decoded:
+            self._head += block
+        return data
+
+    def flush(self):
+        """ Returns the decoded data left at the end """
+
+        if self._obj is None:
+            return ''
+
+        data = self._obj.flush()
+        self._obj = None
+        if not data and not self._decoded:
+            # Nothing could be decoded
+            return self._head
+        return data
+
+def get_decoder(encoding):
+    """ Returns a decoder for the content-encoding 'encoding',
+    or None if the data is not encoded """
+
+    encoding = encoding.strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return HarvestManDecoder('gzip')
+    elif encoding == 'deflate':
+        return HarvestManDecoder('deflate')
+
 class HarvestManFileObject(threading.Thread):
     """ A class which imitates a file object. This wraps
     around the file object returned by urllib2 and provides
@@ -140,11 +209,13 @@ class HarvestManFileObject(threading.Thread):
     MULTIPART = False
     NETDATALEN = 0
     
-    def __init__(self, fobj, filename, clength, mode = 0, bwlimit = 0):
+    def __init__(self, fobj, filename, clength, mode = 0, limiter = None, encoding = '', host = None):
         """ Overloaded __init__ method """
 
         self._fobj = fobj
-        self._data = ''
+        # Blocks read so far in memory mode, joined
+        # only when the data is asked for
+        self._blocks = []
         self._clength = int(clength)
         self._start = 0.0
         self._flag = False
@@ -163,9 +234,14 @@ class HarvestManFileObject(threading.Thread):
         self._init = False
         # Last error
         self._lasterror = None
-        # Bandwidth limit as bytes/sec
-        self._bwlimit = bwlimit
+        # Bandwidth limiter, shared by all connectors,
+        # and the server the data is read from
+        self._limiter = limiter
+        self._host = host
         self._bs = 4096
+        # Decoder of gzip or deflate content-encoded
+        # data, which is decoded as it is read
+        self._decoder = get_decoder(encoding)
 
         threading.Thread.__init__(self, None, None, 'data reader')
         
@@ -186,30 +262,13 @@ class HarvestManFileObject(threading.Thread):
         
         self._fobj = fileobj
 
-    def throttle(self, bytecount, start_time, factor):
-        """ Throttle to fall within limits of specified download speed """
-            
-        diff = float(bytecount)/self._bwlimit - (time.time() - start_time)
-        diff = factor*diff/HarvestManUrlConnectorFactory.connector_count
-        # We need to sleep. But a time.sleep does waste raw CPU
-        # cycles. Still there does not seem to be an option here
-        # since we cannot use SleepEvent class here as there could
-        # be many connectors at any given time and hence the threading
-        # library may not be able to create so many distinct Event
-        # objects...
-        # print 'Diff=>',diff
-
-        if diff>0:
-            # We are 'ahead' of the required bandwidth, so sleep
-            # the time difference off.
-            if self._bs>=256: 
-                self._bs -= 128
-            time.sleep(diff)
-
-        elif diff<0:
-            # We are behind the required bandwidth, so read the
-            # additional data
-            self._bs += int(self._bwlimit*abs(diff))
+    def throttle(self, bytecount):
+        """ Throttle to fall within limits of specified download speed,
+        after reading 'bytecount' bytes """
+
+        # Blocks until the limiter has bandwidth
+        # for the bytes read
+        self._limiter.consume(bytecount, self._host)
 
     def run(self):
         """ Overloaded run method """
@@ -221,31 +280,18 @@ class HarvestManFileObject(threading.Thread):
 
         reads = 0
         
-        dmgr = objects.datamgr
-        config = objects.config
-
-        start_time = config.starttime
-        tfactor = config.throttlefactor
-
         while not self._flag:
             try:
                 block = self._fobj.read(self._bs)
                 if block=='':
                     self._flag = True
-                    # Close the file
-                    if self._mode==CONNECTOR_DATA_MODE_FLUSH:
-                        self.close()                
+                    self.finish()
                     break
                 else:
                     reads += 1
-                    self._data = self._data + block
-                    self._contentlen += len(block)
-                    if self._bwlimit:
-                        self.throttle(dmgr.bytes, start_time, tfactor)
-                    
-                    # Flush data to disk
-                    if self._mode==CONNECTOR_DATA_MODE_FLUSH:
-                        self.flush()
+                    self.add_block(block)
+                    if self._limiter:
+                        self.throttle(len(block))
             except socket.error, e:
                 self._flag = True
                 self._lasterror = e
@@ -260,29 +306,16 @@ class HarvestManFileObject(threading.Thread):
     def readNext(self):
         """ Method which reads the next block of data from the URL """
 
-        dmgr = objects.datamgr
-        config = objects.config
-
-        start_time = config.starttime
-        tfactor = config.throttlefactor
-
         try:
             block = self._fobj.read(self._bs)
             if block=='':
                 self._flag = True
-                # Close the file
-                if self._mode==CONNECTOR_DATA_MODE_FLUSH:
-                    self.close()
+                self.finish()
                 return False
             else:
-                self._data = self._data + block
-                self._contentlen += len(block)
-                if self._bwlimit:
-                    self.throttle(dmgr.bytes, start_time, tfactor)
-                
-                # Flush data to disk
-                if self._mode==CONNECTOR_DATA_MODE_FLUSH:
-                    self.flush()
+                self.add_block(block)
+                if self._limiter:
+                    self.throttle(len(block))
 
         except socket.error, e:
             self._fobj.close()
@@ -291,11 +324,45 @@ class HarvestManFileObject(threading.Thread):
             self._fobj.close()            
             raise HarvestManFileObjectException, str(e)               
 
+    def add_block(self, block):
+        """ Adds a block of data read. The block is decoded if
+        it is compressed, and written straight to the temporary
+        file in flush mode and kept in a list of blocks in memory
+        mode, so that reading takes time linear in the size of
+        the data """
+
+        self._contentlen += len(block)
+        if self._decoder:
+            block = self._decoder.decompress(block)
+            if not block: return
+        
+        if self._mode==CONNECTOR_DATA_MODE_FLUSH:
+            self._tmpf.write(block)
+        else:
+            self._blocks.append(block)
+
+    def finish(self):
+        """ Adds the data left in the decoder at the end of
+        the data and closes the temporary file in flush mode """
+
+        if self._decoder:
+            block = self._decoder.flush()
+            if block:
+                if self._mode==CONNECTOR_DATA_MODE_FLUSH:
+                    self._tmpf.write(block)
+                else:
+                    self._blocks.append(block)
+            self._decoder = None
+
+        # Close the file
+        if self._mode==CONNECTOR_DATA_MODE_FLUSH:
+            self.close()
+        
+
     def flush(self):
         """ Flushes data to the temporary file on disk """
 
-        self._tmpf.write(self._data)
-        self._data = ''
+        self._tmpf.flush()
 
     def close(self):
         """ Closes the temporary file object """
@@ -361,8 +428,12 @@ class HarvestManFileObject(threading.Thread):
 
     def get_data(self):
         """ Returns the downloaded data """
-        
-        return self._data
+
+        blocks = self._blocks
+        if len(blocks) > 1:
+            # Joined once, and kept as a single block
+            blocks[:] = [''.join(blocks)]
+        return (blocks and blocks[0]) or ''
 
     def get_datalen(self):
         """ Returns length of downloaded data """
@@ -417,6 +488,9 @@ class HarvestManNetworkConnector(object):
         self._proxydict = {}
         # dictionary of protocol:proxy auth values
         self._proxyauth = {}
+        # Keep-alive handlers, which keep the pools
+        # of connections to servers
+        self._poolhandlers = []
         self.configure()
         
     def set_useproxy(self, val=True):
@@ -592,9 +666,24 @@ class HarvestManNetworkConnector(object):
         if self._cfg.appname == 'Hget':
             httphandler = urllib2.HTTPHandler
             httpshandler = urllib2.HTTPSHandler
+        elif not self._cfg.connpool:
+            # HTTP connections are kept open for reuse
+            # without any limit, HTTPS ones are not
+            httphandler = keepalive.HTTPHandler()
+            self._poolhandlers.append(httphandler)
+            httpshandler = urllib2.HTTPSHandler
         else:
-            httphandler = keepalive.HTTPHandler
-            httpshandler = urllib2.HTTPSHandler #keepalive.HTTPSHandler
+            # Connections are kept open for reuse, in a pool
+            # per server for each protocol
+            httphandler = keepalive.HTTPHandler(self._cfg.poolsize, self._cfg.poolidletime)
+            self._poolhandlers.append(httphandler)
+            if self._useproxy:
+                # HTTPS through a proxy needs a tunnel, which
+                # the keep-alive handler does not make
+                httpshandler = urllib2.HTTPSHandler
+            else:
+                httpshandler = keepalive.HTTPSHandler(self._cfg.poolsize, self._cfg.poolidletime)
+                self._poolhandlers.append(httpshandler)
             
         # If we are behing proxies/firewalls
         if self._useproxy:
@@ -694,6 +783,23 @@ class HarvestManNetworkConnector(object):
         
         return (self._proxydict, self._proxyauth)
 
+    def get_pool_stats(self):
+        """ Return a dictionary of the counters of the
+        connection pools for all protocols """
+
+        statsd = {'hits': 0, 'misses': 0, 'evictions': 0, 'stale': 0, 'open': 0}
+        for handler in self._poolhandlers:
+            for key, val in handler.get_stats().iteritems():
+                statsd[key] += val
+
+        return statsd
+
+    def close_connections(self):
+        """ Close the connections kept open to servers """
+
+        for handler in self._poolhandlers:
+            handler.close_all()
+        
     def increment_socket_errors(self, val=1):
         """ Increment socket error count """
         
@@ -935,7 +1041,7 @@ class HarvestManUrlConnector(object):
 
                 # If we accept http-compression, add the required header.
                 if self._cfg.httpcompress:
-                    request.add_header('Accept-Encoding', 'gzip')
+                    request.add_header('Accept-Encoding', 'gzip, deflate')
 
                 self._freq = urllib2.urlopen(request)
                 # Set status to 1
@@ -1038,7 +1144,8 @@ class HarvestManUrlConnector(object):
 
                 if fetchdata:
                     try:
-                        # If gzip-encoded, need to deflate data
+                        # If gzip or deflate encoded, data
+                        # is decoded as it is read
                         encoding = self.get_content_encoding()
                         clength = self.get_content_length()
                         
@@ -1057,7 +1164,9 @@ class HarvestManUrlConnector(object):
                                                             self._tmpfname,
                                                             clength,
                                                             self._mode,
-                                                            float(self._cfg.bandwidthlimit))
+                                                            dmgr.limiter,
+                                                            encoding,
+                                                            urlobj.get_domain_with_port())
                             self._fo.initialize()
                         else:
                             self._fo.set_fileobject(self._freq)
@@ -1070,22 +1179,12 @@ class HarvestManUrlConnector(object):
  
                         if self._mode==CONNECTOR_DATA_MODE_INMEM:
                             data = self._fo.get_data()
-                            self._datalen = len(data)
+                            # Length of the data as it was read
+                            self._datalen = self._fo.get_datalen()
 
-                            # Save a reference
-                            data0 = data
                             self._freq.close()                        
-                            dmgr.update_bytes(len(data))
+                            dmgr.update_bytes(self._datalen)
                             debug('Encoding',encoding)
-                        
-                            if encoding.strip().find('gzip') != -1:
-                                try:
-                                    gzfile = gzip.GzipFile(fileobj=cStringIO.StringIO(data))
-                                    data = gzfile.read()
-                                    gzfile.close()
-                                except (IOError, EOFError), e:
-                                    data = data0
-                                    pass
                         else:
                             self._datalen = self._fo.get_datalen()
                             dmgr.update_bytes(self._datalen)
@@ -1671,10 +1770,18 @@ class HarvestManUrlConnector(object):
                         ct.set_tmpfname(self._tmpfname)
 
                     if self._fo==None:
+                        # The parts of a multipart download
+                        # cannot be decoded separately
+                        if self._cfg.multipart:
+                            encoding = ''
+                        else:
+                            encoding = self.get_content_encoding()
                         self._fo = HarvestManFileObject(self._freq,
                                                         self._tmpfname,
                                                         clength,
-                                                        self._mode)
+                                                        self._mode,
+                                                        None,
+                                                        encoding)
                     else:
                         self._fo.set_fileobject(self._freq)
 
@@ -2118,44 +2225,40 @@ class HarvestManUrlConnector(object):
                 filename = ''.join((origfilepath,'.',str(n)))
                 n += 1
 
+        # Store of files by content, if enabled
+        blobs = objects.datamgr.blobs
+        duplicate = False
+        
         try:
             extrainfo('Writing file ', filename)
             if self._mode==CONNECTOR_DATA_MODE_INMEM:
-                f=open(filename, 'wb')
-                f.write(self._data)
-                f.close()
+                if blobs:
+                    duplicate = blobs.store(filename, self._data)
+                else:
+                    f=open(filename, 'wb')
+                    f.write(self._data)
+                    f.close()
             else:
-                # Rename file
+                # Rename file, which has the data
+                # already decoded if it was compressed
                 if os.path.isfile(self._tmpfname):
-                    # If gzip-encoded, we need to deflate data
-                    if self.get_content_encoding().strip().find('gzip') != -1:
-                        try:
-                            g=gzip.GzipFile(fileobj=open(self._tmpfname, 'rb'))
-                            # Open file for writing and write block by block
-                            f=open(filename, 'wb')
-                            while 1:
-                                block = g.read(8192)
-                                if block=='':
-                                    f.flush()
-                                    f.close()
-                                    break
-                                else:
-                                    f.write(block)
-                                    f.flush()
-                            g.close()
-                        except (IOError, OSError), e:
-                            return FILE_WRITE_ERROR
+                    if blobs:
+                        duplicate = blobs.store_file(filename, self._tmpfname)
                     else:
                         shutil.move(self._tmpfname, filename)
                     
             if os.path.isfile(filename):
-                self._writelen = os.path.getsize(filename)
+                # Nothing was written for a duplicate
+                if duplicate:
+                    self._writelen = 0
+                else:
+                    self._writelen = os.path.getsize(filename)
 
                 if printmsg:
                     print '\nSaved to %s' % filename    
                 return FILE_WRITE_OK
                 
-        except IOError,e:
+        except (IOError, OSError), e:
             error('IO Error:', str(e))
             return FILE_WRITE_ERROR
         except ValueError, e:
@@ -2818,16 +2921,24 @@ class HarvestManUrlConnectorFactory(object):
     alias = 'connfactory'                
     connector_count = 0
     
-    def __init__(self, maxsize):
+    def __init__(self, maxsize, hostsize=0):
         """ Overloaded __init__ method """
         
-        # The requests dictionary
+        # The requests dictionary, of the semaphores
+        # limiting the connectors to each server
         self._requests = {}
         self._sema = threading.BoundedSemaphore(maxsize)
+        # Maximum connectors to a server, 0 for no limit
+        self._hostsize = hostsize
         self._conndict = {}
+        # Number of times and total time threads were
+        # blocked waiting for a connector, by server
+        self._blocked = {}
+        self._lock = threading.Lock()
 
-    def create_connector(self):
-        """ Creates and returns a connector object """
+    def create_connector(self, urlobj=None):
+        """ Creates and returns a connector object for
+        fetching the URL object 'urlobj' """
 
         # Even if the number of connections is
         # below the maximum, the number of requests
@@ -2836,12 +2947,41 @@ class HarvestManUrlConnectorFactory(object):
         # the number of current active requests to
         # the server is equal to the maximum allowd
         # this call will also block the calling
-        # thread
-        self._sema.acquire()
+        # thread. The server is waited for first, so
+        # that a thread waiting for a slow server does
+        # not hold a connector other servers could use.
+        host = None
+        if urlobj is not None:
+            host = urlobj.get_domain_with_port()
+
+        t = time.time()
+        blocked = False
+
+        # The parts of a multipart download take a slot of
+        # the server like any other connector. The connector
+        # which splits the download is not made here and
+        # does not hold one.
+        hostsema = self.get_host_semaphore(host)
+        if hostsema is not None and not hostsema.acquire(False):
+            blocked = True
+            hostsema.acquire()
+            
+        if not self._sema.acquire(False):
+            blocked = True
+            self._sema.acquire()
 
+        if blocked:
+            self._lock.acquire()
+            try:
+                waits = self._blocked.setdefault(host, [0, 0.0])
+                waits[0] += 1
+                waits[1] += time.time() - t
+            finally:
+                self._lock.release()
+            
         # Make a connector 
         connector = self.__class__.klass()
-        self._conndict[connector] = 1
+        self._conndict[connector] = host
         self.__class__.connector_count += 1
         
         return connector
@@ -2853,9 +2993,29 @@ class HarvestManUrlConnectorFactory(object):
         self.__class__.connector_count -= 1
         # print 'Connector removed, count is',self._count
         conn.release()
-        del self._conndict[conn]       
+        host = self._conndict.pop(conn)
         self._sema.release()
 
+        hostsema = self._requests.get(host)
+        if hostsema is not None:
+            hostsema.release()
+
+    def get_host_semaphore(self, host):
+        """ Returns the semaphore limiting the connectors
+        to the server 'host', or None if there is no limit """
+
+        if not self._hostsize or host is None:
+            return None
+
+        self._lock.acquire()
+        try:
+            sema = self._requests.get(host)
+            if sema is None:
+                sema = self._requests[host] = threading.BoundedSemaphore(self._hostsize)
+            return sema
+        finally:
+            self._lock.release()
+            
     def get_count(self):
         """ Return the current connector count """
 
@@ -2863,6 +3023,18 @@ class HarvestManUrlConnectorFactory(object):
 
     def get_connector_dict(self):
         return self._conndict
+
+    def get_blocked_stats(self):
+        """ Return a dictionary of the number of times and total
+        time threads were blocked waiting for a connector, as a
+        tuple, by server. Waits for connectors not made for a
+        URL are under the key None """
+
+        self._lock.acquire()
+        try:
+            return dict([(host, tuple(waits)) for host, waits in self._blocked.items()])
+        finally:
+            self._lock.release()
     
 # test code
 if __name__=="__main__":
@@ -194,10 +194,18 @@ class HarvestManBaseUrlCrawler( threading.Thread ):
         # Local Buffer for Objects
         # to be put in q. Maximum size is 100
         self.buffer = Ldeque(100)
-        # Flag for pushing to buffer
-        self._pushflag = self._configobj.fastmode and (not self._configobj.blocking)
+        # Items got from the queue in the
+        # last batch, yet to be processed
+        self.pending = []
+        # Flag for pushing to buffer. Not needed if the
+        # queues spill to disk, since pushes never fail.
+        self._pushflag = self._configobj.fastmode and (not self._configobj.blocking) and \
+                         (not objects.queuemgr.spill)
         # Resume flag - for resuming from a saved state
         self.resuming = False
+        # Retire flag - set when this thread is to
+        # be replaced by one of the other role
+        self._retiring = False
         # Last exception
         self.exception = None
         # Sleep event
@@ -252,11 +260,28 @@ class HarvestManBaseUrlCrawler( threading.Thread ):
         #try:
         self.stateobj.set(self, THREAD_STARTED)
         self.action()
+        if self._retiring:
+            self.stateobj.set(self, THREAD_STOPPED)
         #except Exception, e:
         #    # print 'Exception',e,self
         #    self.exception = e
         #    self.stateobj.set(self, THREAD_DIED)                
 
+    def retire(self):
+        """ Ask this thread to exit once it has processed
+        the items it holds """
+
+        self._retiring = True
+        self.evnt.wake()
+        
+    def signal_stop(self):
+        """ Ask this thread to stop, waking it up if it
+        is sleeping, without waiting for it """
+
+        self._endflag = True
+        self.set_download_flag(False)
+        self.evnt.wake()
+        
     def stop(self):
         self.join()
         
@@ -272,7 +297,8 @@ class HarvestManBaseUrlCrawler( threading.Thread ):
     def sleep(self):
 
         self.stateobj.set(self, THREAD_SLEEPING)
-        self.evnt.sleep()
+        if not self._endflag:
+            self.evnt.sleep()
         
     def crawl_url(self):
         """ Crawl a web page, recursively downloading its links """
@@ -285,6 +311,35 @@ class HarvestManBaseUrlCrawler( threading.Thread ):
 
         pass
         
+    def get_url_data(self):
+        """ Return the next item to be processed, getting
+        a new batch of items from the queue if the last
+        batch is exhausted. Returns None if nothing could
+        be got """
+
+        if not self.pending:
+            if self._retiring:
+                # Hand over the buffered items, if any
+                # and exit.
+                if self.buffer:
+                    objects.queuemgr.push_many(list(self.buffer), self._role)
+                    self.buffer.clear()
+                self._endflag = True
+                return None
+            
+            # Waiting only if we have nothing in hand
+            if self._role == 'crawler':
+                self.stateobj.set(self, CRAWLER_WAITING)
+            else:
+                self.stateobj.set(self, FETCHER_WAITING)
+                
+            self.pending = objects.queuemgr.get_many(self._role,
+                                                     self._configobj.queuebatch)
+        if self.pending:
+            return self.pending.pop(0)
+
+        return None
+        
     def push_buffer(self):
         """ Try to push items in local buffer to queue """
 
@@ -342,8 +397,7 @@ class HarvestManUrlCrawler(HarvestManBaseUrlCrawler):
                     if self.buffer and self._pushflag:
                         self.push_buffer()
 
-                    self.stateobj.set(self, CRAWLER_WAITING)
-                    obj = objects.queuemgr.get_url_data( "crawler" )
+                    obj = self.get_url_data()
                     
                     if not obj:
                         if self._endflag: break
@@ -364,12 +418,14 @@ class HarvestManUrlCrawler(HarvestManBaseUrlCrawler):
                     # We needs to do violates check here also
                     if self.url.violates_rules():
                         extrainfo("Filtered URL",self.url)
+                        objects.queuemgr.mark_crawled(self.url)
                         continue
 
                 # Do a crawl to generate new objects
                 # only after trying to push buffer
                 # objects.
                 self.crawl_url()
+                objects.queuemgr.mark_crawled(self.url)
                 self._loops += 1
                 # Sleep for some time
                 self.sleep()
@@ -387,8 +443,12 @@ class HarvestManUrlCrawler(HarvestManBaseUrlCrawler):
 
         cfg = objects.config
         
-        # Set initial priority to previous url's generation
-        url_obj.priority = self.url.generation
+        if cfg.linkrank:
+            # Set initial priority from the link rank
+            url_obj.priority = objects.linkrank.priority(url_obj)
+        else:
+            # Set initial priority to previous url's generation
+            url_obj.priority = self.url.generation
 
         # Get priority
         curr_priority = url_obj.priority
@@ -441,6 +501,7 @@ class HarvestManUrlCrawler(HarvestManBaseUrlCrawler):
         info('Fetching links', self.url)
         
         priority_indx = 0
+        urlobjs = []
 
         # print self.links
         
@@ -468,9 +529,13 @@ class HarvestManUrlCrawler(HarvestManBaseUrlCrawler):
 
             priority_indx += 1
             self.apply_url_priority( url_obj )
+            urlobjs.append(url_obj)
 
-            if not objects.queuemgr.push( url_obj, "crawler" ):
-                if self._pushflag: self.buffer.append(url_obj)
+        # Push all the links in one go
+        count = objects.queuemgr.push_many(urlobjs, "crawler")
+        if self._pushflag:
+            for url_obj in urlobjs[count:]:
+                self.buffer.append(url_obj)
 
         objects.eventmgr.raise_event('aftercrawl', self.url, self.document)
         
@@ -511,7 +576,16 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
         """ Return the time stamp before fetching """
 
         return self._fetchtime
-    
+
+    def sleep(self):
+
+        if self._configobj.hostqueues:
+            # Fetches are already paced per host
+            # by the url queue, so don't sleep.
+            self.stateobj.set(self, THREAD_SLEEPING)
+        else:
+            HarvestManBaseUrlCrawler.sleep(self)
+
     def set_url_object(self, obj):
 
         if not obj: return False
@@ -538,8 +612,7 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
                         debug('Trying to push buffer...')
                         self.push_buffer()
 
-                    self.stateobj.set(self, FETCHER_WAITING)                    
-                    obj = objects.queuemgr.get_url_data("fetcher" )
+                    obj = self.get_url_data()
                     
                     if not obj:
                         if self._endflag: break
@@ -559,6 +632,10 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
                 # only after trying to push buffer
                 # objects.
                 self.process_url()
+                # URLs downloaded by the url thread pool
+                # are marked when the download is over
+                if not objects.datamgr.use_url_threads(self.url):
+                    objects.queuemgr.mark_fetched(self.url)
 
                 # Raise "afterfetch" event
                 objects.eventmgr.raise_event('afterfetch', self.url)
@@ -803,7 +880,10 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
             # Create collection object
             coll = HarvestManAutoUrlCollection(url_obj)
 
-            children = []
+            linkcache = objects.datamgr.linkcache
+            basekey = linkcache.base_key(url_obj)
+            
+            children, known, newlinks = [], [], []
             for typ, url in links:
                 
                 is_cgi, is_php = False, False
@@ -815,25 +895,39 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
 
                 if not url or len(url)==0: continue
                 # print 'URL=>',url,url_obj.get_full_url()
-                
-                try:
-                    child_urlobj = urlparser.HarvestManUrl(url,
-                                                           typ,
-                                                           is_cgi,
-                                                           url_obj)
 
-                    # print url, child_urlobj.get_full_url()
-                    
-                    if objects.datamgr.check_exists(child_urlobj):
+                # Links seen before are known without
+                # resolving them
+                cached = linkcache.get(basekey, url, typ)
+                if cached:
+                    known.append(cached[1])
+                    continue
+
+                newlinks.append((typ, url, is_cgi))
+
+            # Url objects are created only for
+            # the new URLs
+            for record in urlparser.resolve_links(url_obj, newlinks):
+                if record.error:
+                    error('URL Error:', record.error)
+                    continue
+
+                other, record.index = objects.datamgr.find_url(record.index, record.canonical)
+                if other:
+                    known.append(record.index)
+                else:
+                    try:
+                        child_urlobj = record.get_url_object()
+                    except urlparser.HarvestManUrlError, e:
+                        error('URL Error:', e)
                         continue
-                    else:
-                        objects.datamgr.add_url(child_urlobj)
-                        coll.addURL(child_urlobj)
-                        children.append(child_urlobj)
                     
-                except urlparser.HarvestManUrlError, e:
-                    error('URL Error:', e)
-                    continue
+                    # print url, child_urlobj.get_full_url()
+                    objects.datamgr.add_url(child_urlobj)
+                    coll.addURL(child_urlobj)
+                    children.append(child_urlobj)
+
+                linkcache.put(basekey, record.link, record.typ, record)
 
             # objects.queuemgr.endloop(True)
             
@@ -841,12 +935,13 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
             for child in children:
                 document.add_child(child)
                     
+            # Update links called here, before the push
+            # so that the links are in place for crawling
+            objects.datamgr.update_links(url_obj, coll, known)
+            
             if not objects.queuemgr.push((url_obj.priority, coll, document), 'fetcher'):
                 if self._pushflag: self.buffer.append((url_obj.priority, coll, document))
 
-            # Update links called here
-            objects.datamgr.update_links(url_obj, coll)
-
             
             return data
         
@@ -876,11 +971,15 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
             if not self._configobj.images:
                 links = [link for link in links if link[link.rfind('.'):].lower() not in netinfo.image_extns]
                 
-            children = []
+            children, known = [], []
              
             # Create collection object
             coll = HarvestManAutoUrlCollection(self.url)
+
+            linkcache = objects.datamgr.linkcache
+            basekey = linkcache.base_key(self.url)
             
+            newlinks = []
             # Add these links to the queue
             for url in links:
                 if not url: continue
@@ -893,34 +992,43 @@ class HarvestManUrlFetcher(HarvestManBaseUrlCrawler):
                     urltyp = URL_TYPE_STYLESHEET
                 else:
                     urltyp = URL_TYPE_ANY
-                    
-                try:
-                    child_urlobj =  urlparser.HarvestManUrl(url,
-                                                            urltyp,
-                                                            False,
-                                                            self.url)
 
+                cached = linkcache.get(basekey, url, urltyp)
+                if cached:
+                    known.append(cached[1])
+                    continue
+
+                newlinks.append((urltyp, url, False))
+                
+            for record in urlparser.resolve_links(self.url, newlinks):
+                if record.error: continue
 
-                    if objects.datamgr.check_exists(child_urlobj):
+                other, record.index = objects.datamgr.find_url(record.index, record.canonical)
+                if other:
+                    known.append(record.index)
+                else:
+                    try:
+                        child_urlobj = record.get_url_object()
+                    except urlparser.HarvestManUrlError:
                         continue
-                    else:
-                        objects.datamgr.add_url(child_urlobj)
-                        coll.addURL(child_urlobj)                    
-                        children.append(child_urlobj)
-                        
-                except urlparser.HarvestManUrlError:
-                    continue
+                    
+                    objects.datamgr.add_url(child_urlobj)
+                    coll.addURL(child_urlobj)                    
+                    children.append(child_urlobj)
+
+                linkcache.put(basekey, record.link, record.typ, record)
 
             # Update the document...
             for child in children:
                 document.add_child(child)
             
+            # Update links called here, before the push
+            # so that the links are in place for crawling
+            objects.datamgr.update_links(self.url, coll, known)
+            
             if not objects.queuemgr.push((self.url.priority, coll, document), 'fetcher'):
                 if self._pushflag: self.buffer.append((self.url.priority, coll, document))
 
-            # Update links called here
-            objects.datamgr.update_links(self.url, coll)
-
             # Successful return returns data
             return data
         else:
@@ -56,18 +56,23 @@ import threading
 # Utils
 from harvestman.lib import utils
 from harvestman.lib import urlparser
+from harvestman.lib import urldb
+from harvestman.lib import linkgraph
+from harvestman.lib import localiser
+from harvestman.lib.blobstore import HarvestManBlobStore, unshare_file
+from harvestman.lib.bandwidth import HarvestManBandwidthLimiter
 
 from harvestman.lib.mirrors import HarvestManMirrorManager
 from harvestman.lib.db import HarvestManDbManager
 
 from harvestman.lib.urlthread import HarvestManUrlThreadPool
+from harvestman.lib.checkpoint import journal
 from harvestman.lib.connector import *
 from harvestman.lib.methodwrapper import MethodWrapperMetaClass
 
 from harvestman.lib.common.common import *
 from harvestman.lib.common.macros import *
-from harvestman.lib.common.bst import BST
-from harvestman.lib.common.pydblite import Base
+from harvestman.lib.common.hashdb import HashDB
 
 
 # Defining pluggable functions
@@ -87,6 +92,10 @@ class HarvestManDataManager(object):
     __metaclass__ = MethodWrapperMetaClass
     alias = 'datamgr'        
 
+    # Counters saved with the crawl state
+    counters = ('_numfailed', '_numfailed2', '_numretried', 'savedfiles',
+                'reposfiles', 'cachefiles', 'filteredfiles', 'bytes', 'savedbytes')
+
     def __init__(self):
         self.reset()
 
@@ -98,13 +107,20 @@ class HarvestManDataManager(object):
         # URLs which were retried
         self._numretried = 0
         self.cache = None
+        # Store of downloaded files by content
+        self.blobs = None
+        # Limiter of the bandwidth of the connectors
+        self.limiter = None
         self.savedfiles = 0
         self.reposfiles = 0
         self.cachefiles = 0
         self.filteredfiles = 0
+        # Number of URLs moved to another
+        # index by URL verification
+        self.collisions = AtomicCounter()
         # Config object
         self._cfg = objects.config
-        # Dictionary of servers crawled and
+        # Dictionary of servers crawled, by host id, and
         # their meta-data. Meta-data is
         # a dictionary which currently
         # has only one entry.
@@ -122,6 +138,10 @@ class HarvestManDataManager(object):
         self.cond = threading.Condition(threading.Lock())        
         self._urldb = None
         self.collections = None
+        # Cache of resolved links
+        self.linkcache = None
+        # Graph of the links between URLs
+        self.linkgraph = None
 
     def initialize(self):
         """ Do initializations per project """
@@ -133,21 +153,93 @@ class HarvestManDataManager(object):
         else:
             self._urlThreadPool = None
 
-        # URL database, a BST with disk-caching
-        self._urldb = BST()
-        # Collections database, a BST with disk-caching        
-        self.collections = BST()
-        # For testing, don't set this otherwise we might
-        # be left with many orphaned .bidx... folders!
-        if not self._cfg.testing:
-            self._urldb.set_auto(2)
-            self.collections.set_auto(2)
+        self.make_databases()
 
+        cachedir = self.get_proj_cache_directory()
+        if self._cfg.blobstore and cachedir:
+            self.blobs = HarvestManBlobStore(os.path.join(cachedir, 'blobs'), self._cfg.bloblinks)
+
+        if self._cfg.bandwidthlimit or self._cfg.hostbandwidthlimit:
+            self.limiter = HarvestManBandwidthLimiter(self._cfg.bandwidthlimit,
+                                                      self._cfg.hostbandwidthlimit)
+        
         # Load any mirrors
         self.mirrormgr.load_mirrors(self._cfg.mirrorfile)
         # Set mirror search flag
         self.mirrormgr.mirrorsearch = self._cfg.mirrorsearch
 
+    def make_databases(self):
+        """ Create empty URL and collections databases """
+        
+        # Remove the files of the earlier databases
+        for db in (self._urldb, self.collections):
+            if db is not None:
+                db.close()
+                
+        # For testing, everything is kept in memory
+        memsize = 0
+        if not self._cfg.testing:
+            memsize = self._cfg.urldbsize
+        
+        if self._cfg.urldbbackend == 'sqlite':
+            try:
+                # URL and collections databases in one sqlite
+                # database in the project cache directory
+                db = urldb.HarvestManSqliteDB.create(self.get_urldb_filename(),
+                                                     self._cfg.urldbbatch,
+                                                     self._cfg.urldbinterval)
+                self._urldb = urldb.HarvestManSqliteUrlDB(db, memsize)
+                self.collections = urldb.HarvestManSqliteLinkDB(db, memsize)
+            except (urldb.HarvestManUrlDBError, EnvironmentError), e:
+                warning('Cannot use sqlite URL database, error:', e)
+                self._cfg.urldbbackend = 'hash'
+                
+        if self._cfg.urldbbackend != 'sqlite':
+            # URL database, a hash table of URL objects by
+            # index which spills to disk
+            self._urldb = HashDB(memsize, prefix='urls')
+            # Collections database, by index of the source URL
+            self.collections = HashDB(memsize, prefix='links')
+        # Links of the pages in the collections
+        # database, as integer arrays
+        self.linkgraph = linkgraph.HarvestManLinkGraph()
+        # Links seen so far, for the URLs in the
+        # databases
+        self.linkcache = urlparser.HarvestManLinkCache(self._cfg.linkcachesize)
+
+    def get_counters(self):
+        """ Return a dictionary of the download counters """
+
+        return dict([(name, getattr(self, name)) for name in self.counters])
+    
+    def get_state(self):
+        """ Return the state of this object as a dictionary """
+
+        urls = dict(self._urldb.iteritems())
+        links = dict(self.collections.iteritems())
+            
+        return {'urls': urls, 'links': links, 'counters': self.get_counters()}
+
+    def set_state(self, state):
+        """ Set the state of this object from a dictionary
+        returned by get_state """
+
+        self.make_databases()
+        
+        urls = state['urls']
+        # Starting URL first
+        if 0 in urls:
+            self._urldb.insert(0, urls[0])
+        for index, urlobj in urls.iteritems():
+            if index != 0:
+                self._urldb.insert(index, urlobj)
+        for index, collection in state['links'].iteritems():
+            self.collections.insert(index, collection)
+            self.linkgraph.add_links(index, collection.getAllURLs())
+
+        for name, value in state['counters'].items():
+            setattr(self, name, value)
+            
     def get_urldb(self):
         return self._urldb
     
@@ -156,18 +248,30 @@ class HarvestManDataManager(object):
 
         # print 'Adding %s with index %d' % (urlobj.get_full_url(), urlobj.index)
         self._urldb.insert(urlobj.index, urlobj)
+        journal('url', urlobj)
         
     def update_url(self, urlobj):
         """ Update urlobject urlobj in the local dictionary """
 
         # print 'Adding %s with index %d' % (urlobj.get_full_url(), urlobj.index)
         self._urldb.update(urlobj.index, urlobj)
+        journal('url', urlobj)
         
     def get_url(self, index):
 
         # return self._urldict[str(index)]
         return self._urldb.lookup(index)
 
+    def get_broken_urls(self):
+        """ Return the URL objects of broken links (404) """
+
+        # The sqlite database is queried, the
+        # other one is scanned.
+        if isinstance(self._urldb, urldb.HarvestManSqliteUrlDB):
+            return self._urldb.get_broken_urls()
+        
+        return [urlobj for urlobj in self._urldb.itervalues() if urlobj.status == 404]
+
     def get_original_url(self, urlobj):
 
         # Return the original URL object for
@@ -184,19 +288,18 @@ class HarvestManDataManager(object):
             # an <if None> check on the caller
             return urlobj
         
-    def get_proj_cache_filename(self):
-        """ Return the cache filename for the current project """
-
-        # Note that this function does not actually build the cache directory.
-        # Get the cache file path
-        if self._cfg.projdir and self._cfg.project:
-            cachedir = os.path.join(self._cfg.projdir, "hm-cache")
-            cachefilename = os.path.join(cachedir, 'cache')
-
-            return cachefilename
-        else:
-            return ''
+    def get_urldb_filename(self):
+        """ Return the file name of the sqlite URL database
+        for the current project, creating its directory """
 
+        cachedir = self.get_proj_cache_directory()
+        if not cachedir or self._cfg.testing:
+            return ':memory:'
+        
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        return os.path.join(cachedir, 'urls.db')
+    
     def get_proj_cache_directory(self):
         """ Return the cache directory for the current project """
 
@@ -215,9 +318,8 @@ class HarvestManDataManager(object):
         supports range requests """
 
         # Look up its server in the dictionary
-        server = urlobj.get_full_domain()
-        if server in self._serversdict:
-            d = self._serversdict[server]
+        if urlobj.hostid in self._serversdict:
+            d = self._serversdict[urlobj.hostid]
             return d.get('accept-ranges', False)
 
         return False
@@ -231,46 +333,44 @@ class HarvestManDataManager(object):
         obj, found = cachereader.read_project_cache()
         self._cfg.cachefound = found
         self.cache = obj
-        if not found:
-            # Fresh cache - create structure...
-            self.cache.create('url','last_modified','etag', 'updated','location','checksum',
-                              'content_length','data','headers')
-            
-            # Create an index on URL
-            self.cache.create_index('url')
-        else:
-            pass
+        if obj is None:
+            # No cache could be opened at all
+            self._cfg.pagecache = 0
 
     def write_file_from_cache(self, urlobj):
         """ Write file from url cache. This
-        works only if the cache dictionary of this
-        url has a key named 'data' """
+        works only if data was cached for
+        the url """
 
         ret = False
 
         # print 'Inside write_file_from_cache...'
         url = urlobj.get_full_url()
-        content = self.cache._url[url]
+        item = self.cache.lookup(url)
         
-        if len(content):
-            # Value itself is a dictionary
-            item = content[0]
-            if not item.has_key('data'):
-                return ret
-            else:
-                urldata = item['data']
-                if urldata:
-                    fileloc = item['location']                    
-                    # Write file
-                    extrainfo("Updating file from cache=>", fileloc)
-                    try:
-                        if SUCCESS(self.create_local_directory(os.path.dirname(fileloc))):
+        if item:
+            urldata = self.cache.get_data(url)
+            if urldata:
+                fileloc = item['location']                    
+                # Write file
+                extrainfo("Updating file from cache=>", fileloc)
+                try:
+                    if SUCCESS(self.create_local_directory(os.path.dirname(fileloc))):
+                        data = zlib.decompress(urldata)
+                        if self.blobs:
+                            # Linked to the blob of the data, the
+                            # blob the file shared is left alone
+                            self.blobs.store(fileloc, data)
+                        else:
+                            # The file may still be a link to a blob
+                            # of an earlier crawl, shared with others
+                            unshare_file(fileloc)
                             f=open(fileloc, 'wb')
-                            f.write(zlib.decompress(urldata))
+                            f.write(data)
                             f.close()
-                            ret = True
-                    except (IOError, zlib.error), e:
-                        error("Error:",e)
+                        ret = True
+                except (IOError, OSError, zlib.error), e:
+                    error("Error:",e)
                                 
         return ret
 
@@ -287,24 +387,17 @@ class HarvestManDataManager(object):
             csum = sha.new(urldata).hexdigest()
         else:
             csum = ''
-            
-        # Update all cache keys
-        content = self.cache._url[url]
-        if content:
-            rec = content[0]
-            self.cache.update(rec, checksum=csum, location=filename,content_length=contentlen, 
-                              last_modified=lastmodified,etag=tag, updated=True)
-            if self._cfg.datacache:
-                self.cache.update(rec,data=zlib.compress(urldata))
+
+        if self._cfg.datacache and urldata:
+            data = zlib.compress(urldata)
         else:
-            # Insert as new values
-            if self._cfg.datacache:
-                self.cache.insert(url=url, checksum=csum, location=filename,content_length=contentlen,last_modified=lastmodified,
-                                  etag=tag, updated=True,data=zlib.compress(urldata))
-            else:
-                self.cache.insert(url=url, checksum=csum, location=filename,content_length=contentlen, last_modified=lastmodified,
-                                  etag=tag, updated=True)                
-        
+            data = ''
+            
+        # Written as a new record, which replaces
+        # any earlier one for the URL
+        self.cache.insert(url, data, checksum=csum, location=filename, content_length=contentlen,
+                          last_modified=lastmodified, etag=tag,
+                          headers=urlobj.get_url_content_info())
 
     def get_url_cache_data(self, urlobj):
         """ Get cached data for the URL from disk """
@@ -318,19 +411,14 @@ class HarvestManDataManager(object):
         if (not self._cfg.pagecache) or (not self._cfg.datacache):
             return ''
 
-        url = urlobj.get_full_url()
-
-        content = self.cache._url[url]
-        if content:
-            item = content[0]
-            # Check if we have the data for the URL
-            data = item.get('data','')
-            if data:
-                try:
-                    return zlib.decompress(data)
-                except zlib.error, e:
-                    error('Error:',e)
-                    return ''
+        # Check if we have the data for the URL
+        data = self.cache.get_data(urlobj.get_full_url())
+        if data:
+            try:
+                return zlib.decompress(data)
+            except zlib.error, e:
+                error('Error:',e)
+                return ''
 
         return ''
 
@@ -346,11 +434,9 @@ class HarvestManDataManager(object):
         if (not self._cfg.pagecache):
             return ''
 
-        url = urlobj.get_full_url()
-
-        content = self.cache._url[url]
-        if content:
-            return content[0].get('last_modified', '')
+        item = self.cache.lookup(urlobj.get_full_url())
+        if item:
+            return item.get('last_modified', '')
         else:
             return ''
 
@@ -362,11 +448,9 @@ class HarvestManDataManager(object):
         if (not self._cfg.pagecache):
             return ''
 
-        url = urlobj.get_full_url()
-
-        content = self.cache._url[url]
-        if content:
-            return content[0].get('etag', '')
+        item = self.cache.lookup(urlobj.get_full_url())
+        if item:
+            return item.get('etag', '')
         else:
             return ''        
 
@@ -391,12 +475,9 @@ class HarvestManDataManager(object):
         uptodate, fileverified = False, False
 
         url = urlobj.get_full_url()
-        content = self.cache._url[url]
-
-        if content:
-            cachekey = content[0]
-            cachekey['updated']=False
+        cachekey = self.cache.lookup(url)
 
+        if cachekey:
             fileloc = cachekey['location']
             if os.path.exists(fileloc) and os.path.abspath(fileloc) == os.path.abspath(filename):
                 fileverified=True
@@ -433,44 +514,32 @@ class HarvestManDataManager(object):
 
         return (uptodate, fileverified)
 
-    def conditional_cache_set(self):
-        """ A utility function to conditionally enable/disable
-        the cache mechanism """
-
-        # If already page cache is disabled, do not do anything
-        if not self._cfg.pagecache:
-            return
-        
-        # If the cache file exists for this project, disable
-        # cache, else enable it.
-        cachefilename = self.get_proj_cache_filename()
-
-        if os.path.exists(cachefilename) and os.path.getsize(cachefilename):
-            self._cfg.writecache = False
-        else:
-            self._cfg.writecache = True
-
     def post_download_setup(self):
         """ Actions to perform after project is complete """
 
-        # Loop through URL db, one by one and then for those
-        # URLs which were downloaded but did not succeed, try again.
-        # But make sure we don't download links which were not-modified
-        # on server-side (HTTP 304) and hence were skipped.
+        # Find the URLs which were downloaded but did not succeed,
+        # to try again. But make sure we don't download links which
+        # were not-modified on server-side (HTTP 304) and hence were
+        # skipped.
         failed = []
         # Broken links (404)
         nbroken = 0
-        
-        for node in self._urldb.preorder():
-            urlobj = node.get()
-            # print 'URL=>',urlobj.get_full_url()
-            
-            if urlobj.status == 404:
-                # print 'BROKEN', urlobj.get_full_url()
-                nbroken += 1
-            elif urlobj.qstatus == urlparser.URL_DONE_DOWNLOAD and \
-                   urlobj.status != 0 and urlobj.status != 304:
-                failed.append(urlobj)
+
+        if isinstance(self._urldb, urldb.HarvestManSqliteUrlDB):
+            # Query the database
+            failed = self._urldb.get_failed_urls()
+            nbroken = self._urldb.count_status(404)
+        else:
+            # Loop through URL db, one by one
+            for urlobj in self._urldb.itervalues():
+                # print 'URL=>',urlobj.get_full_url()
+
+                if urlobj.status == 404:
+                    # print 'BROKEN', urlobj.get_full_url()
+                    nbroken += 1
+                elif urlobj.qstatus == urlparser.URL_DONE_DOWNLOAD and \
+                       urlobj.status != 0 and urlobj.status != 304:
+                    failed.append(urlobj)
                     
         self._numfailed = len(failed)
         # print 'BROKEN=>', nbroken
@@ -512,10 +581,10 @@ class HarvestManDataManager(object):
 
         self._cfg.endtime = t2
 
-        # Write cache file
-        if self._cfg.pagecache and self._cfg.writecache:
+        # Write the index of the cache file, its
+        # records were written during the crawl.
+        if self._cfg.pagecache and self.cache is not None:
             cachewriter = utils.HarvestManCacheReaderWriter(self.get_proj_cache_directory())
-            self.add_headers_to_cache()
             cachewriter.write_project_cache(self.cache)
 
         # If url header dump is enabled, dump it
@@ -524,6 +593,10 @@ class HarvestManDataManager(object):
 
         if self._cfg.localise:
             self.localise_links()
+            # Pages whose links were localised have
+            # copies of their own now
+            if self.blobs:
+                self.blobs.prune()
 
         # Write archive file...
         if self._cfg.archive:
@@ -546,6 +619,14 @@ class HarvestManDataManager(object):
         numfilesincache = self.cachefiles
 
         numretried = self._numretried
+        nspilled, nrefilled = objects.queuemgr.get_spill_stats()
+        rolestats = objects.queuemgr.stateobj.get_role_stats()
+        balancer = objects.queuemgr.balancer
+        linkhits, linkmisses = self.linkcache.get_stats()
+        blobstats = (self.blobs and self.blobs.get_stats()) or {}
+        poolstats = (objects.connmgr and objects.connmgr.get_pool_stats()) or {}
+        blockedstats = (objects.connfactory and objects.connfactory.get_blocked_stats()) or {}
+        bwstats = (self.limiter and self.limiter.get_stats()) or {}
         
         fetchtime = self._cfg.endtime-self._cfg.starttime
         
@@ -563,6 +644,24 @@ class HarvestManDataManager(object):
                    'retries' : numretried,
                    'bytes': self.bytes,
                    'fetchtime' : fetchtime,
+                   'spilled' : nspilled,
+                   'refilled' : nrefilled,
+                   'roles' : rolestats,
+                   'conversions' : (balancer and balancer.conversions) or 0,
+                   'linkhits' : linkhits,
+                   'linkmisses' : linkmisses,
+                   'blobs' : blobstats.get('blobs', 0),
+                   'dupfiles' : blobstats.get('dupfiles', 0),
+                   'dupbytes' : blobstats.get('dupbytes', 0),
+                   'poolhits' : poolstats.get('hits', 0),
+                   'poolmisses' : poolstats.get('misses', 0),
+                   'poolevictions' : poolstats.get('evictions', 0),
+                   'poolstale' : poolstats.get('stale', 0),
+                   'blocked' : blockedstats,
+                   'bwlimit' : bwstats.get('rate', 0),
+                   'bwachieved' : bwstats.get('achieved', 0),
+                   'hostbwlimit' : bwstats.get('hostrate', 0),
+                   'hostbwachieved' : bwstats.get('hosts', {}),
                 }
 
         self.print_project_info(statsd)
@@ -572,7 +671,37 @@ class HarvestManDataManager(object):
     def check_exists(self, urlobj):
 
         # Check if this URL object exits (is a duplicate)
-        return self._urldb.lookup(urlobj.index)
+        if not self._cfg.urlverify:
+            return self._urldb.lookup(urlobj.index)
+
+        other, urlobj.index = self.find_url(urlobj.index, urlobj.get_canonical_url())
+        return other
+
+    def find_url(self, index, canonical):
+        """ Find the URL with the canonical URL string 'canonical'
+        and the given index. Returns a tuple of the URL object,
+        or None if not found, and the index of the URL """
+
+        if not self._cfg.urlverify:
+            return (self._urldb.lookup(index), index)
+        
+        # Compare the URL strings and if a different URL has
+        # the same index, move this URL to the next free
+        # index of its probe sequence. The sequence is the
+        # same every time for a URL, so it is found again.
+        probe = 0
+        while True:
+            other = self._urldb.lookup(index)
+            if other is None:
+                if probe:
+                    # A new URL, which goes to a probed index
+                    self.collisions.add()
+                return (other, index)
+            elif other.get_canonical_url() == canonical:
+                return (other, index)
+
+            probe += 1
+            index = urlparser.url_fingerprint('%s#%d' % (canonical, probe))
         
     def update_bytes(self, count):
         """ Update the global byte count """
@@ -602,11 +731,31 @@ class HarvestManDataManager(object):
         
         return HARVESTMAN_OK
     
-    def update_links(self, source, collection):
-        """ Update the links dictionary for this collection """
+    def update_links(self, source, collection, known=()):
+        """ Update the links dictionary for this collection.
+        'known' is a list of indices of the URLs linked from
+        the source which were seen before and so are not in
+        the collection """
         
         self.collections.insert(source.index, collection)
+        self.linkgraph.add_links(source.index, collection.getAllURLs())
+        journal('links', source.index, collection)
+
+        if self._cfg.linkrank and objects.linkrank:
+            objects.linkrank.add_links(source.index, collection.getAllURLs() + list(known))
+
+    def get_links(self, index):
+        """ Return the collection of links of the URL
+        with the given index """
 
+        return self.collections.lookup(index)
+
+    def use_url_threads(self, url):
+        """ Return True if the given URL is downloaded
+        by the url thread pool """
+
+        return self._cfg.usethreads and not url.parseable()
+        
     def thread_download(self, url):
         """ Schedule download of this web document in a separate thread """
 
@@ -713,9 +862,9 @@ class HarvestManDataManager(object):
                 domain_changed_a_lot = True
 
         try:
-            self._serversdict[domain]
+            self._serversdict[urlobj.hostid]
         except KeyError:
-            self._serversdict[domain] = {'accept-ranges': True}
+            self._serversdict[urlobj.hostid] = {'accept-ranges': True}
 
         if self.mirrormgr.mirrors_available(urlobj):
             return self.mirrormgr.download_multipart_url(urlobj, clength, self._cfg.numparts, self._urlThreadPool)
@@ -726,6 +875,10 @@ class HarvestManDataManager(object):
                 urlobj.redirected_old = True
                 
         parts = self._cfg.numparts
+        # Every part takes a slot of the server, so more
+        # parts than slots would only wait for each other
+        if self._cfg.hostconnections:
+            parts = min(parts, self._cfg.hostconnections)
         # Calculate size of each piece
         piecesz = clength/parts
         
@@ -757,14 +910,13 @@ class HarvestManDataManager(object):
 
     def download_url(self, caller, url):
 
-        no_threads = (not self._cfg.usethreads) or \
-                     url.parseable()
+        no_threads = not self.use_url_threads(url)
 
         data=""
         if no_threads:
             # This call will block if we exceed the number of connections
             url.qstatus = urlparser.URL_QUEUED            
-            conn = objects.connfactory.create_connector()
+            conn = objects.connfactory.create_connector(url)
 
             # Set status to queued
             url.qstatus = urlparser.URL_IN_QUEUE            
@@ -805,10 +957,14 @@ class HarvestManDataManager(object):
         lists, dictionaries and resetting other member items"""
 
         # Reset byte count
-        if self._urldb and self._urldb.size:
-            del self._urldb
-        if self.collections and self.collections.size:
-            del self.collections
+        if self.cache is not None:
+            self.cache.close()
+        if self._urldb is not None:
+            self._urldb.close()
+        if self.collections is not None:
+            self.collections.close()
+        if objects.connmgr is not None:
+            objects.connmgr.close_connections()
         self.reset()
 
     def archive_project(self):
@@ -859,30 +1015,6 @@ class HarvestManDataManager(object):
             error("Error in writing archive file",ptarf)
             return FILE_WRITE_ERROR
             
-    def add_headers_to_cache(self):
-        """ Add original URL headers of urls downloaded
-        as an entry to the cache file """
-        
-        # Navigate in pre-order, i.e in the order of insertion...
-        for node in self.collections.preorder():
-            coll = node.get()
-
-            # Get list of links for this collection
-            for urlobjidx in coll.getAllURLs():
-                urlobj = self.get_url(urlobjidx)
-                if urlobj==None: continue
-                
-                url = urlobj.get_full_url()
-                # Get headers
-                headers = urlobj.get_url_content_info()
-                
-                if headers:
-                    content = self.cache._url[url]
-                    if content:
-                        urldict = content[0]
-                        urldict['headers'] = headers
-
-
     def dump_headers(self):
         """ Dump the headers of the web pages
         downloaded, into a DBM file """
@@ -891,12 +1023,13 @@ class HarvestManDataManager(object):
         extrainfo("Writing url headers database")        
         
         headersdict = {}
-        for node in self.collections.preorder():
-            coll = node.get()
-            
-            for urlobjidx in coll.getAllURLs():
+        if isinstance(self._urldb, urldb.HarvestManSqliteUrlDB):
+            for url, headers in self._urldb.get_url_headers().iteritems():
+                headersdict[url] = str(headers)
+        else:
+            for urlobjidx in self.linkgraph.iterlinked():
                 urlobj = self.get_url(urlobjidx)
-                
+
                 if urlobj:
                     url = urlobj.get_full_url()
                     # Get headers
@@ -916,149 +1049,65 @@ class HarvestManDataManager(object):
 
         info('Localising links of downloaded web pages...',)
 
-        count = 0
-        localized = []
-        
-        for node in self.collections.preorder():
-            coll = node.get()
-            
-            sourceurl = self.get_url(coll.getSourceURL())
-            childurls = [self.get_url(index) for index in coll.getAllURLs()]
-            filename = sourceurl.get_full_filename()
-
+        # Each saved page, once
+        tasks, localized = [], set()
+        for urlobj in self._urldb.itervalues():
+            if not urlobj.is_webpage(): continue
+            filename = urlobj.get_full_filename()
             if (not filename in localized) and os.path.exists(filename):
-                extrainfo('Localizing links for',filename)
-                if SUCCESS(self.localise_file_links(filename, childurls)):
-                    count += 1
-                    localized.append(filename)
+                localized.add(filename)
+                tasks.append((filename, urlobj.get_full_url(), bool(self.blobs)))
+
+        count = 0
+        for filename, nlinks, err in localiser.localise_files(tasks, self.get_link_map(),
+                                                              self._cfg.localise,
+                                                              self._cfg.localiseworkers):
+            if err:
+                error('Error localising links of', filename, ':', err)
+            else:
+                extrainfo('Localized', nlinks, 'links for', filename)
+                count += 1
 
         info('Localised links of',count,'web pages.')
 
-    def localise_file_links(self, filename, links):
-        """ Localise links for this file """
+    def get_link_map(self, links=None):
+        """ Return a dictionary mapping the keys of the URLs
+        in 'links', or of all URLs of the project, to the
+        files they were saved to or to '' """
 
-        data=''
-        
-        try:
-            fw=open(filename, 'r+')
-            data=fw.read()
-            fw.seek(0)
-            fw.truncate(0)
-        except (OSError, IOError),e:
-            return FILE_TRUNCATE_ERROR
-
-        # Regex1 to replace ( at the end
-        r1 = re.compile(r'\)+$')
-        r2 = re.compile(r'\(+$')        
-        
-        # MOD: Replace any <base href="..."> line
-        basehrefre = re.compile(r'<base href=.*>', re.IGNORECASE)
-        if basehrefre.search(data):
-            data = re.sub(basehrefre, '', data)
-        
-        for u in links:
-            if not u: continue
+        if links is None:
+            links = self._urldb.itervalues()
             
-            url_object = u
-            typ = url_object.get_type()
-
-            if url_object.is_image():
-                http_str="src"
-            else:
-                http_str="href"
-
-            v = url_object.get_original_url()
-            if v == '/': continue
-
-            # Somehow, some urls seem to have an
-            # unbalanced parantheses at the end.
-            # Remove it. Otherwise it will crash
-            # the regular expressions below.
-            v = r1.sub('', v)
-            v2 = r2.sub('', v)
+        linkmap = {}
+        for url_object in links:
+            if not url_object: continue
             
             # Bug fix, dont localize cgi links
-            if typ != 'base':
-                if url_object.is_cgi(): 
-                    continue
-                
-                fullfilename = os.path.abspath( url_object.get_full_filename() )
-                urlfilename=''
-
-                # Modification: localisation w.r.t relative pathnames
-                if self._cfg.localise==2:
-                    urlfilename = url_object.get_relative_filename()
-                elif self._cfg.localise==1:
-                    urlfilename = fullfilename
-
-                # replace '\\' with '/'
-                urlfilename = urlfilename.replace('\\','/')
+            if url_object.get_type() == 'base' or url_object.is_cgi():
+                continue
 
-                newurl=''
-                oldurl=''
+            key = localiser.link_key(url_object.get_full_url())
+            fullfilename = os.path.abspath( url_object.get_full_filename() )
             
-                # If we cannot get the filenames, replace
-                # relative url paths will full url paths so that
-                # the user can connect to them.
-                if not os.path.exists(fullfilename):
-                    # for relative links, replace it with the
-                    # full url path
-                    fullurlpath = url_object.get_full_url_sans_port()
-                    newurl = "href=\"" + fullurlpath + "\""
-                else:
-                    # replace url with urlfilename
-                    if typ == 'anchor':
-                        anchor_part = url_object.get_anchor()
-                        urlfilename = "".join((urlfilename, anchor_part))
-                        # v = "".join((v, anchor_part))
-
-                    if self._cfg.localise == 1:
-                        newurl= "".join((http_str, "=\"", "file://", urlfilename, "\""))
-                    else:
-                        newurl= "".join((http_str, "=\"", urlfilename, "\""))
+            # If we cannot get the filenames, replace
+            # relative url paths will full url paths so that
+            # the user can connect to them.
+            if os.path.exists(fullfilename):
+                linkmap[key] = fullfilename
+            elif key not in linkmap:
+                linkmap[key] = ''
 
-            else:
-                newurl="".join((http_str,"=\"","\""))
+        return linkmap
 
-            if typ != 'img':
-                oldurl = "".join((http_str, "=\"", v, "\""))
-                try:
-                    oldurlre = re.compile("".join((http_str,'=','\\"?',v,'\\"?')))
-                except Exception, e:
-                    debug("Error:",str(e))
-                    continue
-                    
-                # Get the location of the link in the file
-                try:
-                    if oldurl != newurl:
-                        data = re.sub(oldurlre, newurl, data,1)
-                except Exception, e:
-                    debug("Error:",str(e))
-                    continue
-            else:
-                try:
-                    oldurlre1 = "".join((http_str,'=','\\"?',v,'\\"?'))
-                    oldurlre2 = "".join(('href','=','\\"?',v,'\\"?'))
-                    oldurlre = re.compile("".join(('(',oldurlre1,'|',oldurlre2,')')))
-                except Exception, e:
-                    debug("Error:",str(e))
-                    continue
-                
-                http_strs=('href','src')
-            
-                for item in http_strs:
-                    try:
-                        oldurl = "".join((item, "=\"", v, "\""))
-                        if oldurl != newurl:
-                            data = re.sub(oldurlre, newurl, data,1)
-                    except:
-                        pass
+    def localise_file_links(self, filename, links):
+        """ Localise links for this file """
 
-        try:
-            fw.write(data)
-            fw.close()
-        except IOError, e:
-            logconsole(e)
+        urlobj = links and links[0] and links[0].baseurl
+        pageurl = (urlobj and urlobj.get_full_url()) or ''
+        filename, count, err = localiser.localise_page(filename, pageurl, self.get_link_map(links),
+                                                       self._cfg.localise, bool(self.blobs))
+        if err:
+            logconsole(err)
             return HARVESTMAN_FAIL
 
         return HARVESTMAN_OK
@@ -1123,6 +1172,41 @@ class HarvestManDataManager(object):
 
         if nbroken: info(nbroken,fns[9],wasOrWere(nbroken),'were broken.')
         if fatal: info(fatal,fns[5],'had fatal errors and failed to download.')
+        for role in ('fetcher', 'crawler'):
+            if role in statsd.get('roles', {}):
+                nthreads, util = statsd['roles'][role]
+                info(nthreads, plural((role + ' thread', nthreads)), 'busy for %.1f%% of the time.' % (100.0*util))
+        if statsd.get('conversions'):
+            info(statsd['conversions'],'threads converted between fetcher and crawler roles.')
+        if statsd.get('spilled'):
+            info(statsd['spilled'],'queue items overflowed to disk,',statsd['refilled'],'read back.')
+        if statsd.get('linkhits'):
+            nlookups = statsd['linkhits'] + statsd['linkmisses']
+            info(statsd['linkhits'],'of',nlookups,'links found in the link cache (%.1f%%).' % (100.0*statsd['linkhits']/nlookups))
+        if statsd.get('dupfiles'):
+            info(statsd['dupfiles'],plural(('file', statsd['dupfiles'])),'with the content of another file were linked to',
+                 statsd['blobs'],plural(('stored file', statsd['blobs'])),'saving',statsd['dupbytes'],'bytes.')
+        if statsd.get('poolhits') or statsd.get('poolmisses'):
+            info(statsd['poolhits'],'of',statsd['poolhits']+statsd['poolmisses'],'requests reused an open connection,',
+                 statsd['poolevictions'],'idle and',statsd['poolstale'],'dead connections closed.')
+        if statsd.get('blocked'):
+            blocked = [(t, n, host) for host, (n, t) in statsd['blocked'].items()]
+            blocked.sort(reverse=True)
+            info('Threads waited %.2f seconds for connectors in all,' % sum([t for t, n, host in blocked]),
+                 'most for',', '.join(['%s (%.2f seconds, %d %s)' % (host or 'any server', t, n, plural(('wait', n)))
+                                       for t, n, host in blocked[:3]]),'.')
+            for t, n, host in blocked:
+                extrainfo('Waited %.2f seconds %d times for connectors to %s' % (t, n, host or 'any server'))
+        if statsd.get('bwlimit'):
+            info('Bandwidth limited to %.2f KB/sec, achieved %.2f KB/sec while downloading.' % (statsd['bwlimit']/1024.0,
+                                                                                               statsd['bwachieved']/1024.0))
+        if statsd.get('hostbwlimit') and statsd.get('hostbwachieved'):
+            rates = [(rate, host) for host, rate in statsd['hostbwachieved'].items()]
+            rate, host = max(rates)
+            info('Bandwidth limited to %.2f KB/sec per server, achieved at most %.2f KB/sec from %s.' % (statsd['hostbwlimit']/1024.0,
+                                                                                                       rate/1024.0, host))
+            for rate, host in rates:
+                extrainfo('Achieved %.2f KB/sec from %s' % (rate/1024.0, host))
         if bytes: info(bytes,' bytes received at the rate of',bps,ratespec,'.')
         if savedbytes: info(savedbytes,' bytes were written to disk.\n')
         
@@ -1206,12 +1290,11 @@ class HarvestManDataManager(object):
     def dump_urltree_textmode(self, stream):
         """ Dump urls in text mode """
 
-        for node in self.collections.preorder():
-            coll = node.get()
+        for source, indices in self.linkgraph.iteritems():
 
             idx = 0
-            links = [self.get_url(index) for index in coll.getAllURLs()]
-            children = []
+            links = [self.get_url(index) for index in indices]
+            children = set()
             
             for link in links:
                 if not link: continue
@@ -1220,14 +1303,13 @@ class HarvestManDataManager(object):
                 # child url, since base url will
                 # be same for all child urls.
                 if idx==0:
-                    children = []
-                    base_url = link.get_parent_url().get_full_url()
+                    base_url = self.get_url(source).get_full_url()
                     stream.write(base_url + '\n')
 
                 childurl = link.get_full_url()
                 if childurl and childurl not in children:
                     stream.write("".join(('\t',childurl,'\n')))
-                    children.append(childurl)
+                    children.add(childurl)
 
                 idx += 1
 
@@ -1247,13 +1329,12 @@ class HarvestManDataManager(object):
         stream.write('<p>\n')
         stream.write('<ol>\n')
         
-        for node in self.collections.preorder():
-            coll = node.get()
+        for source, indices in self.linkgraph.iteritems():
             
             idx = 0
-            links = [self.get_url(index) for index in coll.getAllURLs()]            
+            links = [self.get_url(index) for index in indices]
 
-            children = []
+            children = set()
             for link in links:
                 if not link: continue
 
@@ -1261,8 +1342,7 @@ class HarvestManDataManager(object):
                 # child url, since base url will
                 # be same for all child urls.
                 if idx==0:
-                    children = []                   
-                    base_url = link.get_parent_url().get_full_url()
+                    base_url = self.get_url(source).get_full_url()
                     stream.write('<li>')                    
                     stream.write("".join(("<a href=\"",base_url,"\"/>",base_url,"</a>")))
                     stream.write('</li>\n')
@@ -1274,7 +1354,7 @@ class HarvestManDataManager(object):
                     stream.write('<li>')
                     stream.write("".join(("<a href=\"",childurl,"\"/>",childurl,"</a>")))
                     stream.write('</li>\n')                    
-                    children.append(childurl)
+                    children.add(childurl)
                     
                 idx += 1                
 
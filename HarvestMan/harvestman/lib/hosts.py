@@ -0,0 +1,151 @@
+# -- coding: utf-8
+""" hosts.py - Module keeping a table of the hosts (servers)
+seen by HarvestMan. This is part of the HarvestMan program.
+
+Every host name gets a small integer id, which is kept by the
+url objects of the host, and which the modules keeping state
+per host use as key. The facts derived from the host name
+which are used for comparing hosts, such as the base server
+and the name without its 'www' prefix, are computed once and
+kept with the host, and so is its ip address.
+
+The ids are valid only in the process which assigned them, so
+they are not saved with the crawl state.
+
+"""
+
+import socket
+import threading
+
+from harvestman.lib.common.netinfo import tlds, www_re as wwwre
+
+tldset = set(tlds)
+
+def base_server(server):
+    """ Return the base server name of  the passed
+    server (domain) name """
+
+    # If the server name is of the form say bar.foo.com
+    # or vodka.bar.foo.com, i.e there are more than one
+    # '.' in the name, then we need to return the
+    # last string containing a dot in the middle.
+    if server.count('.') > 1:
+        dotstrings = server.split('.')
+        # now the list is of the form => [vodka, bar, foo, com]
+
+        # Skip the list for skipping over tld domain name endings
+        # such as .org.uk, .mobi.uk etc. For example, if the
+        # server is games.mobileworld.mobi.uk, then we
+        # need to return mobileworld.mobi.uk, not mobi.uk
+        dotstrings.reverse()
+        idx = 0
+
+        for item in dotstrings:
+            if item.lower() in tldset:
+                idx += 1
+
+        return '.'.join(dotstrings[idx::-1])
+    else:
+        # The server is of the form foo.com or just "foo"
+        # so return it straight away
+        return server
+
+def strip_tlds(server):
+    """ Return the server name without www prefix and
+    tld endings """
+
+    dotstrings = wwwre.sub('', server.lower()).split('.')
+    return '.'.join([item for item in dotstrings if item not in tldset])
+
+class HarvestManHost(object):
+    """ A host in the host table """
+
+    __slots__ = ('id', 'name', 'nowww', 'notld', 'base', 'basenotld', '_ip')
+
+    def __init__(self, id, name):
+        self.id = id
+        # Lower case name
+        self.name = name
+        # Name without www prefix
+        self.nowww = wwwre.sub('', name)
+        # Name without www prefix and tld endings
+        self.notld = strip_tlds(name)
+        # Base server, without www prefix
+        self.base = wwwre.sub('', base_server(name))
+        self.basenotld = strip_tlds(self.base)
+        self._ip = None
+
+    def __repr__(self):
+        return '<HarvestManHost %d %s>' % (self.id, self.name)
+
+    def get_ip(self):
+        """ Return the ip address of this host, or
+        an empty string if it is not resolved """
+
+        # Looked up once, failures included
+        if self._ip is None:
+            try:
+                self._ip = socket.gethostbyname(self.name)
+            except Exception:
+                self._ip = ''
+
+        return self._ip
+
+class HarvestManHostTable(object):
+    """ Table of hosts, by id and by name """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Id 0 is the empty host of urls without
+        # one, such as file urls
+        self.hosts = [HarvestManHost(0, '')]
+        self.ids = {'': 0}
+
+    def get_id(self, name):
+        """ Return the id of the host 'name', adding
+        it to the table if not found """
+
+        try:
+            return self.ids[name]
+        except KeyError:
+            pass
+
+        lname = name.lower()
+        self.lock.acquire()
+        try:
+            hid = self.ids.get(lname)
+            if hid is None:
+                hid = len(self.hosts)
+                self.hosts.append(HarvestManHost(hid, lname))
+                self.ids[lname] = hid
+            # Also look up the name as given
+            self.ids[name] = hid
+            return hid
+        finally:
+            self.lock.release()
+
+    def get_host(self, host):
+        """ Return the host record for the id or name 'host' """
+
+        if type(host) is int:
+            return self.hosts[host]
+        return self.hosts[self.get_id(host)]
+
+    def __len__(self):
+        return len(self.hosts)
+
+# The table of this process
+hosttable = HarvestManHostTable()
+
+def host_id(name):
+    """ Return the id of the host 'name' """
+
+    return hosttable.get_id(name)
+
+def get_host(host):
+    """ Return the host record for the id or name 'host' """
+
+    return hosttable.get_host(host)
@@ -0,0 +1,309 @@
+# -- coding: utf-8
+""" linkgraph.py - Module which keeps the graph of links
+between the URLs of a crawl in compact integer arrays. This
+is part of the HarvestMan program.
+
+Every URL in the graph is a node with a small integer id, given
+in the order the URLs are seen. The links are kept in compressed
+sparse row (CSR) form: the ids of the URLs linked from each page
+are appended to one array of edges, and an array of offsets
+marks where the links of every page start. Finding the links of
+a page takes time in the number of its links, and going over
+the whole graph reads the arrays without creating an object per
+page. The reverse links (the pages linking to a URL) are built
+in the same form when first asked for.
+
+A graph can be saved to a file and opened again, either read
+into memory or memory-mapped.
+"""
+
+import mmap
+import struct
+import threading
+
+from array import array
+
+# URL indices are 64-bit, so they are kept in
+# unsigned longs where these have 64 bits.
+if array('L').itemsize == 8:
+    INDEX_TYPE = 'L'
+else:
+    INDEX_TYPE = None
+
+MAGIC = 'HMLG'
+VERSION = 1
+# Magic, version, number of nodes, rows and edges
+HEADER = struct.Struct('<4sIIII')
+
+class HarvestManLinkGraphError(Exception):
+    pass
+
+def index_array(items=()):
+    """ Return an array for URL indices """
+
+    if INDEX_TYPE:
+        return array(INDEX_TYPE, items)
+    return list(items)
+
+class HarvestManMappedArray(object):
+    """ Read-only array of integers in native byte order
+    in a memory-mapped file """
+
+    def __init__(self, mapped, offset, typecode, length):
+        self.mapped = mapped
+        self.offset = offset
+        self.typecode = typecode
+        self.itemsize = struct.calcsize('=' + typecode)
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.length)
+            if step != 1 or stop <= start:
+                return [self[i] for i in xrange(start, stop, step)]
+            return list(struct.unpack_from('=%d%s' % (stop - start, self.typecode),
+                                           self.mapped, self.offset + start*self.itemsize))
+
+        if item < 0:
+            item += self.length
+        if not 0 <= item < self.length:
+            raise IndexError, 'array index out of range'
+        return struct.unpack_from('=' + self.typecode, self.mapped,
+                                  self.offset + item*self.itemsize)[0]
+
+    def __iter__(self):
+        # In chunks, to keep the unpacking cheap
+        for start in xrange(0, self.length, 4096):
+            for item in self[start:start+4096]:
+                yield item
+
+class HarvestManLinkGraph(object):
+    """ Graph of the links between URLs in CSR form """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Node ids by URL index
+        self.ids = {}
+        # URL indices by node id
+        self.nodes = index_array()
+        # Row of the links of each node by node id,
+        # -1 for nodes whose links are not known
+        self.rows = array('i')
+        # Source node of every row
+        self.sources = array('i')
+        # Start of the links of every row in the
+        # edge array, and the end of the last one
+        self.offsets = array('i', [0])
+        # Node ids of the links
+        self.edges = array('i')
+        # Number of rows which were replaced
+        self.stale = 0
+        # Reverse links, built when needed
+        self._rev = None
+        # Set if mapped from a file
+        self.mapped = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _node(self, index):
+        """ Return the node id of the URL with 'index',
+        adding a node if it is not in the graph """
+
+        try:
+            return self.ids[index]
+        except KeyError:
+            node = self.ids[index] = len(self.nodes)
+            self.nodes.append(index)
+            self.rows.append(-1)
+            return node
+
+    def _get_ids(self):
+        # Built on first use for a mapped graph
+        if not self.ids and len(self.nodes):
+            self.ids = dict([(index, node) for node, index in enumerate(self.nodes)])
+        return self.ids
+
+    def add_links(self, source, children):
+        """ Add the links from the URL with index 'source'
+        to the URLs with the indices in 'children'. Links
+        added before for the source are replaced """
+
+        if self.mapped is not None:
+            raise HarvestManLinkGraphError, 'graph is read-only'
+
+        self.lock.acquire()
+        try:
+            node = self._node(source)
+            row = len(self.sources)
+            self.sources.append(node)
+            self.edges.extend([self._node(child) for child in children])
+            self.offsets.append(len(self.edges))
+            # Set last, for readers not taking the lock
+            if self.rows[node] != -1:
+                self.stale += 1
+            self.rows[node] = row
+            self._rev = None
+        finally:
+            self.lock.release()
+
+    def get_children(self, index):
+        """ Return the indices of the URLs linked from the
+        URL with index 'index' """
+
+        node = self._get_ids().get(index)
+        if node is None:
+            return []
+        row = self.rows[node]
+        if row == -1:
+            return []
+
+        nodes = self.nodes
+        return [nodes[child] for child in self.edges[self.offsets[row]:self.offsets[row+1]]]
+
+    def _build_reverse(self):
+        """ Build the reverse links in CSR form, as a
+        tuple of offset and edge arrays by node id """
+
+        n = len(self.nodes)
+        counts = array('i', [0])*(n + 1)
+        rows, sources, offsets, edges = self.rows, self.sources, self.offsets, self.edges
+
+        live = [row for row in xrange(len(sources)) if rows[sources[row]] == row]
+        for row in live:
+            for child in edges[offsets[row]:offsets[row+1]]:
+                counts[child+1] += 1
+        # Prefix sums give the start of every node
+        for node in xrange(n):
+            counts[node+1] += counts[node]
+
+        revedges = array('i', [0])*counts[n]
+        fill = array('i', counts)
+        for row in live:
+            source = sources[row]
+            for child in edges[offsets[row]:offsets[row+1]]:
+                revedges[fill[child]] = source
+                fill[child] += 1
+
+        return (counts, revedges)
+
+    def get_parents(self, index):
+        """ Return the indices of the URLs linking to
+        the URL with index 'index' """
+
+        node = self._get_ids().get(index)
+        if node is None:
+            return []
+
+        self.lock.acquire()
+        try:
+            if self._rev is None:
+                self._rev = self._build_reverse()
+            revoffsets, revedges = self._rev
+        finally:
+            self.lock.release()
+
+        nodes = self.nodes
+        return [nodes[parent] for parent in revedges[revoffsets[node]:revoffsets[node+1]]]
+
+    def iteritems(self):
+        """ Iterate over the pages whose links are known, in the
+        order they were added, as tuples of the index of the page
+        and the list of indices of the URLs it links to """
+
+        nodes, rows, sources, offsets, edges = self.nodes, self.rows, self.sources, \
+                                               self.offsets, self.edges
+        for row in xrange(len(sources)):
+            source = sources[row]
+            # Skip links which were replaced
+            if rows[source] != row: continue
+            yield nodes[source], [nodes[child] for child in edges[offsets[row]:offsets[row+1]]]
+
+    def iterlinked(self):
+        """ Iterate over the indices of the URLs which are
+        linked from some page, each only once, in the order
+        they were first linked """
+
+        seen = array('b', [0])*len(self.nodes)
+        nodes, rows, sources, offsets, edges = self.nodes, self.rows, self.sources, \
+                                               self.offsets, self.edges
+        for row in xrange(len(sources)):
+            if rows[sources[row]] != row: continue
+            for child in edges[offsets[row]:offsets[row+1]]:
+                if not seen[child]:
+                    seen[child] = 1
+                    yield nodes[child]
+
+    def get_stats(self):
+        """ Return a dictionary with the number of nodes,
+        pages, links and the bytes used by the arrays """
+
+        arrays = (self.rows, self.sources, self.offsets, self.edges)
+        size = sum([len(a)*4 for a in arrays]) + len(self.nodes)*8
+        return {'nodes': len(self.nodes), 'pages': len(self.sources) - self.stale,
+                'links': len(self.edges), 'bytes': size}
+
+    def save(self, filename):
+        """ Save the graph to the file 'filename' """
+
+        if INDEX_TYPE is None:
+            raise HarvestManLinkGraphError, 'saving needs 64-bit unsigned longs'
+
+        self.lock.acquire()
+        try:
+            f = open(filename, 'wb')
+            try:
+                f.write(HEADER.pack(MAGIC, VERSION, len(self.nodes), len(self.sources),
+                                    len(self.edges)))
+                for a in (self.nodes, self.rows, self.sources, self.offsets, self.edges):
+                    a.tofile(f)
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+
+    @classmethod
+    def load(cls, filename, mapped=False):
+        """ Return the graph saved in the file 'filename'. If
+        'mapped' is True, the file is memory-mapped and the
+        graph is read-only """
+
+        f = open(filename, 'rb')
+        try:
+            magic, version, nnodes, nrows, nedges = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise HarvestManLinkGraphError, 'not a link graph file: %s' % filename
+
+            graph = cls()
+            layout = (('nodes', INDEX_TYPE, nnodes), ('rows', 'i', nnodes),
+                      ('sources', 'i', nrows), ('offsets', 'i', nrows + 1),
+                      ('edges', 'i', nedges))
+
+            if mapped:
+                graph.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                offset = HEADER.size
+                for name, typecode, length in layout:
+                    # Struct codes with standard sizes
+                    typecode = {'L': 'Q'}.get(typecode, typecode)
+                    a = HarvestManMappedArray(graph.mapped, offset, typecode, length)
+                    setattr(graph, name, a)
+                    offset += length*a.itemsize
+            else:
+                for name, typecode, length in layout:
+                    a = array(typecode)
+                    a.fromfile(f, length)
+                    setattr(graph, name, a)
+                graph._get_ids()
+
+            graph.stale = nrows - len([row for row in xrange(nrows) \
+                                       if graph.rows[graph.sources[row]] == row])
+        finally:
+            f.close()
+
+        return graph
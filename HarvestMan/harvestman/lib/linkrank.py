@@ -0,0 +1,132 @@
+# -- coding: utf-8
+""" linkrank.py - Module which estimates the importance of
+URLs from the links seen during the crawl, for prioritizing
+the URLs to fetch. This is part of the HarvestMan program.
+
+The estimate is computed online with the OPIC algorithm
+(On-line Page Importance Computation, Abiteboul et al,
+WWW 2003). Every URL holds some 'cash'. The starting URL
+gets a cash of 1.0. When the links of a page are known,
+its cash is split equally among the URLs it links to and
+added to their cash, and the page keeps what it had in its
+'history'. URLs which are not fetched yet are fetched in
+the order of their cash, so the URLs which collected most
+from the pages crawled so far are fetched first.
+
+Cash halves with every level of links, so the priority of
+a URL is derived from the logarithm of its cash. As more
+pages link to a URL waiting in the url queue, its priority
+is raised in the queue.
+
+"""
+
+import math
+import threading
+
+from harvestman.lib.common.common import *
+
+class HarvestManLinkRank(object):
+    """ Online estimate of the importance of URLs by
+    the OPIC algorithm """
+
+    alias = 'linkrank'
+    # Priority steps per halving of cash
+    scale = 4
+    # Priority for URLs without cash
+    maxterm = 64*scale
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Cash of URLs whose links are not known
+        # yet, by index
+        self.cash = {}
+        # Cash given away by URLs whose links
+        # are known, by index
+        self.history = {}
+        # Priority term applied to the URLs
+        # pushed to the url queue, by index
+        self.terms = {}
+        self.lock = threading.Lock()
+        # Stats
+        self.nupdates = 0
+        self.nreprioritized = 0
+
+    def term(self, cash):
+        """ Return the priority term for an amount of cash.
+        Lower terms are fetched first """
+
+        if cash <= 0.0:
+            return self.maxterm
+        return min(int(round(-self.scale*math.log(cash, 2))), self.maxterm)
+
+    def get_cash(self, index):
+        """ Return the cash of the URL with the given index """
+
+        return self.cash.get(index, 0.0)
+
+    def get_importance(self, index):
+        """ Return the estimated importance of the URL
+        with the given index, which is the total cash
+        it has received """
+
+        return self.history.get(index, 0.0) + self.cash.get(index, 0.0)
+
+    def priority(self, url_obj):
+        """ Return the priority term of a URL object being
+        pushed to the url queue """
+
+        self.lock.acquire()
+        try:
+            term = self.term(self.cash.get(url_obj.index, 0.0))
+            self.terms[url_obj.index] = term
+            return term
+        finally:
+            self.lock.release()
+
+    def add_links(self, source, children):
+        """ Distribute the cash of the URL with index 'source'
+        to the URLs it links to, whose indices are given in
+        'children'. Raises the priority of the children which
+        are already in the url queue """
+
+        deltas = {}
+
+        self.lock.acquire()
+        try:
+            # A page with no cash of its own, such as a
+            # starting URL or the URL where a resumed crawl
+            # starts, gets a full share.
+            if source in self.history:
+                cash = self.cash.pop(source, 0.0)
+            else:
+                cash = self.cash.pop(source, 1.0)
+            self.history[source] = self.history.get(source, 0.0) + cash
+            self.terms.pop(source, None)
+
+            children = [index for index in set(children) if index != source]
+            if not children: return
+
+            share = cash/len(children)
+            for index in children:
+                if index in self.history:
+                    # Links already distributed
+                    self.history[index] += share
+                    continue
+
+                cash = self.cash.get(index, 0.0) + share
+                self.cash[index] = cash
+                term = self.terms.get(index)
+                if term is not None:
+                    newterm = self.term(cash)
+                    if newterm != term:
+                        deltas[index] = newterm - term
+                        self.terms[index] = newterm
+
+            self.nupdates += 1
+        finally:
+            self.lock.release()
+
+        if deltas and objects.queuemgr:
+            self.nreprioritized += objects.queuemgr.reprioritize(deltas)
@@ -0,0 +1,217 @@
+# -- coding: utf-8
+""" localiser.py - Module which localises the links of the
+web pages saved by HarvestMan, i.e rewrites links pointing
+to the web into links to the files saved on the disk. This
+is part of the HarvestMan program.
+
+The links of a page are rewritten in a single pass over the
+page. Every href and src attribute is resolved against the URL
+of the page and looked up in a map of the URLs of the project
+to the files they were saved to. A link to a saved file is
+replaced by the path of the file, relative to the page or
+absolute, and any other link of the project by its absolute
+URL. The map is built once for the whole project.
+
+The pages of a project are localised in a pool of processes,
+since the work for every page is independent.
+"""
+
+import os
+import re
+import urlparse
+
+from harvestman.lib.blobstore import unshare_file
+
+# An href or src attribute with its value, quoted or not. The
+# name must follow whitespace, so that attributes such as
+# data-src or xlink:href are not taken for it.
+ATTR_RE = re.compile(r'''((?<=\s)(?:href|src)\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''',
+                     re.IGNORECASE)
+# A <base href="..."> tag
+BASE_RE = re.compile(r'<base\s[^>]*>', re.IGNORECASE)
+BASE_HREF_RE = re.compile(r'''(?<=\s)href\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443', 'ftp': ':21'}
+
+# Pages localised by each process at a time
+CHUNKSIZE = 16
+# Below this number of pages, the pages are
+# localised without a pool of processes
+MIN_POOL_PAGES = 50
+
+# Map of the URLs of the project and localisation
+# mode, set in every process of the pool
+linkmap = {}
+localise = 2
+
+def link_key(url):
+    """ Return the key of the absolute URL 'url' in a link map """
+
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    scheme, netloc = scheme.lower(), netloc.lower()
+    port = DEFAULT_PORTS.get(scheme)
+    if port and netloc.endswith(port):
+        netloc = netloc[:-len(port)]
+
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, ''))
+
+def relative_dir(path, start):
+    """ Return the directory 'path' relative to the directory
+    'start' as a URL path ending in '/', or '' if they are the
+    same. Returns None if they are on different drives """
+
+    # os.path.relpath needs Python 2.6
+    pathparts = os.path.abspath(path).split(os.sep)
+    startparts = os.path.abspath(start).split(os.sep)
+    if os.path.normcase(pathparts[0]) != os.path.normcase(startparts[0]):
+        return None
+
+    pathparts = [part for part in pathparts[1:] if part]
+    startparts = [part for part in startparts[1:] if part]
+    common = 0
+    for part, startpart in zip(pathparts, startparts):
+        if os.path.normcase(part) != os.path.normcase(startpart):
+            break
+        common += 1
+
+    parts = ['..']*(len(startparts) - common) + pathparts[common:]
+    return ''.join([part + '/' for part in parts])
+
+def localise_data(data, pageurl, filename, linkmap, mode=2):
+    """ Return a tuple of the content 'data' of the page with URL
+    'pageurl' saved to 'filename', with its links localised, and
+    the number of links replaced. 'linkmap' maps the keys of URLs
+    (see link_key) to the absolute file names they were saved to,
+    or to '' if they were not saved. The file names are made
+    relative to the page if 'mode' is 2 and file:// URLs if it
+    is 1 """
+
+    # Links are resolved against the base URL of the
+    # page, and the <base> tag itself is removed.
+    baseurl = pageurl
+    match = BASE_RE.search(data)
+    if match:
+        href = BASE_HREF_RE.search(match.group())
+        if href:
+            baseurl = urlparse.urljoin(pageurl, href.group(1))
+        data = BASE_RE.sub('', data)
+
+    pagedir = os.path.dirname(os.path.abspath(filename))
+    # Directories of the targets relative to the page
+    reldirs = {}
+    count = [0]
+
+    def replace(match):
+        value = match.group(2)
+        if value is None:
+            value = match.group(3)
+            if value is None:
+                value = match.group(4)
+
+        # str.partition needs Python 2.5
+        url, sep, fragment = value, '', ''
+        if '#' in value:
+            url, fragment = value.split('#', 1)
+            sep = '#'
+        if not url:
+            return match.group()
+
+        key = link_key(urlparse.urljoin(baseurl, url.replace('&amp;', '&')))
+        target = linkmap.get(key)
+        if target is None:
+            return match.group()
+
+        if not target:
+            # Not saved, so point to the web
+            newurl = key
+        else:
+            newurl = None
+            if mode == 2:
+                head, tail = os.path.split(target)
+                if head not in reldirs:
+                    reldirs[head] = relative_dir(head, pagedir)
+                reldir = reldirs[head]
+                if reldir is not None:
+                    newurl = reldir + tail
+            if newurl is None:
+                newurl = 'file://' + target.replace('\\', '/')
+
+        count[0] += 1
+        return ''.join((match.group(1), '"', newurl, sep, fragment, '"'))
+
+    data = ATTR_RE.sub(replace, data)
+    return (data, count[0])
+
+def localise_page(filename, pageurl, linkmap, mode=2, unshare=False):
+    """ Localise the links of the page with URL 'pageurl' saved
+    to 'filename', as for localise_data. If 'unshare' is True,
+    the file is unshared before it is modified. Returns a tuple
+    of the file name, the number of links replaced and an error
+    message or '' """
+
+    try:
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+
+        newdata, count = localise_data(data, pageurl, filename, linkmap, mode)
+        if newdata != data:
+            # The file is modified in place, so it must
+            # not be shared with other files any more
+            if unshare:
+                unshare_file(filename)
+            f = open(filename, 'wb')
+            f.write(newdata)
+            f.close()
+    except (OSError, IOError), e:
+        return (filename, 0, str(e))
+
+    return (filename, count, '')
+
+def set_link_map(urlmap, mode):
+    """ Set the link map and localisation mode of this process """
+
+    global linkmap, localise
+    linkmap, localise = urlmap, mode
+
+def localise_file(task):
+    """ Localise a page with the link map of this process.
+    'task' is a tuple of the file name of the page, its URL
+    and the unshare flag, as for localise_page """
+
+    filename, pageurl, unshare = task
+    return localise_page(filename, pageurl, linkmap, localise, unshare)
+
+def localise_files(tasks, urlmap, mode=2, workers=0):
+    """ Localise the pages for the list 'tasks', as for
+    localise_file, with the link map 'urlmap' and mode 'mode',
+    using 'workers' processes or one per CPU if 'workers' is 0.
+    Yields the results of localise_page, not necessarily in
+    the order of the tasks """
+
+    pool = None
+    if workers != 1 and len(tasks) >= MIN_POOL_PAGES:
+        try:
+            import multiprocessing
+            # The map is inherited by the processes, or
+            # pickled once for each where they are spawned
+            pool = multiprocessing.Pool(workers or None, set_link_map, (urlmap, mode))
+        except (ImportError, OSError, NotImplementedError):
+            # No processes on this platform
+            pool = None
+
+    if pool is None:
+        for filename, pageurl, unshare in tasks:
+            yield localise_page(filename, pageurl, urlmap, mode, unshare)
+        return
+
+    # Not try/finally, since a yield in it needs Python 2.5
+    try:
+        for result in pool.imap_unordered(localise_file, tasks, CHUNKSIZE):
+            yield result
+    except:
+        pool.terminate()
+        raise
+
+    pool.close()
+    pool.join()
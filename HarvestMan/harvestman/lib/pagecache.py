@@ -0,0 +1,460 @@
+# -- coding: utf-8
+""" pagecache.py - Module which keeps the project cache of
+HarvestMan. This is part of the HarvestMan program.
+
+The cache keeps a record for every URL saved by a project:
+its last-modified time, etag, checksum and location on disk,
+its headers and, if data caching is enabled, its compressed
+data. It is kept in two files in the project cache directory.
+
+cache.log is an append-only log of records. A record is written
+to the end of the log as soon as its URL is saved, so that the
+cache of an interrupted crawl is not lost. A record which is
+written again for a URL replaces the earlier one, which is left
+as garbage until the log is compacted.
+
+cache.idx is an index of the records in the log, as a sorted
+array of 64-bit URL fingerprints with the positions and sizes of
+their records. It is memory-mapped on open, so opening the cache
+does not depend on its size, and looking up a URL is a binary
+search in the index followed by reading one record. The data of
+a record is read only when asked for. The index is rewritten
+when the cache is committed; records written after the last
+commit are found again by reading the end of the log on open.
+"""
+
+import os
+import mmap
+import struct
+import bisect
+import cPickle
+import threading
+
+from harvestman.lib.linkgraph import HarvestManMappedArray
+from harvestman.lib.urlparser import url_fingerprint
+from harvestman.lib.common.common import *
+from harvestman.lib.common.lrucache import LRU
+
+MAGIC_LOG = 'HMPL'
+MAGIC_INDEX = 'HMPI'
+VERSION = 1
+
+# Magic and version
+LOG_HEADER = struct.Struct('<4sI')
+# URL fingerprint, size of the pickled fields and size of the data
+RECORD = struct.Struct('<QII')
+# Magic, version, number of records, size of the log
+# indexed and bytes taken by replaced records
+INDEX_HEADER = struct.Struct('<4sIQQQ')
+
+# Fields of a record
+FIELDS = ('url', 'last_modified', 'etag', 'location', 'checksum',
+          'content_length', 'headers')
+
+class HarvestManProjectCacheError(Exception):
+    pass
+
+class HarvestManProjectCache(object):
+    """ Project cache as an append-only record log
+    with a memory-mapped index """
+
+    def __init__(self, directory, memsize=1000):
+        self.directory = directory
+        self.logfilename = os.path.join(directory, 'cache.log')
+        self.indexfilename = os.path.join(directory, 'cache.idx')
+        # Number of records whose fields are kept in memory
+        self.memsize = memsize
+        self.lock = threading.Lock()
+        self._init()
+
+    def _init(self):
+        # Fingerprints, positions and sizes of the
+        # records in the index file
+        self.keys, self.offsets, self.sizes = [], [], []
+        self.mapped = None
+        # Positions and sizes of the records written since
+        # the index was written, by fingerprint
+        self.new = {}
+        # Fields of the records read or written last
+        self.mem = LRU(self.memsize)
+        self.rfile = None
+        self.wfile = None
+        # Size of the log
+        self.logsize = 0
+        # Bytes taken by replaced records
+        self.stale = 0
+        # Number of records
+        self.count = 0
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.reads = 0
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, key):
+        """ Return the position of 'key' in the index or None """
+
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+
+    def _locate(self, key):
+        """ Return the position and size of the record of 'key'
+        in the log or None """
+
+        try:
+            return self.new[key]
+        except KeyError:
+            i = self._find(key)
+            if i is not None:
+                return (self.offsets[i], self.sizes[i])
+
+    def open(self):
+        """ Open the cache, creating it if needed. Return True if an
+        existing cache with some records was found """
+
+        self.lock.acquire()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            if os.path.isfile(self.logfilename):
+                self.rfile = open(self.logfilename, 'rb')
+                magic, version = LOG_HEADER.unpack(self.rfile.read(LOG_HEADER.size) or '\0'*LOG_HEADER.size)
+                if magic != MAGIC_LOG or version != VERSION:
+                    raise HarvestManProjectCacheError, 'not a cache log: %s' % self.logfilename
+
+                start = self._read_index()
+                self._recover(start)
+            else:
+                f = open(self.logfilename, 'wb')
+                f.write(LOG_HEADER.pack(MAGIC_LOG, VERSION))
+                f.close()
+                self.rfile = open(self.logfilename, 'rb')
+                self.logsize = LOG_HEADER.size
+
+            self.wfile = open(self.logfilename, 'ab')
+        finally:
+            self.lock.release()
+
+        return len(self) > 0
+
+    def reset(self):
+        """ Set aside the files of a cache which could not be
+        opened, adding '.bad' to their names, and open a new
+        empty cache in their place """
+
+        self.lock.acquire()
+        try:
+            for f in (self.rfile, self.wfile):
+                if f: f.close()
+            self._unmap()
+            self._init()
+            for filename in (self.logfilename, self.indexfilename):
+                if os.path.isfile(filename):
+                    badfile = filename + '.bad'
+                    if os.path.isfile(badfile):
+                        os.remove(badfile)
+                    os.rename(filename, badfile)
+        finally:
+            self.lock.release()
+
+        return self.open()
+
+    def _read_index(self):
+        """ Map the index file and return the size of the log
+        it covers """
+
+        size = os.path.getsize(self.logfilename)
+        if not os.path.isfile(self.indexfilename):
+            return LOG_HEADER.size
+
+        f = open(self.indexfilename, 'rb')
+        try:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                return LOG_HEADER.size
+            magic, version, count, logsize, stale = INDEX_HEADER.unpack(header)
+            # An index for a log other than this one is ignored
+            if magic != MAGIC_INDEX or version != VERSION or logsize > size or \
+                   os.path.getsize(self.indexfilename) != INDEX_HEADER.size + count*20:
+                return LOG_HEADER.size
+
+            if count:
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                offset = INDEX_HEADER.size
+                self.keys = HarvestManMappedArray(self.mapped, offset, 'Q', count)
+                self.offsets = HarvestManMappedArray(self.mapped, offset + count*8, 'Q', count)
+                self.sizes = HarvestManMappedArray(self.mapped, offset + count*16, 'I', count)
+            self.stale = stale
+            self.count = count
+        finally:
+            f.close()
+
+        return logsize
+
+    def _recover(self, start):
+        """ Index the records written to the log from
+        'start' on, after the index was written """
+
+        f = self.rfile
+        end = os.fstat(f.fileno()).st_size
+        f.seek(start)
+        offset = start
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            key, metalen, datalen = RECORD.unpack(header)
+            size = RECORD.size + metalen + datalen
+            if offset + size > end:
+                break
+            f.seek(offset + size)
+            self._add(key, offset, size)
+            offset += size
+
+        if offset < end:
+            # Drop a record which was not written out in full
+            debug('Truncating project cache log at', offset)
+            f.close()
+            f = open(self.logfilename, 'r+b')
+            f.truncate(offset)
+            f.close()
+            self.rfile = open(self.logfilename, 'rb')
+
+        self.logsize = offset
+
+    def _add(self, key, offset, size):
+        old = self._locate(key)
+        if old is None:
+            self.count += 1
+        else:
+            self.stale += old[1]
+        self.new[key] = (offset, size)
+
+    def _read(self, key, data=False):
+        """ Return the fields of the record of 'key' and,
+        if 'data' is True, its data, or None """
+
+        where = self._locate(key)
+        if where is None:
+            return None
+
+        offset, size = where
+        self.rfile.seek(offset)
+        key, metalen, datalen = RECORD.unpack(self.rfile.read(RECORD.size))
+        fields = cPickle.loads(self.rfile.read(metalen))
+        self.reads += 1
+        if data:
+            return fields, self.rfile.read(datalen)
+        return fields
+
+    def _remember(self, key, fields):
+        # The least recently used fields are dropped
+        self.mem[key] = fields
+
+    def lookup(self, url):
+        """ Return the fields of the record for 'url' as
+        a dictionary, or None if it is not in the cache """
+
+        key = url_fingerprint(url)
+        self.lock.acquire()
+        try:
+            fields = self.mem.get(key)
+            if fields is None:
+                fields = self._read(key)
+            if fields is None or fields['url'] != url:
+                # Not found or a fingerprint collision
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._remember(key, fields)
+            return fields
+        finally:
+            self.lock.release()
+
+    def get_data(self, url):
+        """ Return the data saved with the record for 'url',
+        or an empty string """
+
+        key = url_fingerprint(url)
+        self.lock.acquire()
+        try:
+            record = self._read(key, True)
+            if record is None or record[0]['url'] != url:
+                return ''
+            return record[1]
+        finally:
+            self.lock.release()
+
+    def insert(self, url, data='', **kwargs):
+        """ Write a record for 'url' with the fields given as
+        keyword arguments and the data 'data', replacing any
+        earlier record for the URL """
+
+        fields = dict.fromkeys(FIELDS, '')
+        fields.update(kwargs)
+        fields['url'] = url
+        key = url_fingerprint(url)
+        meta = cPickle.dumps(fields, cPickle.HIGHEST_PROTOCOL)
+
+        self.lock.acquire()
+        try:
+            offset = self.logsize
+            self.wfile.write(RECORD.pack(key, len(meta), len(data)))
+            self.wfile.write(meta)
+            self.wfile.write(data)
+            # Flushed, so that the record can be read back
+            # and survives the crawl being killed
+            self.wfile.flush()
+            size = RECORD.size + len(meta) + len(data)
+            self.logsize += size
+            self._add(key, offset, size)
+            self._remember(key, fields)
+            self.written += 1
+        finally:
+            self.lock.release()
+
+    def iteritems(self):
+        """ Iterate over the records as tuples of URL
+        fingerprints and positions and sizes in the log,
+        in the order of the log """
+
+        entries = [(self.offsets[i], self.sizes[i], self.keys[i]) \
+                   for i in xrange(len(self.keys)) if self.keys[i] not in self.new]
+        entries.extend([(offset, size, key) for key, (offset, size) in self.new.iteritems()])
+        entries.sort()
+        for offset, size, key in entries:
+            yield key, (offset, size)
+
+    def _write_index(self, entries, logsize, stale):
+        """ Write the index for 'entries', a list of tuples
+        of fingerprints, positions and sizes """
+
+        entries.sort()
+        count = len(entries)
+        tmpfile = self.indexfilename + '.tmp'
+        f = open(tmpfile, 'wb')
+        try:
+            f.write(INDEX_HEADER.pack(MAGIC_INDEX, VERSION, count, logsize, stale))
+            # In chunks, to keep the packing cheap
+            for column, code in ((0, 'Q'), (1, 'Q'), (2, 'I')):
+                for start in xrange(0, count, 4096):
+                    chunk = [entry[column] for entry in entries[start:start+4096]]
+                    f.write(struct.pack('=%d%s' % (len(chunk), code), *chunk))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        self._unmap()
+        if os.name == 'nt' and os.path.isfile(self.indexfilename):
+            os.remove(self.indexfilename)
+        os.rename(tmpfile, self.indexfilename)
+
+    def _unmap(self):
+        if self.mapped is not None:
+            self.keys, self.offsets, self.sizes = [], [], []
+            self.mapped.close()
+            self.mapped = None
+
+    def commit(self):
+        """ Write the index of the cache to the disk. The
+        log is compacted first if more than half of it
+        is taken by replaced records """
+
+        self.lock.acquire()
+        try:
+            if self.wfile is None:
+                return
+            if self.stale and self.stale*2 > self.logsize:
+                self._compact()
+            elif self.new:
+                self.wfile.flush()
+                os.fsync(self.wfile.fileno())
+                entries = [(key, offset, size) for key, (offset, size) in self.iteritems()]
+                self._write_index(entries, self.logsize, self.stale)
+            else:
+                return
+
+            self.new = {}
+            self._read_index()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        """ Copy the current records to a new log """
+
+        extrainfo('Compacting project cache...')
+        tmpfile = self.logfilename + '.tmp'
+        f = open(tmpfile, 'wb')
+        f.write(LOG_HEADER.pack(MAGIC_LOG, VERSION))
+        entries = []
+        offset = LOG_HEADER.size
+        try:
+            for key, (start, size) in self.iteritems():
+                self.rfile.seek(start)
+                f.write(self.rfile.read(size))
+                entries.append((key, offset, size))
+                offset += size
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        self.rfile.close()
+        self.wfile.close()
+        # The old index must not be used with the new log
+        self._unmap()
+        if os.path.isfile(self.indexfilename):
+            os.remove(self.indexfilename)
+        if os.name == 'nt':
+            os.remove(self.logfilename)
+        os.rename(tmpfile, self.logfilename)
+        self.rfile = open(self.logfilename, 'rb')
+        self.wfile = open(self.logfilename, 'ab')
+        self.logsize, self.stale = offset, 0
+        self._write_index(entries, offset, 0)
+
+    def close(self):
+        """ Commit and close the cache """
+
+        self.commit()
+        self.lock.acquire()
+        try:
+            for f in (self.rfile, self.wfile):
+                if f: f.close()
+            self._unmap()
+            self._init()
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """ Return a dictionary with the number of records,
+        the size of the log and the bytes taken by replaced
+        records, and lookup stats """
+
+        return {'records': len(self), 'bytes': self.logsize, 'stale': self.stale,
+                'hits': self.hits, 'misses': self.misses, 'written': self.written,
+                'reads': self.reads}
+
+    def import_pydblite(self, filename):
+        """ Copy the records of a cache file in the pydblite
+        format written by earlier versions to this cache """
+
+        from harvestman.lib.common.pydblite import Base
+
+        base = Base(filename).open()
+        count = 0
+        for rec in base:
+            url = rec.get('url')
+            if not url: continue
+            fields = dict([(field, rec.get(field) or '') for field in FIELDS if field != 'url'])
+            self.insert(url, rec.get('data') or '', **fields)
+            count += 1
+
+        return count
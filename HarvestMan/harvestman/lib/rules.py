@@ -29,7 +29,6 @@
 __version__ = '2.0 b1'
 __author__ = 'Anand B Pillai'
 
-import socket
 import re
 import os
 import time
@@ -39,10 +38,11 @@ from harvestman.lib.event import HarvestManEvent
 from harvestman.lib import robotparser
 from harvestman.lib.methodwrapper import MethodWrapperMetaClass
 from harvestman.lib import urlparser
+from harvestman.lib import hosts
 from harvestman.lib import filters
+from harvestman.lib.checkpoint import journal
 
 from harvestman.lib.common.common import *
-from harvestman.lib.common.netinfo import tlds
 from harvestman.lib.common.lrucache import LRU
 
 # Defining pluggable functions
@@ -62,9 +62,6 @@ class HarvestManRulesChecker(object):
     __metaclass__ = MethodWrapperMetaClass
     alias = 'rulesmgr'
     
-    # Regular expression for matching www. infront of domains
-    wwwre = re.compile(r'^www(\d*)\.')
-
     def __init__(self):
         self.reset()
 
@@ -73,7 +70,10 @@ class HarvestManRulesChecker(object):
         self._extservers = Ldeque(1000)
         self._extdirs = Ldeque(1000)
         self._wordstr = '[\s+<>]'
+        # Robot parsers keyed by (host id, port)
         self._robots  = LRU(1000)
+        # Results of host comparisons keyed by host ids
+        self._samehost = {}
         self._robocache = Ldeque(1000)
         self._invalidservers = Ldeque(1000)
         # Flag for making filters
@@ -152,82 +152,113 @@ class HarvestManRulesChecker(object):
         """ Add the link to the filter dictionary """
 
         self._filter[urlindex] = 1
+        journal('filter', urlindex)
+
+    def get_caches(self):
+        """ Return the contents of the caches as a dictionary """
+
+        return {'extservers': list(self._extservers),
+                'extdirs': list(self._extdirs),
+                # Host ids are not valid in another process
+                'robots': [((hosts.get_host(hid).name, port), rp) for ((hid, port), rp) in self._robots.iteritems()],
+                'robocache': list(self._robocache),
+                'invalidservers': list(self._invalidservers)}
+
+    def get_state(self):
+        """ Return the state of this object as a dictionary """
+
+        return {'filter': self._filter.copy(), 'caches': self.get_caches()}
+
+    def set_state(self, state):
+        """ Set the state of this object from a dictionary
+        returned by get_state """
+
+        self._filter = state['filter'].copy()
+        caches = state['caches']
+        
+        for name in ('extservers', 'extdirs', 'robocache', 'invalidservers'):
+            cache = Ldeque(1000)
+            cache.extend(caches.get(name, []))
+            setattr(self, '_' + name, cache)
+        robots = []
+        for (key, rp) in caches.get('robots', []):
+            if type(key) is tuple:
+                domain, port = key
+            else:
+                # Older states are keyed by the server URL,
+                # with the port if it is not the default,
+                # such as 'http://www.foo.com:8080'
+                try:
+                    proto, domain = key.split('://', 1)
+                    port = urlparser.protocol_map[proto + '://']
+                    if ':' in domain:
+                        domain, port = domain.rsplit(':', 1)
+                        port = int(port)
+                except (ValueError, KeyError):
+                    continue
+            robots.append(((hosts.host_id(domain), port), rp))
+        self._robots = LRU(1000, robots)
 
     def compare_domains(self, domain1, domain2, robots=False):
         """ Compare two domains (servers) first by
         ip and then by name and return True if both point
-        to the same server, return False otherwise. """
-
+        to the same server, return False otherwise. The
+        domains are host names or host ids """
+
+        # The result for a pair of hosts does not change
+        # during a crawl, so it is computed only once
+        host1 = hosts.get_host(domain1)
+        host2 = hosts.get_host(domain2)
+        key = (host1.id, host2.id, robots)
+        
+        try:
+            return self._samehost[key]
+        except KeyError:
+            pass
+        
         # For comparing robots.txt file, first compare by
         # ip and then by name.
         if robots: 
-            firstval=self.compare_by_ip(domain1, domain2)
-            if firstval:
-                return firstval
-            else:
-                return self.compare_by_name(domain1, domain2)
-
+            ret = self.compare_by_ip(host1.id, host2.id) or \
+                  self.compare_by_name(host1.id, host2.id)
         # otherwise, we do only a name check
         else:
-            return self.compare_by_name(domain1, domain2)
+            ret = self.compare_by_name(host1.id, host2.id)
+
+        self._samehost[key] = ret
+        return ret
 
     def _get_base_server(self, server):
         """ Return the base server name of  the passed
         server (domain) name """
 
-        # If the server name is of the form say bar.foo.com
-        # or vodka.bar.foo.com, i.e there are more than one
-        # '.' in the name, then we need to return the
-        # last string containing a dot in the middle.
-        if server.count('.') > 1:
-            dotstrings = server.split('.')
-            # now the list is of the form => [vodka, bar, foo, com]
-
-            # Skip the list for skipping over tld domain name endings
-            # such as .org.uk, .mobi.uk etc. For example, if the
-            # server is games.mobileworld.mobi.uk, then we
-            # need to return mobileworld.mobi.uk, not mobi.uk
-            dotstrings.reverse()
-            idx = 0
-            
-            for item in dotstrings:
-                if item.lower() in tlds:
-                    idx += 1
-                
-            return '.'.join(dotstrings[idx::-1])
-        else:
-            # The server is of the form foo.com or just "foo"
-            # so return it straight away
-            return server
+        return hosts.base_server(server)
 
     def compare_no_tld(self, domain1, domain2):
         """ Compare two server names without their tld endings """
 
         # This will return True for www.foo.com, www.foo.org
         # foo.co.uk etc.
-        dotstrings1 = self.wwwre.sub('', domain1.lower()).split('.')
-        dotstrings2 = self.wwwre.sub('', domain2.lower()).split('.')
-        l1 = [item for item in dotstrings1 if item not in tlds]
-        l2 = [item for item in dotstrings2 if item not in tlds]            
-        debug(l1, l2)
-        
-        return '.'.join(l1) =='.'.join(l2)
+        return hosts.get_host(domain1).notld == hosts.get_host(domain2).notld
         
     def compare_by_name(self, domain1, domain2):
         """ Compare two servers by their names. Return True
         if similar, False otherwise """
 
+        host1 = hosts.get_host(domain1)
+        host2 = hosts.get_host(domain2)
+        
         # first check if both domains are same
-        if domain1.lower() == domain2.lower(): return True
+        if host1 is host2: return True
         # Check whether we are comparing something like www.foo.com
         # and foo.com, they are assumed to be same. 
-        if self.wwwre.sub('',domain1.lower())==self.wwwre.sub('',domain2.lower()):
+        if host1.nowww == host2.nowww:
             return True
 
         # If ignoretlds is set to True, return True for two servers such
         # as www.foo.com and www.foo.co.uk, www.foo.org etc.
         if self._configobj.ignoretlds:
-            if self.compare_no_tld(domain1, domain2):
+            if host1.notld == host2.notld:
                 return True
             
         if not self._configobj.subdomain:
@@ -236,19 +267,16 @@ class HarvestManRulesChecker(object):
             # variable is set. For example, this will
             # return True for two servers like server1.foo.com
             # and server2.foo.com or server1.base and server2.base
-            baseserver1 = self.wwwre.sub('',self._get_base_server(domain1))
-            baseserver2 = self.wwwre.sub('',self._get_base_server(domain2))
-            debug('Bases=>',baseserver1, baseserver2)
+            debug('Bases=>',host1.base, host2.base)
             
             # Instead of checking for equality, check for endswith.
             # This will return True even for cases like
             # vanhall-larenstein.nl and larenstein.nl
             if self._configobj.ignoretlds:
-                if self.compare_no_tld(baseserver1, baseserver2):
+                if host1.basenotld == host2.basenotld:
                     return True
                 
-            return baseserver1.lower().endswith(baseserver2.lower())
-            # return (baseserver1.lower() == baseserver2.lower())
+            return host1.base.endswith(host2.base)
         else:
             # if the subdomain variable is set will return False for two servers like
             # server1.foo.com and server2.foo.com i.e with same base domain but different
@@ -259,13 +287,11 @@ class HarvestManRulesChecker(object):
         """ Compare two servers by their ip address. Return
         True if same, False otherwise """
 
-        try:
-            ip1 = socket.gethostbyname(domain1)
-            ip2 = socket.gethostbyname(domain2)
-        except Exception:
-            return False
+        # The addresses are looked up once per host
+        ip1 = hosts.get_host(domain1).get_ip()
+        ip2 = hosts.get_host(domain2).get_ip()
 
-        if ip1==ip2: return True
+        if ip1 and ip1==ip2: return True
         else: return False
 
     def apply_url_filter(self, urlObj):
@@ -288,6 +314,8 @@ class HarvestManRulesChecker(object):
         if self._configobj.robots==0: return False
         
         domport = urlObj.get_full_domain_with_port()
+        # Robot parsers are kept per host and port
+        hostport = (urlObj.hostid, urlObj.port)
         # The robots.txt file url
         robotsfile = "".join((domport, '/robots.txt'))
 
@@ -311,7 +339,7 @@ class HarvestManRulesChecker(object):
             pass
 
         try:
-            rp = self._robots[domport]
+            rp = self._robots[hostport]
             # Check #4
             # If there is an entry, but it
             # is None, it means there is no
@@ -331,11 +359,11 @@ class HarvestManRulesChecker(object):
                 # server as None, so next
                 # time we dont need to do
                 # this operation again.
-                self._robots[domport] = None
+                self._robots[hostport] = None
                 return False
             else:
                 # Set it
-                self._robots[domport] = rp
+                self._robots[hostport] = rp
         
         # Check #6
         if rp.can_fetch(self._configobj.USER_AGENT, url_directory):
@@ -400,7 +428,7 @@ class HarvestManRulesChecker(object):
 
         # Check if both of them are in the same
         # domain
-        if self.compare_domains(urlObj.get_domain(), baseUrlObj.get_domain()):
+        if self.compare_domains(urlObj.hostid, baseUrlObj.hostid):
             debug('Domains',urlObj.get_domain(),'and',baseUrlObj.get_domain(),'compare fine')
             # Get url directory sans domain
             directory = urlObj.get_url_directory_sans_domain()
@@ -423,10 +451,7 @@ class HarvestManRulesChecker(object):
             return False
 
         # Check based on the server
-        server = urlObj.get_domain()
-        baseserver = baseUrlObj.get_domain()
-
-        return not self.compare_domains( server, baseserver )
+        return not self.compare_domains(urlObj.hostid, baseUrlObj.hostid)
 
     def is_external_link(self, urlObj):
         """ Check if the url is an external link relative to starting url,
@@ -755,4 +780,5 @@ class HarvestManRulesChecker(object):
         self._robocache = []
         # Reset dicts
         self._robots.clear()
+        self._samehost.clear()
         
@@ -213,6 +213,15 @@ class HarvestManUrlCollection(object):
         """ Returns a copy of the internal context dictionary """
 
         return self._collections.copy()
+
+    def reindex(self, indexmap):
+        """ Change the URL indices in this collection using
+        the dictionary 'indexmap' from old to new indices.
+        Indices not in the dictionary are dropped """
+
+        self._source = indexmap.get(self._source, self._source)
+        for context, urls in self._collections.items():
+            self._collections[context] = [indexmap[index] for index in urls if index in indexmap]
     
 class HarvestManAutoUrlCollection(HarvestManUrlCollection):
     """ A sub-class of HarvestManUrlCollection which
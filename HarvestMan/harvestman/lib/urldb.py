@@ -0,0 +1,482 @@
+# -- coding: utf-8
+"""
+urldb.py - Provides the sqlite backend of the URL database
+of the data manager. The URL objects, their status, headers
+and the links from each page to its children are kept in an
+sqlite database file in the cache directory of the project,
+so crawls whose URL state is larger than memory are possible
+and the results can be queried after the crawl.
+
+The database is opened in WAL mode. Writes are buffered and
+done in one transaction every few operations or seconds,
+whichever comes first. The most recently used objects are
+kept in memory, so that a URL looked up again is the same
+object.
+
+This is part of the HarvestMan program.
+"""
+
+import os
+import time
+import cPickle
+import threading
+
+from harvestman.lib import urlparser
+from harvestman.lib.common.common import *
+from harvestman.lib.common.lrucache import LRU
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+def to_sql(key):
+    """ Return the 64-bit unsigned key 'key' as
+    a signed sqlite integer """
+
+    if key >= 1L<<63:
+        return key - (1L<<64)
+    return key
+
+def from_sql(key):
+    """ Return the signed sqlite integer 'key' as
+    a 64-bit unsigned key """
+
+    if key < 0:
+        return key + (1L<<64)
+    return key
+
+def dumps(obj):
+    return sqlite3.Binary(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+def loads(data):
+    return cPickle.loads(str(data))
+
+class HarvestManUrlDBError(Exception):
+    pass
+
+class HarvestManSqliteDB(object):
+    """ Connection to the sqlite database of a crawl. Writes
+    of the stores using it are committed in batches """
+
+    schema = ("""create table if not exists urls (idx integer primary key, seq integer,
+                 url text, host text, status integer, qstatus integer,
+                 redirect text, headers blob, obj blob)""",
+              "create index if not exists urls_seq on urls (seq)",
+              "create index if not exists urls_status on urls (status, qstatus)",
+              """create table if not exists colls (idx integer primary key,
+                 seq integer, obj blob)""",
+              "create index if not exists colls_seq on colls (seq)",
+              "create table if not exists links (source integer, child integer)",
+              "create index if not exists links_source on links (source)")
+
+    def __init__(self, filename, batch=1000, interval=1.0):
+        if sqlite3 is None:
+            raise HarvestManUrlDBError, 'sqlite3 module not available'
+
+        self.filename = filename
+        # Number of writes per commit
+        self.batch = batch
+        # Maximum time between commits in seconds
+        self.interval = interval
+        self.lock = threading.RLock()
+        # Autocommit mode, transactions are begun
+        # and committed by us
+        self.conn = sqlite3.connect(filename, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+        for sql in self.schema:
+            self.conn.execute(sql)
+        self.stores = []
+        # Number of writes since the last commit
+        self.writes = 0
+        self.lastcommit = time.time()
+        self.commits = 0
+
+    @classmethod
+    def create(cls, filename, batch=1000, interval=1.0):
+        """ Create a fresh database in file 'filename',
+        removing any earlier one """
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.isfile(filename + suffix):
+                os.remove(filename + suffix)
+
+        return cls(filename, batch, interval)
+
+    def add_store(self, store):
+        self.stores.append(store)
+
+    def written(self):
+        """ Count a write and commit if the batch is
+        full or the commit interval is over """
+
+        self.writes += 1
+        if self.writes >= self.batch or \
+               (time.time() - self.lastcommit) >= self.interval:
+            self.commit()
+
+    def commit(self):
+        """ Write the buffered writes of all stores in
+        one transaction """
+
+        self.lock.acquire()
+        try:
+            self.conn.execute('begin')
+            try:
+                for store in self.stores:
+                    store.flush()
+            except:
+                self.conn.execute('rollback')
+                raise
+            self.conn.execute('commit')
+            self.writes = 0
+            self.lastcommit = time.time()
+            self.commits += 1
+        finally:
+            self.lock.release()
+
+    def execute(self, sql, params=()):
+        self.lock.acquire()
+        try:
+            return self.conn.execute(sql, params).fetchall()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.conn:
+                self.commit()
+                self.conn.close()
+                self.conn = None
+        finally:
+            self.lock.release()
+
+class HarvestManSqliteStore(object):
+    """ Store of pickled objects by 64-bit key in a table of
+    the crawl database. It has the interface of the hash
+    store in common.hashdb """
+
+    table = ''
+    columns = ()
+
+    def __init__(self, db, memsize=0):
+        self.db = db
+        self.lock = db.lock
+        # Maximum number of objects in memory,
+        # 0 means no limit
+        self.memsize = memsize
+        # Objects in memory, in order of use if
+        # their number is limited
+        if memsize:
+            self.mem = LRU(memsize)
+        else:
+            self.mem = {}
+        # Keys added since the last commit
+        self.new = set()
+        # Objects to write at the next commit
+        self.dirty = {}
+        self.size = db.execute('select count(*) from %s' % self.table)[0][0]
+        self.seq = db.execute('select max(seq) from %s' % self.table)[0][0] or 0
+        self.seqs = {}
+        # Stats
+        self.hits = 0
+        self.loads = 0
+        db.add_store(self)
+
+        # Statements
+        self.insert_sql = 'insert into %s (idx, seq, %s) values (?, ?, %s)' % \
+                          (self.table, ', '.join(self.columns), ', '.join('?'*len(self.columns)))
+        self.update_sql = 'update %s set %s where idx=?' % \
+                          (self.table, ', '.join([c + '=?' for c in self.columns]))
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            return key in self.mem or key in self.dirty or self._exists(key)
+        finally:
+            self.lock.release()
+
+    def _exists(self, key):
+        return bool(self.db.conn.execute('select 1 from %s where idx=?' % self.table,
+                                         (to_sql(key),)).fetchall())
+
+    def _read(self, key):
+        rows = self.db.conn.execute('select obj from %s where idx=?' % self.table,
+                                    (to_sql(key),)).fetchall()
+        if rows:
+            return loads(rows[0][0])
+
+    def _row(self, obj):
+        """ Return the values of the columns for object 'obj' """
+        raise NotImplementedError
+
+    def _put(self, key, obj):
+        mem = self.mem
+        if self.memsize and len(mem) >= self.memsize:
+            # Written at the next commit
+            oldkey, oldobj = mem.popitem()
+            self.dirty[oldkey] = oldobj
+        mem[key] = obj
+
+    def _write_links(self, key, obj):
+        pass
+
+    def _clear_links(self, key):
+        pass
+
+    def flush(self):
+        """ Write the buffered objects, called by the
+        database in a transaction """
+
+        if not self.dirty: return
+
+        conn = self.db.conn
+        new, old = [], []
+        for key, obj in self.dirty.iteritems():
+            row = self._row(obj)
+            if key in self.new:
+                new.append((to_sql(key), self.seqs.pop(key)) + row)
+            else:
+                old.append(row + (to_sql(key),))
+                self._clear_links(key)
+            self._write_links(key, obj)
+
+        conn.executemany(self.insert_sql, new)
+        conn.executemany(self.update_sql, old)
+        self.new.clear()
+        self.dirty.clear()
+
+    def insert(self, key, obj):
+        """ Add object 'obj' with key 'key', replacing
+        the object with this key if any """
+
+        self.lock.acquire()
+        try:
+            mem = self.mem
+            if key in mem:
+                del mem[key]
+            elif key not in self.dirty and not self._exists(key):
+                self.seq += 1
+                self.seqs[key] = self.seq
+                self.new.add(key)
+                self.size += 1
+            self.dirty[key] = obj
+            self._put(key, obj)
+            self.db.written()
+        finally:
+            self.lock.release()
+
+    def update(self, key, obj):
+        """ Replace the object with key 'key', if there
+        is one, by 'obj' """
+
+        if key in self:
+            self.insert(key, obj)
+
+    def lookup(self, key):
+        """ Return the object with key 'key' or None
+        if not found """
+
+        self.lock.acquire()
+        try:
+            mem = self.mem
+            obj = mem.get(key)
+            if obj is None:
+                obj = self.dirty.get(key)
+                if obj is None:
+                    obj = self._read(key)
+                    if obj is None:
+                        return None
+                    self.loads += 1
+                self._put(key, obj)
+            else:
+                if self.memsize:
+                    # Most recently used now
+                    del mem[key]
+                    mem[key] = obj
+                self.hits += 1
+            return obj
+        finally:
+            self.lock.release()
+
+    def _cached(self, key):
+        obj = self.mem.get(key)
+        if obj is None:
+            obj = self.dirty.get(key)
+        return obj
+
+    def select(self, where='', params=(), columns='idx'):
+        """ Return the rows of the table matching the
+        condition 'where', in the order of insertion. The
+        objects in memory are written first """
+
+        self.sync()
+        sql = 'select %s from %s' % (columns, self.table)
+        if where:
+            sql += ' where ' + where
+        return self.db.execute(sql + ' order by seq', params)
+
+    def select_objects(self, where='', params=()):
+        """ Return the objects matching the condition 'where',
+        in the order of insertion """
+
+        return [self.lookup(from_sql(row[0])) for row in self.select(where, params)]
+
+    def iteritems(self):
+        """ Iterate over the (key, object) pairs in order of
+        insertion. Objects not in memory are read without
+        moving them to memory """
+
+        self.db.commit()
+        seq = -1
+        while True:
+            rows = self.db.execute('select seq, idx, obj from %s where seq > ? order by seq limit 500' % \
+                                   self.table, (seq,))
+            if not rows: break
+            for seq, idx, data in rows:
+                key = from_sql(idx)
+                self.lock.acquire()
+                try:
+                    obj = self._cached(key)
+                finally:
+                    self.lock.release()
+                if obj is None:
+                    obj = loads(data)
+                yield key, obj
+
+    def iterkeys(self):
+        for key, obj in self.iteritems():
+            yield key
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for key, obj in self.iteritems():
+            yield obj
+
+    def sync(self):
+        """ Write all objects in memory to the database, so
+        that the columns reflect their current state """
+
+        self.lock.acquire()
+        try:
+            for key, obj in self.mem.iteritems():
+                self.dirty[key] = obj
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ Return a dictionary of statistics """
+
+        return {'size': self.size, 'memory': len(self.mem),
+                'hits': self.hits, 'loads': self.loads,
+                'commits': self.db.commits}
+
+    def close(self):
+        """ Write all objects and close the database. The
+        database file is kept """
+
+        if self.db.conn:
+            self.sync()
+        self.db.stores.remove(self)
+        if not self.db.stores:
+            self.db.close()
+
+class HarvestManSqliteUrlDB(HarvestManSqliteStore):
+    """ Store of URL objects by index """
+
+    table = 'urls'
+    columns = ('url', 'host', 'status', 'qstatus', 'redirect', 'headers', 'obj')
+
+    def _row(self, urlobj):
+        redirect = None
+        if urlobj.redirected:
+            orig = urlobj.get_original_state()
+            if orig is not None:
+                redirect = orig.get_full_url()
+        headers = urlobj.contentdict
+        if headers: headers = dumps(headers)
+
+        return (urlobj.get_full_url(), urlobj.get_domain(), urlobj.status,
+                urlobj.qstatus, redirect, headers, dumps(urlobj))
+
+    def get_broken_urls(self):
+        """ Return the URL objects of broken links (404) """
+
+        return self.select_objects('status=404')
+
+    def count_status(self, status):
+        """ Return the number of URLs with the given status """
+
+        return self.select('status=?', (status,), 'count(*)')[0][0]
+
+    def get_failed_urls(self):
+        """ Return the URL objects which were downloaded but did
+        not succeed, other than broken links and URLs which were
+        not modified """
+
+        return self.select_objects('qstatus=? and status not in (0, 304, 404)',
+                                   (urlparser.URL_DONE_DOWNLOAD,))
+
+    def get_url_headers(self):
+        """ Return a dictionary of the headers of URLs by URL """
+
+        return dict([(url, loads(headers)) for url, headers in \
+                     self.select('headers is not null', (), 'url, headers')])
+
+    def get_host_counts(self):
+        """ Return a dictionary of the number of URLs per host """
+
+        self.sync()
+        return dict(self.db.execute('select host, count(*) from urls group by host'))
+
+    def get_redirect_chains(self):
+        """ Return a list of redirect chains, each a list of
+        the URLs from the first one to the final one """
+
+        redirects = dict(self.select('redirect is not null', (), 'redirect, url'))
+        targets = set(redirects.values())
+        chains = []
+        for start in redirects:
+            # Chains start at URLs which are not
+            # the target of another redirect
+            if start in targets: continue
+            chain = [start]
+            while chain[-1] in redirects and redirects[chain[-1]] not in chain:
+                chain.append(redirects[chain[-1]])
+            chains.append(chain)
+
+        return chains
+
+class HarvestManSqliteLinkDB(HarvestManSqliteStore):
+    """ Store of URL collections by index of their source
+    URL, which also keeps the table of links from each
+    source to its children """
+
+    table = 'colls'
+    columns = ('obj',)
+
+    def _row(self, coll):
+        return (dumps(coll),)
+
+    def _write_links(self, key, coll):
+        self.db.conn.executemany('insert into links (source, child) values (?, ?)',
+                                 [(to_sql(key), to_sql(child)) for child in coll.getAllURLs()])
+
+    def _clear_links(self, key):
+        self.db.conn.execute('delete from links where source=?', (to_sql(key),))
+
+    def get_children(self, key):
+        """ Return the indices of the URLs linked from the
+        URL with index 'key' """
+
+        self.db.commit()
+        return [from_sql(row[0]) for row in \
+                self.db.execute('select child from links where source=?', (to_sql(key),))]
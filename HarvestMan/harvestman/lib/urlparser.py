@@ -44,18 +44,23 @@ __author__ = 'Anand B Pillai'
 
 import os, sys
 import re
+import struct
 import mimetypes
 import copy
 import urlproc
 import md5
 import itertools
 import random
+import weakref
+import threading
 
 from types import StringTypes
 
 from harvestman.lib import document
+from harvestman.lib import hosts
 from harvestman.lib.common.common import *
 from harvestman.lib.common.netinfo import *
+from harvestman.lib.common.lrucache import LRU
 from harvestman.lib.urltypes import *
 
 # URL queueing status macros
@@ -67,22 +72,68 @@ URL_IN_DOWNLOAD=3      # URL is out of queue and in download
 URL_DONE_DOWNLOAD=4    # URL has completed download, though this may not mean
                        # that the download was successful.
 
-mask=0xffffff
-
-def one_stringhash(s):
-    # One-at-a-time string hash
-    l = len(s)
-    hashval = 0
-    for c in s:
-        hashval += ord(c)
-        hashval += (hashval << 10)
-        hashval ^= (hashval >> 6)
-
-    hashval += (hashval << 3)
-    hashval ^= (hashval >> 11)
-    hashval += (hashval << 15)
+# Scheme of URL indices. Stored with saved crawl
+# states, which are re-indexed if it changes.
+INDEX_SCHEME = 'md5-64'
+
+def url_fingerprint(s):
+    """ Return a 64-bit fingerprint of the URL string s """
+
+    if type(s) is unicode:
+        s = s.encode('utf-8')
+    # The first 8 bytes of the MD5 digest. By the birthday
+    # bound a collision is expected only after some 4 billion
+    # URLs. Index 0 is kept for the starting URL.
+    return struct.unpack('<Q', md5.new(s).digest()[:8])[0] or 1
+
+def valid_url(url):
+    """ Make a valid url """
+
+    for x,y in itertools.izip(dirty_chars, dirty_chars_repl):
+        if x in url:
+            url = url.replace(x, y)
+
+    # Replace spaces between words
+    # with '%20'.
+    # For example http://www.foo.com/bar/this file.html
+    # Fix: Use regex instead of blind
+    # replacement.
+    if wspacere.search(url):
+        url = re.sub(r'\s', '%20', url)
+    
+    # Replace all % chars with their capital counterparts
+    # i.e %3a => %3A, %5b => %5B etc. This helps in
+    # canonicalization.
+    percent_chars = percent_repl.findall(url)
+    for pchar in percent_chars:
+        url = url.replace(pchar, pchar.upper())
+        
+    return url
 
-    return (hashval & mask)
+def canonical_url(url):
+    """ Return the canonical form of the full url 'url'. See
+    HarvestManUrl.get_canonical_url """
+    
+    params = params_re.findall(url)
+    lp = len(params)
+    if lp>1:
+        # Rule#11: Remove those params which are using a default value
+        # i.e which does not specify a value.
+        params = [param for param in params if param_re.match(param)]
+        # More than one param, sort it
+        params.sort()
+        url_sans_params = ampersand_re.sub('', params_re.sub('', url))
+        # Now put the params back in sorted order
+        url = url_sans_params + '&'.join(params)
+    elif lp==0:
+        # If no params but there is a ? at end, rule 12 applies
+        # Remove trailing ? at the end
+        url = question_re.sub('', url)
+
+    # Finally we strip off the www. from the beginning of the URL
+    url = www2_re.sub('', url)
+
+    return url
 
 class HarvestManUrlError(Exception):
     """ Error class for HarvestManUrl """
@@ -96,11 +147,72 @@ class HarvestManUrlError(Exception):
     def __str__(self):
         return str(self.value)
     
+# Attributes which are set only for a few URLs, such as
+# the URLs of multipart downloads, with their defaults.
+# These are kept in a dictionary of the URL object only
+# when set, instead of in slots of every URL object.
+extra_attrs = { 'range': None,
+                'trymultipart': False,
+                'mindex': 0,
+                'mirror_url': None,
+                'mirrored': False,
+                'clength': 0,
+                'redirected_old': False,
+                'orig_state': None }
+
+def extra_property(name):
+    """ Return a property for the rare attribute 'name'
+    of URL objects """
+
+    default = extra_attrs[name]
+    
+    def fget(self):
+        if self._extra:
+            return self._extra.get(name, default)
+        return default
+
+    def fset(self, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[name] = value
+
+    return property(fget, fset)
+
+def intern_string(s):
+    """ Return the interned copy of the string s, so that
+    strings such as domain names are shared by URL objects """
+    
+    if type(s) is str:
+        return intern(s)
+    return s
+
 class HarvestManUrl(object):
     """ A class representing a URL in HarvestMan """
 
+    # A crawl keeps an object for every URL it sees,
+    # so the attributes are kept in slots instead of
+    # a dictionary per object.
+    __slots__ = ('origurl', 'url', 'typ', 'cgi', 'anchor', 'index',
+                 'filename', 'validfilename', 'lastpath', 'protocol',
+                 'defproto', 'filelike', 'status', 'qstatus', 'fatal',
+                 'starturl', 'hasextn', 'isrel', 'isrels', 'port',
+                 'domain', 'hostid', 'contentdict', 'generation', 'priority',
+                 'violatesrules', 'rulescheckdone', 'dirpath',
+                 'reresolved', 'redirected', 'pagehash', 'absurl',
+                 'rootdir', '_parent', '_parentindex', '_extra',
+                 '__weakref__')
+    
     TEST = False
     hashes = {}
+
+    range = extra_property('range')
+    trymultipart = extra_property('trymultipart')
+    mindex = extra_property('mindex')
+    mirror_url = extra_property('mirror_url')
+    mirrored = extra_property('mirrored')
+    clength = extra_property('clength')
+    redirected_old = extra_property('redirected_old')
+    orig_state = extra_property('orig_state')
     
     def __init__(self, url, urltype = URL_TYPE_ANY, cgi = False, baseurl  = None, rootdir = ''):
         # Remove trailing wspace chars.
@@ -165,11 +277,10 @@ class HarvestManUrl(object):
         self.isrels = False
         self.port = 80
         self.domain = ''
-        self.rpath = []
-        # Recursion depth
-        self.rdepth = 0
-        # Url headers
-        self.contentdict = {}
+        # Id of the domain in the host table
+        self.hostid = 0
+        # Url headers, set after download
+        self.contentdict = None
         # Url generation
         self.generation = 0
         # Url priority
@@ -177,64 +288,46 @@ class HarvestManUrl(object):
         # rules violation cache flags
         self.violatesrules = False
         self.rulescheckdone = False
-        # Bytes range - used for HTTP/1.1
-        # multipart downloads. This has to
-        # be set to an xrange object 
-        self.range = None
-        # Flag to try multipart
-        self.trymultipart = False
-        # Multipart index
-        self.mindex = 0
-        # Original url for mirrored URLs
-        self.mirror_url = None
-        # Flag set for URLs which are mirrored from
-        # a different server than the original URL
-        self.mirrored = False
-        # Content-length for multi-part
-        # This is the content length of the original
-        # content.
-        self.clength = 0
         self.dirpath = []
         # Re-computation flag
         self.reresolved = False
         # URL redirected flag
         self.redirected = False
-        # Flag indicating we are using an old URL
-        # which was redirected, again for producing
-        # further redirections. This is used in Hget
-        # for automatic split-mirror downloading
-        # for URLs that auto-forward to mirrors.
-        self.redirected_old = False
-        self.baseurl = None
         # Hash of page data
         self.pagehash = ''
-        # Flag to decide whether to recalculate get_full_url(...)
-        # if flag is False, recalculate...
-        self.urlflag = False
-        # Cached full URL string
+        # Cached full URL string, computed
+        # by get_full_url(...) when empty
         self.absurl = ''
+        # Rare attributes (see extra_attrs)
+        self._extra = None
+        # Parent url (see the baseurl property)
+        self._parent = None
+        self._parentindex = None
         # Base Url Dictionary
         if baseurl:
             if isinstance(baseurl, HarvestManUrl):
                 self.baseurl = baseurl
             elif type(baseurl) in StringTypes:
-                self.baseurl = HarvestManUrl(baseurl, 'generic', cgi, None, rootdir)
+                # Nothing else refers to this one, so it
+                # is held by this object
+                self._parent = HarvestManUrl(baseurl, 'generic', cgi, None, rootdir)
+                self._parentindex = self._parent.index
                       
         # Root directory
         if rootdir == '':
             if self.baseurl and self.baseurl.rootdir:
                 self.rootdir = self.baseurl.rootdir
             else:
-                self.rootdir = os.getcwd()
+                self.rootdir = intern_string(os.getcwd())
         else:
-            self.rootdir = rootdir
+            self.rootdir = intern_string(rootdir)
             
         self.anchorcheck()
         self.resolveurl()
 
         # For starting URL, the index is 0, for the rest
         # it is as hash of the canonical URL string...
-        self.index = one_stringhash(self.get_canonical_url())
+        self.index = url_fingerprint(self.get_canonical_url())
         # If this is a URL similar to start URL,
         # reset its index to zero. The trick is
         # to store only the hash of the start URL
@@ -246,11 +339,77 @@ class HarvestManUrl(object):
         except KeyError:
             pass
 
-        # Copy of myself, this will be saved if
-        # a re-resolving is requested so that old
-        # parameters can be requested if needed
-        self.orig_state = None
+    def get_baseurl(self):
+        """ Return the parent url object """
+
+        parent = self._parent
+        if type(parent) is weakref.ReferenceType:
+            parent = parent()
+        if parent is None and self._parentindex is not None and objects.datamgr:
+            # The parent is not in memory, or this object
+            # was loaded from a pickle.
+            parent = objects.datamgr.get_url(self._parentindex)
+        return parent
+
+    def set_baseurl(self, baseurl):
+        """ Set the parent url object """
+
+        # The parent is referred weakly, so that URL
+        # objects do not keep the chain of their parents
+        # in memory, or in their pickles.
+        if baseurl is None:
+            self._parent = self._parentindex = None
+        else:
+            self._parent = weakref.ref(baseurl)
+            self._parentindex = baseurl.index
+
+    baseurl = property(get_baseurl, set_baseurl)
+
+    def __getstate__(self):
+        """ Return the state of this object for pickling """
+
+        state = {}
+        for name in self.__slots__[:-1]:
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+
+        # Parents referred weakly are found by
+        # index, the others are pickled with
+        # this object.
+        if type(self._parent) is weakref.ReferenceType:
+            state['_parent'] = None
+        # Host ids are valid only in this process
+        state.pop('hostid', None)
+        if self._extra:
+            state['_extra'] = self._extra.copy()
+        return state
+
+    def __setstate__(self, state):
+        """ Set the state of this object from a pickle """
+
+        for name in self.__slots__[:-1]:
+            setattr(self, name, None)
+        self.absurl = ''
         
+        for name, value in state.items():
+            if name in extra_attrs:
+                # Pickled before the slots
+                if value is not None:
+                    setattr(self, name, value)
+            elif name in self.__slots__:
+                setattr(self, name, value)
+
+        # Pickled before the slots, with the parent
+        parent = state.get('baseurl')
+        if parent is not None:
+            self._parent = parent
+            self._parentindex = parent.index
+        if self._extra is not None:
+            self._extra = self._extra.copy()
+        self.hostid = hosts.host_id(self.domain or '')
+
     def reset(self):
         """ Reset all the key attributes """
 
@@ -266,14 +425,11 @@ class HarvestManUrl(object):
         self.isrels = False
         self.port = 80
         self.domain = ''
-        self.rpath = []
-        # Recursion depth
-        self.rdepth = 0
+        self.hostid = 0
         self.dirpath = []
         self.filename = 'index.html'
         self.validfilename = 'index.html'
-        # Set urlflag to False
-        self.urlflag = False
+        # Clear cached full url
         self.absurl = ''
 
     def __str__(self):
@@ -370,6 +526,8 @@ class HarvestManUrl(object):
         proto = self.resolve_protocol()
 
         paths = ''
+        # Relative path items and their count
+        rpath, rindex = [], 0
         
         if not proto:
             # Could not resolve protocol, must be a relative url
@@ -401,21 +559,20 @@ class HarvestManUrl(object):
             relpaths = self.reduce_url(relpaths)
 
             # Build relative path by checking for "." and ".." strings
-            self.rindex = 0
             for ritem in relpaths:
                 # If path item is ., .. or empty, increment
                 # relpath index.
                 if ritem in (DOT, DOTDOT, ""):
-                    self.rindex += 1
+                    rindex += 1
                     # If path item is not empty, insert
                     # to relpaths list.
                     if ritem:
-                        self.rpath.append(ritem)
+                        rpath.append(ritem)
 
                 else:
                     # Otherwise, add the rest to paths
                     # with the separator
-                    for entry in relpaths[self.rindex:]:
+                    for entry in relpaths[rindex:]:
                         paths = "".join((paths, entry, URLSEP))
 
                     # Remove the last entry
@@ -459,7 +616,7 @@ class HarvestManUrl(object):
                 
         # Now compute local directory/file paths
 
-        self.compute_dirpaths(paths)
+        self.compute_dirpaths(paths, rpath, rindex)
         if not self.protocol.startswith('file:'):
             self.compute_domain_and_port()
 
@@ -541,8 +698,11 @@ class HarvestManUrl(object):
         # Copy
         self.dirpath = dirpath2[:]
             
-    def compute_dirpaths(self, path):
-        """ Computer local file & directory paths for the url """
+    def compute_dirpaths(self, path, rpath, rindex):
+        """ Computer local file & directory paths for the url.
+        For relative urls, 'rpath' is the list of relative path
+        items (. and ..) and 'rindex' their count including
+        empty ones """
 
         self.dirpath = path.split(URLSEP)
         self.lastpath = self.dirpath[-1]
@@ -554,13 +714,13 @@ class HarvestManUrl(object):
             # Otherwise, the url is a plain domain
             # path like www.python.org .
             self.compute_file_and_dir_paths()
-            # print 'Rpath=>',self.rpath
+            # print 'Rpath=>',rpath
             
             # Interprets relative path
             # ../../. Nonsense relative paths are graciously ignored,
-            self.rpath.reverse()
+            rpath.reverse()
             # print 'Base url dirpath=>',self.baseurl.dirpath
-            # print 'Rindex=>',self.rindex
+            # print 'Rindex=>',rindex
 
             # This simple logic is fine for most paths except
             # when a base URL has a "?" as part of its dirpath.
@@ -572,13 +732,13 @@ class HarvestManUrl(object):
                 qindex = self.baseurl.dirpath.index('?')
                 self.baseurl.dirpath = self.baseurl.dirpath[:qindex]
             
-            if len(self.rpath) == 0 :
-                if not self.rindex:
+            if len(rpath) == 0 :
+                if not rindex:
                     self.dirpath = self.baseurl.dirpath + self.dirpath
             else:
                 pathstack = self.baseurl.dirpath[0:]
 
-                for ritem in self.rpath:
+                for ritem in rpath:
                     if ritem == DOT:
                         pathstack = self.baseurl.dirpath[0:]
                     elif ritem == DOTDOT:
@@ -646,9 +806,13 @@ class HarvestManUrl(object):
             
             self.port = self.baseurl.port
 
-        # Convert domain to lower case
+        # Convert domain to lower case. The domain
+        # string is interned since it is the same for
+        # many URLs (protocol strings are shared already,
+        # being the keys of protocol_map).
         if self.domain != '':
-            self.domain = self.domain.lower()
+            self.domain = intern_string(self.domain.lower())
+        self.hostid = hosts.host_id(self.domain)
         
     def make_valid_filename(self, s):
         """ Replace junk characters to create a valid filename """
@@ -673,26 +837,7 @@ class HarvestManUrl(object):
     def make_valid_url(self, url):
         """ Make a valid url """
 
-        for x,y in itertools.izip(dirty_chars, dirty_chars_repl):
-            if x in url:
-                url = url.replace(x, y)
-
-        # Replace spaces between words
-        # with '%20'.
-        # For example http://www.foo.com/bar/this file.html
-        # Fix: Use regex instead of blind
-        # replacement.
-        if wspacere.search(url):
-            url = re.sub(r'\s', '%20', url)
-        
-        # Replace all % chars with their capital counterparts
-        # i.e %3a => %3A, %5b => %5B etc. This helps in
-        # canonicalization.
-        percent_chars = percent_repl.findall(url)
-        for pchar in percent_chars:
-            url = url.replace(pchar, pchar.upper())
-            
-        return url
+        return valid_url(url)
 
     def is_filename_url(self):
         """ Return whether this is file name url """
@@ -897,7 +1042,7 @@ class HarvestManUrl(object):
     def get_url_content_info(self):
         """ Get the url content information """
         
-        return self.contentdict
+        return self.contentdict or {}
     
     def get_anchor(self):
         """ Return the anchor tag of this url """
@@ -1025,33 +1170,13 @@ class HarvestManUrl(object):
         # Doing 9, 10,11 and 12 and specifically. 
 
         # Get full url first...
-        url = self.get_full_url()
-        params = params_re.findall(url)
-        lp = len(params)
-        if lp>1:
-            # Rule#11: Remove those params which are using a default value
-            # i.e which does not specify a value.
-            params = [param for param in params if param_re.match(param)]
-            # More than one param, sort it
-            params.sort()
-            url_sans_params = ampersand_re.sub('', params_re.sub('', url))
-            # Now put the params back in sorted order
-            url = url_sans_params + '&'.join(params)
-        elif lp==0:
-            # If no params but there is a ? at end, rule 12 applies
-            # Remove trailing ? at the end
-            url = question_re.sub('', url)
-
-        # Finally we strip off the www. from the beginning of the URL
-        url = www2_re.sub('', url)
-
-        return url
+        return canonical_url(self.get_full_url())
         
     def get_full_url(self):
         """ Return the full url path of this url object after
         resolving relative paths, filenames etc """
 
-        if self.urlflag:
+        if self.absurl:
             return self.absurl
         else:
             rval = ''
@@ -1080,7 +1205,6 @@ class HarvestManUrl(object):
 
                 return self.protocol + rval
             
-            self.urlflag = True
             self.absurl = self.make_valid_url(rval)
 
             return self.absurl
@@ -1464,7 +1588,7 @@ class HarvestManUrl(object):
         if (not self.dirpath and self.lastpath != self.domain) or (self.dirpath and (self.dirpath[-1] != self.lastpath)):
             self.dirpath.append(self.lastpath)
         self.validfilename = 'index.html'
-        self.urlflag = False
+        self.absurl = ''
         
     def set_url_content_info(self, headers):
         """ This function sets the url content information of this
@@ -1573,19 +1697,213 @@ class HarvestManUrl(object):
         doc.keywords = keywords[:]
         doc.description = description
         doc.content_hash = self.pagehash
-        doc.headers = self.contentdict.copy()
+        headers = self.get_url_content_info()
+        doc.headers = headers.copy()
         for child in children:
             doc.add_child(child)
         
-        doc.lastmodified = self.contentdict.get('last-modified','')
-        doc.etag = self.contentdict.get('etag','')
-        doc.content_type = self.contentdict.get('content-type','')
-        doc.content_encoding = self.contentdict.get('content-encoding','plain')
+        doc.lastmodified = headers.get('last-modified','')
+        doc.etag = headers.get('etag','')
+        doc.content_type = headers.get('content-type','')
+        doc.content_encoding = headers.get('content-encoding','plain')
         return doc
     
     # ============ End - Set Methods =========== #
 
 
+class HarvestManLinkCache(object):
+    """ LRU cache of the links resolved by HarvestManUrl,
+    for finding links which were seen before without
+    creating URL objects for them """
+
+    # The same links, such as those of navigation bars, are
+    # found in many pages of a site. A relative link resolves
+    # to the same URL from all pages in the same directory, so
+    # the cache is keyed by the directory URL of the page, the
+    # link and the url type. The value is a tuple of the
+    # canonical URL and index of the URL.
+    
+    def __init__(self, size):
+        self.size = size
+        self._lru = LRU(size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def base_key(self, base):
+        """ Return the part of the key for links found in the
+        page of the url object 'base' """
+
+        # Relative links are resolved using the protocol,
+        # domain, port and directory path of the base url
+        return base.get_full_domain_with_port() + base.get_url_directory_sans_domain()
+
+    def get(self, basekey, link, typ):
+        """ Return a tuple of the canonical URL and index of
+        the url for 'link' of type 'typ' found in a page
+        with the key 'basekey', or None if not cached """
+
+        # Anchor links resolve to the url of the page itself
+        # so they are not the same for any two pages
+        if not self.size or typ == URL_TYPE_ANCHOR:
+            return None
+
+        self._lock.acquire()
+        try:
+            try:
+                value = self._lru[(basekey, link, typ)]
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+                return None
+        finally:
+            self._lock.release()
+
+    def put(self, basekey, link, typ, urlobj):
+        """ Cache the url object or link record 'urlobj'
+        resolved for 'link' of type 'typ' found in a page with
+        the key 'basekey' """
+
+        if not self.size or typ == URL_TYPE_ANCHOR:
+            return
+
+        self._lock.acquire()
+        try:
+            self._lru[(basekey, link, typ)] = (urlobj.get_canonical_url(), urlobj.index)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lru = LRU(self.size)
+
+    def get_stats(self):
+        """ Return a tuple of the number of hits and misses """
+
+        return (self.hits, self.misses)
+
+# Links resolved by resolve_links without a url object. These
+# are plain relative paths and absolute http, https or ftp URLs
+# without a port, whose resolution is a concatenation of strings.
+simple_link_re = re.compile(r'^[A-Za-z0-9_\-./~?&=+,]+$')
+simple_absolute_re = re.compile(r'^(http://|https://|ftp://)([A-Za-z0-9][A-Za-z0-9.\-]*)(/[A-Za-z0-9_\-./~?&=+,]*)?$')
+
+def is_simple_path(path):
+    """ Return whether the url path 'path' is resolved by
+    HarvestManUrl to itself """
+
+    if '//' in path or '/.' in (URLSEP + path):
+        # Empty path items, or . and .. items
+        return False
+    qindex = path.find('?')
+    if qindex != -1 and URLSEP in path[qindex:]:
+        return False
+    
+    lastpath = path[path.rfind(URLSEP)+1:]
+    if lastpath:
+        # The last item should be a file name as decided by
+        # compute_file_and_dir_paths, without a directory
+        # extension
+        dotindex = lastpath.find(DOT)
+        if dotindex == len(lastpath) - 1:
+            return False
+        extn = os.path.splitext(lastpath.replace('?', ''))[1].lower()
+        if extn in default_directory_extns:
+            return False
+
+    return True
+        
+class HarvestManLinkRecord(object):
+    """ A link of a page resolved by resolve_links """
+
+    __slots__ = ('typ', 'link', 'cgi', 'base', 'canonical', 'index', 'urlobj', 'error')
+
+    def __init__(self, typ, link, cgi, base):
+        self.typ = typ
+        self.link = link
+        self.cgi = cgi
+        self.base = base
+        self.canonical = ''
+        self.index = 0
+        # Url object, if created
+        self.urlobj = None
+        # Error in resolving the link
+        self.error = None
+
+    def get_canonical_url(self):
+        return self.canonical
+
+    def get_url_object(self):
+        """ Return the url object of this link, creating it
+        if not done yet """
+
+        if self.urlobj is None:
+            self.urlobj = HarvestManUrl(self.link, self.typ, self.cgi, self.base)
+        # The index could have been changed by
+        # the data manager
+        self.urlobj.index = self.index
+        return self.urlobj
+        
+def resolve_links(base, links):
+    """ Resolve the links of the page with url object 'base'.
+    'links' is a list of (type, link, cgi) tuples. Returns a
+    list of HarvestManLinkRecord objects with the canonical
+    URL and index of every link """
+
+    # Creating a url object for every link of a page takes most
+    # of the time of parsing it, while most links lead to URLs
+    # which are known already. So for the simple links, the URL
+    # is found by joining the link to the directory URL of the
+    # page, and url objects are created only for new URLs. The
+    # other links are resolved with url objects as before.
+
+    # The parts of the page URL shared by its links
+    prefix, dirprefix = '', ''
+    if base.protocol in ('http://', 'https://', 'ftp://') and '?' not in base.dirpath:
+        # The same as for get_full_url of a relative url
+        prefix = base.get_full_domain_with_port()
+        dirprefix = "".join([prefix, URLSEP] + [x+URLSEP for x in base.dirpath if x and not x[-1]==URLSEP])
+        
+    hashes = HarvestManUrl.hashes
+    records = []
+
+    for typ, link, cgi in links:
+        record = HarvestManLinkRecord(typ, link, cgi, base)
+        records.append(record)
+        
+        url = ''
+        if not typ == URL_TYPE_ANCHOR:
+            m = simple_absolute_re.match(link)
+            if m:
+                protocol, domain, path = m.groups()
+                path = path or URLSEP
+                if is_simple_path(path):
+                    url = "".join((protocol, domain.lower(), path))
+            elif prefix and simple_link_re.match(link) and is_simple_path(link):
+                lower = link.lower()
+                if not www_re.match(lower) and not lower.startswith('ftp.'):
+                    if link[0] == URLSEP:
+                        url = prefix + link
+                    else:
+                        url = dirprefix + link
+
+        if url:
+            record.canonical = canonical_url(valid_url(url))
+            record.index = url_fingerprint(record.canonical)
+            if record.index in hashes:
+                record.index = 0
+        else:
+            try:
+                urlobj = HarvestManUrl(link, typ, cgi, base)
+                record.urlobj = urlobj
+                record.canonical = urlobj.get_canonical_url()
+                record.index = urlobj.index
+            except HarvestManUrlError, e:
+                record.error = e
+
+    return records
+
+
 def test():
     
     # Test code
@@ -26,7 +26,8 @@
 __version__ = '2.0 b1'
 __author__ = 'Anand B Pillai'
 
-import bisect
+import heapq
+import itertools
 import time
 import threading
 import sys, os
@@ -44,11 +45,80 @@ from harvestman.lib import urltypes
 from harvestman.lib.common.common import *
 from harvestman.lib.common.macros import *
 from harvestman.lib.common.singleton import Singleton
+from harvestman.lib.common.seglog import SegmentLog
+from harvestman.lib.checkpoint import journal
+
+# Names of states in which a thread counts as idle for
+# the end condition of a regular crawl...
+IDLE_STATES = frozenset(('PERM_EXCEPT','FETCHER_WAITING','CRAWLER_WAITING',
+                         'THREAD_DIED', 'THREAD_STOPPED'))
+# ...and in which it counts as stopped for an abnormal exit
+STOPPED_STATES = frozenset(('PERM_EXCEPT','THREAD_STOPPED','THREAD_SLEEPING'))
+# States in which a thread is waiting for work, for
+# measuring thread utilisation
+WAITING_STATES = frozenset(('FETCHER_WAITING','CRAWLER_WAITING'))
+# Transitions to these states can bring about the end state
+# or the exit state, so waiters are signalled on them.
+ENDING_STATES = IDLE_STATES | STOPPED_STATES
+
+class HarvestManThreadSlot(object):
+    """ State slot of a single tracker thread. A slot is
+    normally updated only by its own thread, the lock is
+    for the rare case of another thread setting its state
+    (such as when the thread is stopped) """
+
+    __slots__ = ('state', 'role', 'lock', 'born', 'since', 'ended', 'idle')
+
+    def __init__(self, role):
+        self.state = None
+        self.role = role
+        self.lock = threading.Lock()
+        # Time when the thread started running
+        self.born = None
+        # Time of the last state transition
+        self.since = time.time()
+        # Time when the thread stopped
+        self.ended = None
+        # Total time spent waiting for work
+        self.idle = 0.0
+
+    def transition(self, curr, state):
+        """ Update the timings for a change of state
+        from 'curr' to 'state' """
+
+        now = time.time()
+        if curr is not None and curr.__name__ in WAITING_STATES:
+            self.idle += now - self.since
+        self.since = now
+        
+        name = state.__name__
+        if name == 'THREAD_STARTED':
+            if self.born is None: self.born = now
+        elif name in ('THREAD_STOPPED', 'THREAD_DIED'):
+            if self.ended is None: self.ended = now
+
+    def get_times(self, now):
+        """ Return a tuple of the running time and the
+        time spent waiting for work of the thread """
+
+        if self.born is None:
+            return 0.0, 0.0
+        end = self.ended or now
+        idle = self.idle
+        if not self.ended and self.state.__name__ in WAITING_STATES:
+            idle += now - self.since
+        return end - self.born, idle
 
 class HarvestManCrawlerState(Singleton):
     """ State machine for signalling crawler end condition
     and for managing end-condition stalemates and other
-    issues """
+    issues.
+
+    Every thread keeps its state in its own slot. The number
+    of idle and stopped threads and the push/get counts are
+    kept in counters which are updated on state transitions,
+    so setting a state does not take a global lock and the
+    end-state checks do not have to scan the threads """
 
     def __init__(self, queue):
         self.reset()
@@ -56,7 +126,12 @@ class HarvestManCrawlerState(Singleton):
         self.queue = queue
 
     def reset(self):
-        self.ts = {}
+        # Thread slots indexed by thread name
+        self.slots = {}
+        # Number of threads in an idle state
+        self.nidle = AtomicCounter()
+        # Number of threads in a stopped state
+        self.nstopped = AtomicCounter()
         # Flags
         # All threads blocked (waiting)
         self.blocked = False
@@ -65,17 +140,17 @@ class HarvestManCrawlerState(Singleton):
         # All crawlers blocked (waiting)
         self.cblocked = False
         # Crawler thread transitions
-        self.ctrans = 0
+        self.ctrans = AtomicCounter()
         # Fetcher thread transitions
-        self.ftrans = 0
+        self.ftrans = AtomicCounter()
         # Pushes by fetcher
-        self.fpush = 0
+        self.fpush = AtomicCounter()
         # Pushes by crawler
-        self.cpush = 0
+        self.cpush = AtomicCounter()
         # Gets by fetcher
-        self.fgets = 0
+        self.fgets = AtomicCounter()
         # Gets by crawler
-        self.cgets = 0
+        self.cgets = AtomicCounter()
         # Number of crawlers
         self.numcrawlers = 0
         # Number of fetchers
@@ -91,22 +166,75 @@ class HarvestManCrawlerState(Singleton):
         self.blkcnt = 0
         self.lastcheck = time.time()
         
-    def set(self, thread, state):
+    def set(self, thread, state, count=1):
+        """ Set the state of a thread. The 'count' argument
+        is the number of items pushed or got, for the push
+        and get states """
+
+        name = thread.getName()
+        slot = self.slots.get(name)
+        if slot is None:
+            # setdefault is atomic, so a racing thread
+            # cannot replace the slot we get here.
+            slot = self.slots.setdefault(name, HarvestManThreadSlot(thread._role))
+
+        slot.lock.acquire()
+        try:
+            curr = slot.state
+            if curr != state:
+                # print 'Thread %s changes from state %s to state %s' % (thread, curr, state)
+                if curr is not None:
+                    self.update_counts(curr.__name__, -1)
+
+                if state == crawler.THREAD_DIED:
+                    # Dead threads do not take part
+                    # in the end condition anymore
+                    if self.slots.get(name) is slot:
+                        del self.slots[name]
+                else:
+                    self.update_counts(state.__name__, 1)
+                    
+                slot.transition(curr, state)
+                slot.state = state
+        finally:
+            slot.lock.release()
 
-        curr, role = None, None
-        item = self.get(thread)
-        if item:
-            curr, role = item
-            
-        if curr != state:
-            # print 'Thread %s changes from state %s to state %s' % (thread, curr, state)
-            self.ts[thread.getName()] = state, thread._role
+        self.state_callback(thread, state, count)
+
+        if state.__name__ in ENDING_STATES:
+            nthreads = len(self.slots)
+            if self.nidle.value==nthreads or self.nstopped.value==nthreads:
+                # All threads idle or stopped, wake up
+                # anyone waiting for the end.
+                self.notify()
 
-        self.state_callback(thread, state)
+    def update_counts(self, statename, n):
+        """ Update the idle and stopped counts for a thread
+        leaving (n=-1) or entering (n=1) the given state """
 
+        if statename in IDLE_STATES:
+            self.nidle.add(n)
+        if statename in STOPPED_STATES:
+            self.nstopped.add(n)
+        
     def get(self, thread):
-        return self.ts.get(thread.getName())
+        slot = self.slots.get(thread.getName())
+        if slot is not None:
+            return slot.state, slot.role
 
+    def add_threads(self, fetchers=0, crawlers=0):
+        """ Add to the counts of fetcher and crawler threads.
+        The counts are changed by the queue manager and by the
+        state callback in different threads, so this is done
+        holding the state lock """
+
+        self.cond.acquire()
+        try:
+            self.numfetchers += fetchers
+            self.numcrawlers += crawlers
+        finally:
+            self.cond.release()
+        
     def zero_thread(self):
         """ Function which returns whether any of the
         thread counts (fetcher/crawler) have gone to zero """
@@ -125,10 +253,9 @@ class HarvestManCrawlerState(Singleton):
 
         self.st = None
         
-    def state_callback(self, thread, state):
+    def state_callback(self, thread, state, count=1):
         """ Callbacks for taking action according to state transitions """
 
-        self.cond.acquire()
         typ = thread._role
         
         if state == crawler.THREAD_STARTED:
@@ -142,64 +269,79 @@ class HarvestManCrawlerState(Singleton):
             # Don't try to regenerate threads if this is a local exception.
             e = thread.exception
             logconsole("Thread died due to exception => ", str(e))
-            # See class for last error. If it is same as
-            # this error, don't do anything since this could
-            # be a programming error and will send us into
-            # a loop...
-            #if str(thread.__class__._lasterror) == str(e):
-            #    debug('Looks like a repeating error, not trying to restart thread %s' % (str(thread)))
             # In this case the thread has died, so reduce local thread count
             if typ=='crawler':
-                self.numcrawlers -= 1
+                self.add_threads(crawlers=-1)
             elif typ == 'fetcher':
-                self.numfetchers -= 1
-                
-            del self.ts[thread.getName()]
-            #else:
-            #    thread.__class__._lasterror = e
-            #    # Release the lock now!
-            #    self.cond.release()
-            #    # Set suspend flag
-            #    self.suspend()
-            #    
-            #    del self.ts[thread]
-            #    extrainfo('Tracker thread %s has died due to error: %s' % (str(thread), str(e)))
-            #    self.queue.dead_thread_callback(thread)
-            #    return
+                self.add_threads(fetchers=-1)
             
         elif state == crawler.FETCHER_PUSHED_URL:
             # Push count for fetcher threads
-            self.fpush += 1
+            self.fpush.add(count)
         elif state == crawler.CRAWLER_PUSHED_URL:            
             # Push count for fetcher threads
-            self.cpush += 1
+            self.cpush.add(count)
         elif state == crawler.FETCHER_GOT_DATA:
             # Get count for fetcher threads
-            self.fgets += 1
+            self.fgets.add(count)
         elif state == crawler.CRAWLER_GOT_DATA:
             # Get count for fetcher threads
-            self.cgets += 1            
+            self.cgets.add(count)
         elif state == crawler.THREAD_SLEEPING:
             # A sleep state can be achieved only after a work state
             # so this indicates a cycle of transitions since
             # a cycle ends with a sleep...
             if typ == 'crawler':
                 # Transition count for crawler threads                
-                self.ctrans += 1
+                self.ctrans.add()
             elif typ == 'fetcher':
                 # Transition count for crawler threads                
-                self.ftrans += 1                
+                self.ftrans.add()
+
+
+    def get_role_stats(self):
+        """ Return a dictionary mapping each role to a tuple of
+        (number of threads, utilisation). Utilisation is the
+        fraction of their running time the threads of a role
+        spent not waiting for work """
+
+        now = time.time()
+        stats = {}
+        for slot in self.slots.values():
+            run, idle = slot.get_times(now)
+            if slot.born is None: continue
+            nthreads, tot, totidle = stats.get(slot.role, (0, 0.0, 0.0))
+            stats[slot.role] = (nthreads + 1, tot + run, totidle + idle)
+
+        for role, (nthreads, tot, totidle) in stats.items():
+            if tot>0:
+                stats[role] = (nthreads, 1.0 - totidle/tot)
+            else:
+                stats[role] = (nthreads, 0.0)
                 
-        elif state in (crawler.FETCHER_WAITING, crawler.CRAWLER_WAITING):
-            if self.end_state():
-                # This is useful only if the waiter is waiting
-                # using wait1(...) method. If he is waiting
-                # using wait2(...) method, he needs to devise
-                # his own wake-up logic.
-                self.cond.notify()
-
-        self.cond.release()
+        return stats
+
+    def get_waiting_counts(self):
+        """ Return a tuple of the number of fetchers and
+        crawlers which are waiting for work now """
+
+        nfetchers, ncrawlers = 0, 0
+        for slot in self.slots.values():
+            if slot.ended is not None: continue
+            state = slot.state
+            if state == crawler.FETCHER_WAITING:
+                nfetchers += 1
+            elif state == crawler.CRAWLER_WAITING:
+                ncrawlers += 1
+
+        return nfetchers, ncrawlers
+    
+    def counts(self):
+        """ Return a tuple of the push and get counts """
 
+        return (self.fpush.value, self.cgets.value,
+                self.cpush.value, self.fgets.value)
+    
     def all_are_waiting(self):
         """ This method returns whether the threads are all starved for
         data during regular crawl, which signals an end condition for the
@@ -219,15 +361,22 @@ class HarvestManCrawlerState(Singleton):
             self.abortmsg = "Fatal thread reduction, stopping program"
             return True
 
-        for status, role in self.ts.values():
-            if status.__name__ not in ('PERM_EXCEPT','FETCHER_WAITING','CRAWLER_WAITING','THREAD_DIED', 'THREAD_STOPPED'):
-                return False
-        
-        #if self.queue.url_q.qsize() or self.queue.data_q.qsize():
-        #    return False
+        # Every item pushed should have been got...
+        counts = self.counts()
+        fpush, cgets, cpush, fgets = counts
+        if fpush != cgets or cpush != fgets:
+            return False
+
+        # ...by threads which are all idle now...
+        if self.nidle.value != len(self.slots):
+            return False
 
-        return ((self.fpush == self.cgets) and \
-               (self.cpush == self.fgets))
+        # ...and nothing was pushed or got while we
+        # were checking. Since a thread stays active
+        # till its push or get is counted, this makes
+        # sure that the two checks above saw the same
+        # quiescent state.
+        return self.counts() == counts
 
     def all_have_stopped(self):
         """ This method returns whether the threads are all stopped
@@ -238,11 +387,7 @@ class HarvestManCrawlerState(Singleton):
             self.abortmsg = "Fatal thread reduction, stopping program"
             return True
 
-        for status, role in self.ts.values():
-            if status.__name__ not in ('PERM_EXCEPT','THREAD_STOPPED','THREAD_SLEEPING'):
-                return False
-        
-        return True
+        return self.nstopped.value == len(self.slots)
 
     def end_state(self):
         """ Check end state for the program. Returns True
@@ -333,8 +478,49 @@ class HarvestManCrawlerState(Singleton):
 ##         return False
 
     def __str__(self):
-        return str(self.ts)
+        return str(dict([(name, (slot.state, slot.role)) for name, slot in self.slots.items()]))
+
+    def notify(self):
+        """ Wake up all threads waiting on the state machine """
+
+        self.cond.acquire()
+        try:
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
+    def wait_for(self, predicate, timeout=None, poll=1.0):
+        """ Wait till predicate() returns True or till 'timeout'
+        seconds have passed, and return the last value of
+        predicate(). Threads notify the state machine on the
+        transitions which can bring about the end or exit
+        state, so the wait ends as soon as such a state is
+        reached. The predicate is also checked every 'poll'
+        seconds, for conditions which come about without a
+        transition, such as an expiring suspend """
+
+        if timeout is not None:
+            endtime = time.time() + timeout
+            
+        self.cond.acquire()
+        try:
+            while True:
+                ret = predicate()
+                if ret: break
+                
+                waittime = poll
+                if timeout is not None:
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        break
+                    waittime = min(waittime, remaining)
+                    
+                self.cond.wait(waittime)
+        finally:
+            self.cond.release()
+
+        return ret
+    
     def wait1(self, timeout):
         """ Regular wait method. This should be typically
         called with a large timeout value """
@@ -363,39 +549,825 @@ class HarvestManCrawlerState(Singleton):
             pass
         
 class PriorityQueue(Queue):
-    """ Priority queue based on bisect module (courtesy: Effbot) """
-
-    def __init__(self, maxsize=0):
+    """ Priority queue based on the heapq module. Items are
+    tuples whose first member is the priority. Each entry is
+    stamped with a monotonic sequence number, so items with
+    the same priority come out in insertion (FIFO) order and
+    the rest of the tuple (URL objects, collections etc) is
+    never compared.
+
+    If a 'key' function is given, queued items can be looked
+    up by key and their priority changed by reprioritize """
+
+    def __init__(self, maxsize=0, key=None):
+        self.key = key
         Queue.__init__(self, maxsize)
 
     def _init(self, maxsize):
         self.maxsize = maxsize
         self.queue = []
-        
+        # Sequence counter for tie-breaking
+        self.seq = itertools.count()
+        # Count of items per priority value
+        self.buckets = {}
+        # Heap entries by key of their item
+        self.entries = {}
+        # Number of stale entries in the heap
+        self.nstale = 0
+        # Flag set by interrupt()
+        self.interrupted = False
+
     def _put(self, item):
-        bisect.insort(self.queue, item)
+        prio = item[0]
+        entry = [prio, self.seq.next(), item]
+        heapq.heappush(self.queue, entry)
+        self.buckets[prio] = self.buckets.get(prio, 0) + 1
+        if self.key:
+            self.entries[self.key(item)] = entry
 
     def __len__(self):
         return self.qsize()
-    
+
     def _qsize(self):
-        return len(self.queue)
+        return len(self.queue) - self.nstale
 
     def _empty(self):
-        return not self.queue
+        return not self._qsize()
 
     def _full(self):
-        return self.maxsize>0 and len(self.queue) == self.maxsize
+        return self.maxsize>0 and self._qsize() >= self.maxsize
 
     def _get(self):
-        return self.queue.pop(0)    
+        while True:
+            entry = heapq.heappop(self.queue)
+            if entry[2] is not None: break
+            # Replaced by reprioritize
+            self.nstale -= 1
+
+        prio, seq, item = entry
+        count = self.buckets[prio] - 1
+        if count:
+            self.buckets[prio] = count
+        else:
+            del self.buckets[prio]
+
+        if self.key:
+            key = self.key(item)
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+            
+        return item
+
+    def put_many(self, items):
+        """ Put as many of 'items' as there is room for,
+        taking the lock only once. Never blocks. Returns
+        the number of items put """
+
+        self.not_full.acquire()
+        try:
+            count = 0
+            for item in items:
+                if self._full(): break
+                self._put(item)
+                count += 1
+            if count:
+                self.unfinished_tasks += count
+                self.not_empty.notifyAll()
+            return count
+        finally:
+            self.not_full.release()
+
+    def get_many(self, n, block=True, timeout=None):
+        """ Remove and return a list of at most 'n' items,
+        taking the lock only once. Waits for the first item
+        and raises Empty under the same conditions as get """
+
+        self.not_empty.acquire()
+        try:
+            if not block:
+                if not self._qsize():
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize():
+                    if self.interrupted:
+                        raise Empty
+                    self.not_empty.wait()
+            else:
+                endtime = time.time() + timeout
+                while not self._qsize():
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0 or self.interrupted:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+
+            items = []
+            while self._qsize() and len(items)<n:
+                items.append(self._get())
+            self.not_full.notifyAll()
+            return items
+        finally:
+            self.not_empty.release()
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, block, timeout)[0]
+
+    def reprioritize(self, deltas):
+        """ Add to the priority of queued items. 'deltas' is
+        a dictionary mapping item keys to the value to add.
+        Keys of items not in the queue are ignored. Returns
+        the list of the updated items """
+
+        if not self.key: return []
+        
+        self.mutex.acquire()
+        try:
+            items = []
+            for key, delta in deltas.iteritems():
+                entry = self.entries.get(key)
+                if entry is None or not delta: continue
+
+                prio, seq, item = entry
+                newprio = prio + delta
+                item = (newprio,) + item[1:]
+                # The old entry is left in the heap marked stale,
+                # the new one keeps its sequence number so that
+                # FIFO order among equal priorities holds.
+                entry[2] = None
+                self.nstale += 1
+                entry = [newprio, seq, item]
+                heapq.heappush(self.queue, entry)
+                self.entries[key] = entry
+
+                count = self.buckets[prio] - 1
+                if count:
+                    self.buckets[prio] = count
+                else:
+                    del self.buckets[prio]
+                self.buckets[newprio] = self.buckets.get(newprio, 0) + 1
+                items.append(item)
+
+            # Drop stale entries once they are the majority
+            if self.nstale > len(self.queue)/2:
+                self.queue = [entry for entry in self.queue if entry[2] is not None]
+                heapq.heapify(self.queue)
+                self.nstale = 0
+                
+            return items
+        finally:
+            self.mutex.release()
+        
+    def interrupt(self):
+        """ Wake up all threads waiting to get items. Waiting
+        and blocking gets raise Empty on an empty queue till
+        the queue is cleared """
+
+        self.mutex.acquire()
+        try:
+            self.interrupted = True
+            self.not_empty.notifyAll()
+        finally:
+            self.mutex.release()
 
     def clear(self):
-        while True:
-            try:
-                self.queue.pop()
-            except IndexError:
-                break
+        """ Remove all items from the queue """
+
+        self.mutex.acquire()
+        try:
+            self.queue = []
+            self.buckets.clear()
+            self.entries.clear()
+            self.nstale = 0
+            self.interrupted = False
+            self.not_full.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def bucket_counts(self):
+        """ Return a dictionary mapping each priority
+        to the number of queued items having it """
+
+        self.mutex.acquire()
+        try:
+            return self.buckets.copy()
+        finally:
+            self.mutex.release()
+
+class HarvestManHostFrontier(object):
+    """ A politeness aware URL frontier modelled on the back
+    queues of the Mercator crawler. Every host gets its own
+    priority queue of URLs and a heap of (ready-time, host)
+    entries decides which host may be fetched next. Once
+    a URL is handed out for a host, that host is not ready
+    again till 'delay' seconds after its fetch is reported
+    done with mark_done, so a fetch to a server starts no
+    sooner than that after the last one ended, however long
+    the URL waited in the batch of a fetcher. A host whose
+    fetch is not reported done is ready again 'holdtime'
+    seconds after it was handed out.
+
+    This class is a drop-in replacement for PriorityQueue as
+    the url queue. Items are (priority, url object) tuples.
+    Priorities apply among the URLs of the same host """
+
+    def __init__(self, maxsize=0, delay=1.0, key=None, holdtime=300.0):
+        self.maxsize = maxsize
+        self.delay = delay
+        self.key = key
+        self.holdtime = holdtime
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.seq = itertools.count()
+        self._init()
+
+    def _init(self):
+        # Back queues indexed by host
+        self.hostqueues = {}
+        # Heap of (ready time, host) for hosts
+        # which have URLs in their back queue.
+        # Entries whose time is not the one in
+        # 'scheduled' for their host are stale.
+        self.ready = []
+        self.scheduled = {}
+        # Time before which a host which has
+        # no queued URLs may not be fetched
+        self.nexttime = {}
+        # Hosts with a URL out for fetching, mapped
+        # to the time their hold runs out and the
+        # index of the URL
+        self.busy = {}
+        # Total number of queued items
+        self.count = 0
+        # Count of items per priority value
+        self.buckets = {}
+        # Heap entries by key of their item
+        self.entries = {}
+        # Number of stale entries in the back queues
+        self.nstale = 0
+        # Flag set by interrupt()
+        self.interrupted = False
+
+    def _host(self, item):
+        # Hosts are keyed by their id in the host table
+        # and port, which are cheaper to hash than names
+        url_obj = item[1]
+        return (url_obj.hostid, url_obj.port)
+
+    def _schedule(self, host, readytime):
+        # Replaces any earlier entry of the host
+        self.scheduled[host] = readytime
+        heapq.heappush(self.ready, (readytime, host))
+        self.not_empty.notify()
+
+    def _put(self, item):
+        prio = item[0]
+        host = self._host(item)
+        q = self.hostqueues.get(host)
+        if q is None:
+            q = self.hostqueues[host] = []
+        if not q:
+            # Host becomes active, schedule it. A busy
+            # host is scheduled again by mark_done.
+            if host in self.busy:
+                readytime = self.busy[host][0]
+            else:
+                readytime = self.nexttime.pop(host, 0)
+            self._schedule(host, readytime)
+
+        entry = [prio, self.seq.next(), item]
+        heapq.heappush(q, entry)
+        self.buckets[prio] = self.buckets.get(prio, 0) + 1
+        self.count += 1
+        if self.key:
+            self.entries[self.key(item)] = (host, entry)
+
+    def _pop(self, q):
+        """ Drop the stale entries from the top of a back queue """
+
+        while q and q[0][2] is None:
+            heapq.heappop(q)
+            self.nstale -= 1
+        
+    def _get(self, host, now):
+        q = self.hostqueues[host]
+        self._pop(q)
+        entry = heapq.heappop(q)
+        self._pop(q)
+        prio, seq, item = entry
+        # The host is not ready till the fetch of
+        # the URL is done, or its hold runs out
+        holdtime = now + self.holdtime
+        self.busy[host] = (holdtime, item[1].index)
+
+        if q:
+            self._schedule(host, holdtime)
+        else:
+            del self.hostqueues[host]
+            del self.scheduled[host]
+
+        count = self.buckets[prio] - 1
+        if count:
+            self.buckets[prio] = count
+        else:
+            del self.buckets[prio]
+        self.count -= 1
+
+        if self.key:
+            key = self.key(item)
+            if self.entries.get(key, (None, None))[1] is entry:
+                del self.entries[key]
+                
+        return item
+
+    def _full(self):
+        return self.maxsize>0 and self.count >= self.maxsize
+
+    def put(self, item, block=True, timeout=None):
+        """ Put an item into the frontier. Raises Full
+        under the same conditions as Queue.put """
+
+        self.not_full.acquire()
+        try:
+            if self._full():
+                if not block:
+                    raise Full
+                elif timeout is None:
+                    while self._full():
+                        self.not_full.wait()
+                else:
+                    endtime = time.time() + timeout
+                    while self._full():
+                        remaining = endtime - time.time()
+                        if remaining <= 0.0:
+                            raise Full
+                        self.not_full.wait(remaining)
+            self._put(item)
+        finally:
+            self.not_full.release()
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_many(self, items):
+        """ Put as many of 'items' as there is room for,
+        taking the lock only once. Never blocks. Returns
+        the number of items put """
+
+        self.not_full.acquire()
+        try:
+            count = 0
+            for item in items:
+                if self._full(): break
+                self._put(item)
+                count += 1
+            return count
+        finally:
+            self.not_full.release()
+
+    def get(self, block=True, timeout=None):
+        """ Return the next item from the host which
+        is ready earliest. Blocks till a host becomes
+        ready. Raises Empty under the same conditions
+        as Queue.get """
+
+        return self.get_many(1, block, timeout)[0]
+
+    def get_many(self, n, block=True, timeout=None):
+        """ Return a list of at most 'n' items from the
+        hosts which are ready, taking the lock only once.
+        At most one item is returned per host since a host
+        is not ready again till 'delay' seconds have passed.
+        Waits for the first item like get """
+
+        self.not_empty.acquire()
+        try:
+            if timeout is not None:
+                endtime = time.time() + timeout
+            while True:
+                now = time.time()
+                items = []
+                while self.ready and len(items)<n:
+                    readytime, host = self.ready[0]
+                    if self.scheduled.get(host) != readytime:
+                        heapq.heappop(self.ready)
+                        continue
+                    if readytime > now: break
+                    heapq.heappop(self.ready)
+                    items.append(self._get(host, now))
+
+                if items:
+                    self.not_full.notifyAll()
+                    return items
+                
+                if self.ready:
+                    waittime = self.ready[0][0] - now
+                else:
+                    waittime = None
+
+                if not block or self.interrupted:
+                    raise Empty
+                if timeout is not None:
+                    remaining = endtime - now
+                    if remaining <= 0.0:
+                        raise Empty
+                    if waittime is None or remaining < waittime:
+                        waittime = remaining
+
+                self.not_empty.wait(waittime)
+        finally:
+            self.not_empty.release()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def mark_done(self, url_obj):
+        """ Report that the fetch of 'url_obj', got from the
+        frontier, is done. Its host is ready again 'delay'
+        seconds from now """
+
+        host = (url_obj.hostid, url_obj.port)
+        
+        self.mutex.acquire()
+        try:
+            holdtime, index = self.busy.get(host, (None, None))
+            if index != url_obj.index: return
+
+            del self.busy[host]
+            readytime = time.time() + self.delay
+            if host in self.hostqueues:
+                self._schedule(host, readytime)
+            else:
+                self.nexttime[host] = readytime
+        finally:
+            self.mutex.release()
+            
+    def reprioritize(self, deltas):
+        """ Add to the priority of queued items. 'deltas' is
+        a dictionary mapping item keys to the value to add.
+        Keys of items not in the frontier are ignored. Returns
+        the list of the updated items """
+
+        if not self.key: return []
+        
+        self.mutex.acquire()
+        try:
+            items = []
+            for key, delta in deltas.iteritems():
+                host, entry = self.entries.get(key, (None, None))
+                if entry is None or not delta: continue
+
+                prio, seq, item = entry
+                newprio = prio + delta
+                item = (newprio,) + item[1:]
+                # Same as in PriorityQueue. The new entry goes
+                # to the same back queue, so a back queue which
+                # is not empty always has a live entry.
+                entry[2] = None
+                self.nstale += 1
+                entry = [newprio, seq, item]
+                q = self.hostqueues[host]
+                heapq.heappush(q, entry)
+                self._pop(q)
+                self.entries[key] = (host, entry)
+
+                count = self.buckets[prio] - 1
+                if count:
+                    self.buckets[prio] = count
+                else:
+                    del self.buckets[prio]
+                self.buckets[newprio] = self.buckets.get(newprio, 0) + 1
+                items.append(item)
+
+            # Drop stale entries once they are the majority
+            if self.nstale > self.count:
+                for q in self.hostqueues.values():
+                    q[:] = [entry for entry in q if entry[2] is not None]
+                    heapq.heapify(q)
+                self.nstale = 0
+                
+            return items
+        finally:
+            self.mutex.release()
+        
+    def qsize(self):
+        self.mutex.acquire()
+        try:
+            return self.count
+        finally:
+            self.mutex.release()
+
+    def __len__(self):
+        return self.qsize()
+
+    def empty(self):
+        return self.qsize()==0
+
+    def full(self):
+        self.mutex.acquire()
+        try:
+            return self._full()
+        finally:
+            self.mutex.release()
+
+    def interrupt(self):
+        """ Wake up all threads waiting to get items. Waiting
+        and blocking gets raise Empty when no host is ready,
+        till the frontier is cleared """
+
+        self.mutex.acquire()
+        try:
+            self.interrupted = True
+            self.not_empty.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def clear(self):
+        """ Remove all items from the frontier """
+
+        self.mutex.acquire()
+        try:
+            self._init()
+            self.not_full.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def bucket_counts(self):
+        """ Return a dictionary mapping each priority
+        to the number of queued items having it """
+
+        self.mutex.acquire()
+        try:
+            return self.buckets.copy()
+        finally:
+            self.mutex.release()
+
+    def host_counts(self):
+        """ Return a dictionary mapping each host
+        to the number of its queued items """
+
+        self.mutex.acquire()
+        try:
+            counts = {}
+            for q in self.hostqueues.itervalues():
+                live = [entry[2] for entry in q if entry[2] is not None]
+                if live:
+                    counts[live[0][1].get_full_domain_with_port()] = len(live)
+            return counts
+        finally:
+            self.mutex.release()
+
+class HarvestManSpillQueue(object):
+    """ A queue with a bounded in-memory head which overflows
+    into an append-only segment log on disk. Puts never block
+    and never drop items. Items which overflowed are moved back
+    to the in-memory queue in batches when it drains below its
+    low-water mark.
+
+    The in-memory queue can be a PriorityQueue or a
+    HarvestManHostFrontier. Priority order is kept among
+    items in memory. Spilled items are refilled in the order
+    in which they were spilled.
+
+    The optional 'dump' and 'load' functions convert an item
+    to the record written to disk and back again """
+
+    def __init__(self, memqueue, batch=500, tmpdir='', name='queue',
+                 dump=None, load=None):
+        self.q = memqueue
+        self.dump = dump
+        self.load = load
+        self.maxsize = memqueue.maxsize
+        # Number of items refilled at a time
+        self.batch = max(batch, 1)
+        # Refill when the in-memory queue
+        # drops to this many items
+        self.lowmark = self.maxsize/2
+        self.log = SegmentLog(tmpdir, 'hm-' + name)
+        self.lock = threading.Lock()
+        # Stats
+        self.spilled = 0
+        self.refilled = 0
+
+    def put(self, item, block=True, timeout=None):
+        """ Put an item, spilling it to disk if the
+        in-memory queue is full. Never raises Full """
+
+        self.lock.acquire()
+        try:
+            if not len(self.log):
+                try:
+                    self.q.put(item, False)
+                    return
+                except Full:
+                    pass
+
+            if self.dump: item = self.dump(item)
+            self.log.append(item)
+            self.spilled += 1
+        finally:
+            self.lock.release()
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_many(self, items):
+        """ Put all of 'items', spilling the ones which do
+        not fit in memory to disk. Returns the number of
+        items put, which is always len(items) """
+
+        self.lock.acquire()
+        try:
+            count = 0
+            if not len(self.log):
+                count = self.q.put_many(items)
+
+            rest = items[count:]
+            if rest:
+                if self.dump: rest = map(self.dump, rest)
+                self.log.extend(rest)
+                self.spilled += len(rest)
+            return len(items)
+        finally:
+            self.lock.release()
+
+    def refill(self):
+        """ Move a batch of spilled items back to the
+        in-memory queue, if it has room for them """
+
+        if not len(self.log):
+            return 0
+
+        self.lock.acquire()
+        try:
+            # Only gets can run in parallel and they
+            # only make room, so this is safe.
+            room = self.maxsize - self.q.qsize()
+            if room<=0:
+                return 0
+            items = self.log.pop(min(room, self.batch))
+            if self.load: items = map(self.load, items)
+            self.q.put_many(items)
+            self.refilled += len(items)
+            return len(items)
+        finally:
+            self.lock.release()
+
+    def get(self, block=True, timeout=None):
+        """ Get an item, refilling from disk first
+        if the in-memory queue is running low """
+
+        if len(self.log) and self.q.qsize()<=self.lowmark:
+            self.refill()
+
+        return self.q.get(block, timeout)
+
+    def get_many(self, n, block=True, timeout=None):
+        """ Get a list of at most 'n' items, refilling
+        from disk first if the in-memory queue is running
+        low """
+
+        if len(self.log) and self.q.qsize()<=self.lowmark:
+            self.refill()
+
+        return self.q.get_many(n, block, timeout)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self.q.qsize() + len(self.log)
+
+    def __len__(self):
+        return self.qsize()
+
+    def empty(self):
+        return self.qsize()==0
+
+    def full(self):
+        return False
+
+    def interrupt(self):
+        """ Wake up all threads waiting to get items """
+
+        self.q.interrupt()
+        
+    def clear(self):
+        """ Remove all items, in memory and on disk """
+
+        self.lock.acquire()
+        try:
+            self.q.clear()
+            self.log.clear()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """ Clear the queue and remove its disk files """
+
+        self.clear()
+        self.log.close()
+
+    def mark_done(self, url_obj):
+        """ Report that the fetch of 'url_obj' is done,
+        for a HarvestManHostFrontier in memory """
+
+        self.q.mark_done(url_obj)
+        
+    def reprioritize(self, deltas):
+        """ Add to the priority of queued items in memory.
+        Spilled items keep their priority till they are
+        refilled """
+
+        return self.q.reprioritize(deltas)
+    
+    def bucket_counts(self):
+        """ Return the per-priority counts of the
+        items in the in-memory queue """
+
+        return self.q.bucket_counts()
+
+    def get_stats(self):
+        """ Return a dictionary of spill statistics """
+
+        return {'spilled': self.spilled,
+                'refilled': self.refilled,
+                'ondisk': len(self.log)}
+
+class HarvestManThreadBalancer(threading.Thread):
+    """ A thread which adapts the ratio of fetcher and
+    crawler threads to the crawl. It samples the depth of
+    the url and data queues and the number of waiting
+    threads of each role. At the end of every period, if
+    the threads of one role were mostly waiting while the
+    queue feeding the other role had a backlog and its
+    threads were all busy, a thread is converted from the
+    first role to the second. A role never goes below its
+    configured minimum number of threads """
+
+    def __init__(self, queue, period=2.0, minfetchers=1, mincrawlers=1):
+        self.queue = queue
+        self.stateobj = queue.stateobj
+        self.period = period
+        self.minfetchers = max(minfetchers, 1)
+        self.mincrawlers = max(mincrawlers, 1)
+        # Samples per period
+        self.nsamples = 4
+        # Number of conversions done
+        self.conversions = 0
+        self._exitflag = False
+        self.evnt = threading.Event()
+        threading.Thread.__init__(self, None, None, 'HarvestMan Thread Balancer')
+
+    def sample(self):
+        """ Return a tuple of the url queue size, the data
+        queue size and the numbers of waiting fetchers and
+        crawlers """
+
+        nfetchers, ncrawlers = self.stateobj.get_waiting_counts()
+        return (self.queue.url_q.qsize(), self.queue.data_q.qsize(),
+                nfetchers, ncrawlers)
+
+    def decide(self, samples):
+        """ Return a tuple of (from role, to role) for the
+        conversion to do given the samples of the last
+        period, or None """
+
+        n = float(len(samples))
+        urlq, dataq, fwait, cwait = [sum(x)/n for x in zip(*samples)]
+        state = self.stateobj
+        
+        # Crawlers starving, fetchers overloaded
+        if cwait >= 1.0 and fwait < 0.5 and urlq > state.numfetchers:
+            if state.numcrawlers > self.mincrawlers:
+                return ('crawler', 'fetcher')
+        # Fetchers starving, crawlers overloaded
+        elif fwait >= 1.0 and cwait < 0.5 and dataq > state.numcrawlers:
+            if state.numfetchers > self.minfetchers:
+                return ('fetcher', 'crawler')
+
+        return None
+    
+    def run(self):
+        samples = []
+        while not self._exitflag:
+            self.evnt.wait(self.period/self.nsamples)
+            if self._exitflag: break
+            
+            samples.append(self.sample())
+            if len(samples) < self.nsamples:
+                continue
+
+            change = self.decide(samples)
+            samples = []
+            if change and self.queue.convert_thread(*change):
+                self.conversions += 1
+                extrainfo('Converted a %s thread to a %s thread' % change)
+            
+    def stop(self):
+        """ Stop this thread """
+
+        self._exitflag = True
+        self.evnt.set()
         
 class HarvestManCrawlerQueue(object):
     """ This class functions as the thread safe queue
@@ -410,6 +1382,7 @@ class HarvestManCrawlerQueue(object):
         
         self.basetracker = None
         self.controller = None 
+        self.balancer = None
         self.flag = 0
         self.pushes = 0
         self.lasttimestamp = time.time()
@@ -420,11 +1393,52 @@ class HarvestManCrawlerQueue(object):
         self.baseurl = None
         self.stateobj = HarvestManCrawlerState(self)
         self.configobj = objects.config
-        self.url_q = PriorityQueue(self.configobj.queuesize)
+        # URLs are looked up by index in the url queue
+        # for changing their priority by link rank
+        if self.configobj.linkrank:
+            key = lambda (prio, url): url.index
+        else:
+            key = None
+        if self.configobj.hostqueues:
+            # Per-host politeness frontier. A host whose fetch
+            # is not reported done is ready again once a
+            # download would have timed out.
+            self.url_q = HarvestManHostFrontier(self.configobj.queuesize,
+                                                self.configobj.hostdelay,
+                                                key, self.configobj.timeout)
+        else:
+            self.url_q = PriorityQueue(self.configobj.queuesize, key)
         self.data_q = PriorityQueue(self.configobj.queuesize)
+        # Whether the queues spill to disk. Puts to them never
+        # fail, so they are not retried and the threads do not
+        # fall back to their buffers. The retries and buffers
+        # are kept for bounded queues.
+        self.spill = bool(self.configobj.queuespill and self.configobj.queuesize)
+        if self.spill:
+            # Overflow to disk instead of blocking
+            # URL objects are spilled as their index so that the
+            # objects refilled are the ones in the URL database.
+            self.url_q = HarvestManSpillQueue(self.url_q, self.configobj.spillbatch,
+                                              name='urlq',
+                                              dump=lambda (prio, url): (prio, url.index),
+                                              load=lambda (prio, index): (prio, objects.datamgr.get_url(index)))
+            # Likewise url collections are spilled as the index of
+            # their source URL and refilled from the links database.
+            # Documents are not spilled, a page refilled is crawled
+            # without one, as when it is restored from a checkpoint.
+            self.data_q = HarvestManSpillQueue(self.data_q, self.configobj.spillbatch,
+                                               name='dataq',
+                                               dump=lambda (prio, coll, document): (prio, coll.getSourceURL()),
+                                               load=lambda (prio, index): (prio, objects.datamgr.get_links(index), None))
             
         # Local buffer
         self.buffer = []
+        # Priority and generation of URLs pushed to the
+        # url queue and not fetched yet, by index
+        self.pending = {}
+        # Priority of collections pushed to the data queue
+        # and not crawled yet, by index of their source URL
+        self.tocrawl = {}
         # Lock for creating new threads
         self.cond = threading.Lock()
         # Flag indicating a forceful exit
@@ -484,14 +1498,12 @@ class HarvestManCrawlerQueue(object):
         the threads to do their work """
 
         # print 'Waiting...'
-        timeslot, tottime = 0.5, 0
         pool = objects.datamgr.get_url_threadpool()
-        
-        while not self.stateobj.end_state():
-            self.stateobj.wait2(timeslot)
-            tottime += timeslot
-            if self.flag: 
-                break
+
+        # The threads notify the state machine when they
+        # all go idle and endloop notifies it too, so this
+        # returns as soon as the crawl is over.
+        self.stateobj.wait_for(lambda: self.flag or self.stateobj.end_state())
             
         if pool: pool.wait(10.0, self.configobj.timeout)
 
@@ -506,6 +1518,8 @@ class HarvestManCrawlerQueue(object):
 
         # Set flag to 1 to denote that downloading is finished.
         self.flag = 1
+        # Wake up the mainloop
+        self.stateobj.notify()
         if forced:
             self.forcedexit = True
             # A forced exit happens when we exit because a
@@ -513,32 +1527,76 @@ class HarvestManCrawlerQueue(object):
             # to not save anything from here on...
             conndict = objects.connfactory.get_connector_dict()
             for conn in conndict.keys():
-                if conndict.get(conn):
+                if conn in conndict:
                     conn.blockwrite = True
 
     def restart(self):
         """ Alternate method to start from a previous restored state """
 
-        # Start harvestman controller thread
-        import datamgr
+        # Reset flag
+        self.flag = 0
 
-        if self.configobj.enable_controller():
-            self.controller = datamgr.HarvestManController()
-            self.controller.start()
+        t1=time.time()
 
-        # Start base tracker
-        self.basetracker.start()
-        time.sleep(2.0)
+        # Clear the queues...
+        self.url_q.clear()
+        self.data_q.clear()
 
-        for t in self.trackers[1:]:
-            try:
-                t.start()
-            except AssertionError, e:
-                logconsole(e)
-                pass
+        baseurl = objects.datamgr.get_url(0)
+        if baseurl: self.baseurl = baseurl
+        
+        # Rebuild the queues from the restored state. URLs
+        # which were being fetched are fetched again. Any
+        # files of these and of the links of pages to be
+        # crawled again which were not recorded as fetched
+        # are from interrupted downloads, so remove them.
+        urlitems, dataitems = [], []
+        for index, (prio, generation) in self.pending.items():
+            url_obj = objects.datamgr.get_url(index)
+            if url_obj:
+                url_obj.priority, url_obj.generation = prio, generation
+                url_obj.qstatus = urlparser.URL_NOT_QUEUED
+                self.remove_file(url_obj)
+                urlitems.append((prio, url_obj))
+                
+        for index, prio in self.tocrawl.items():
+            coll = objects.datamgr.get_links(index)
+            if coll:
+                for child in coll.getAllURLs():
+                    url_obj = objects.datamgr.get_url(child)
+                    if url_obj and url_obj.qstatus == urlparser.URL_NOT_QUEUED:
+                        self.remove_file(url_obj)
+                dataitems.append((prio, coll, None))
+
+        extrainfo('Restored %d urls to fetch and %d pages to crawl' % (len(urlitems), len(dataitems)))
+
+        count = self.url_q.put_many(urlitems)
+        self.stateobj.cpush.add(count)
+        urlitems = urlitems[count:]
+        count = self.data_q.put_many(dataitems)
+        self.stateobj.fpush.add(count)
+        dataitems = dataitems[count:]
+
+        self.start_threads(t1)
+
+        # Items which did not fit in the queues
+        for q, items, counter in ((self.url_q, urlitems, self.stateobj.cpush),
+                                  (self.data_q, dataitems, self.stateobj.fpush)):
+            while items and not self.flag:
+                count = q.put_many(items)
+                counter.add(count)
+                items = items[count:]
+                if items: self.evnt.sleep()
 
         self.mainloop()
         
+    def remove_file(self, url_obj):
+        """ Remove the file saved for a URL object, if any """
+
+        filename = url_obj.get_full_filename()
+        if os.path.isfile(filename):
+            os.remove(filename)
+        
     def crawl(self):
         """ Starts crawling for this project """
 
@@ -553,9 +1611,16 @@ class HarvestManCrawlerQueue(object):
         self.data_q.clear()
         
         # Push the first URL directly to the url queue
+        self.record_urls([self.baseurl])
         self.url_q.put((self.baseurl.priority, self.baseurl))
         # This is pushed to url queue, so increment crawler push...
-        self.stateobj.cpush += 1
+        self.stateobj.cpush.add()
+
+        self.start_threads(t1)
+        self.mainloop()
+
+    def start_threads(self, starttime):
+        """ Start the controller and the crawler threads """
         
         #if self.configobj.fastmode:
 
@@ -575,14 +1640,9 @@ class HarvestManCrawlerQueue(object):
         self.basetracker.setDaemon(True)
         self.basetracker.start()
 
-        evt = SleepEvent(0.1)
-        while self.stateobj.get(self.basetracker) == crawler.FETCHER_WAITING:
-            evt.sleep()
-
         # Set start time on config object
-        self.configobj.starttime = t1
+        self.configobj.starttime = starttime
 
-        del evt
         for x in range(1, self.stateobj.numfetchers):
             t = crawler.HarvestManUrlFetcher(x, None)
             self.add_tracker(t)
@@ -595,10 +1655,81 @@ class HarvestManCrawlerQueue(object):
             t.setDaemon(True)
             t.start()
 
-        self.mainloop()
+        # Index of the next thread of each role
+        self.nextindex = {'fetcher': self.stateobj.numfetchers,
+                          'crawler': self.stateobj.numcrawlers}
+        
+        if self.configobj.adaptivethreads:
+            self.balancer = HarvestManThreadBalancer(self,
+                                                     self.configobj.adaptiveperiod,
+                                                     self.configobj.minfetchers,
+                                                     self.configobj.mincrawlers)
+            self.balancer.setDaemon(True)
+            self.balancer.start()
+            
         #else:
         #    self.basetracker.action()
 
+    def get_state(self):
+        """ Return the state of this object as a dictionary """
+
+        return {'pending': self.pending.copy(), 'tocrawl': self.tocrawl.copy()}
+
+    def set_state(self, state):
+        """ Set the state of this object from a dictionary
+        returned by get_state. The queues are filled
+        from it when the crawl is restarted """
+
+        self.pending = state['pending'].copy()
+        self.tocrawl = state['tocrawl'].copy()
+
+    def record_urls(self, urlobjs):
+        """ Record URL objects pushed to the url queue """
+
+        items = [(url_obj.index, url_obj.priority, url_obj.generation) for url_obj in urlobjs]
+        for index, prio, generation in items:
+            self.pending[index] = (prio, generation)
+        journal('queued', items)
+
+    def reprioritize(self, deltas):
+        """ Add to the priority of the URLs queued for fetching.
+        'deltas' is a dictionary mapping URL indices to the
+        value to add """
+
+        items = self.url_q.reprioritize(deltas)
+        for prio, url_obj in items:
+            url_obj.priority = prio
+        if items:
+            self.record_urls([url_obj for prio, url_obj in items])
+            
+        return len(items)
+    
+    def record_data(self, dataitems):
+        """ Record url data pushed to the data queue """
+
+        items = [(coll.getSourceURL(), prio) for prio, coll, document in dataitems]
+        for index, prio in items:
+            self.tocrawl[index] = prio
+        journal('data', items)
+
+    def mark_fetched(self, url_obj):
+        """ Record that a URL object got from the url
+        queue has been fetched """
+
+        self.pending.pop(url_obj.index, None)
+        if self.configobj.hostqueues:
+            # The host of the URL is ready again
+            # after the delay from now
+            self.url_q.mark_done(url_obj)
+        journal('fetched', url_obj)
+
+    def mark_crawled(self, url_obj):
+        """ Record that the links of a URL object got
+        from the data queue have been crawled """
+
+        self.tocrawl.pop(url_obj.index, None)
+        journal('crawled', url_obj.index)
+        
     def get_base_tracker(self):
         """ Get the base tracker object """
 
@@ -659,6 +1790,46 @@ class HarvestManCrawlerQueue(object):
 
         self.trackers.remove(tracker)
 
+    def convert_thread(self, fromrole, torole):
+        """ Replace a thread of role 'fromrole' with a new
+        thread of role 'torole'. The old thread exits once
+        it has processed the items it holds. Returns True
+        if a thread was converted """
+
+        if self.flag: return False
+        
+        self.cond.acquire()
+        try:
+            candidates = [t for t in self.trackers if t._role==fromrole and \
+                          t is not self.basetracker and t.isAlive() and not t._retiring]
+            if not candidates: return False
+
+            # Prefer a thread which is waiting for work
+            waiting = (crawler.FETCHER_WAITING, crawler.CRAWLER_WAITING)
+            for t in candidates:
+                item = self.stateobj.get(t)
+                if item and item[0] in waiting:
+                    break
+            else:
+                t = candidates[0]
+
+            if torole == 'fetcher':
+                new_t = crawler.HarvestManUrlFetcher(self.nextindex[torole], None)
+                self.stateobj.add_threads(fetchers=1, crawlers=-1)
+            else:
+                new_t = crawler.HarvestManUrlCrawler(self.nextindex[torole], None)
+                self.stateobj.add_threads(fetchers=-1, crawlers=1)
+            self.nextindex[torole] += 1
+
+            t.retire()
+            self.add_tracker(new_t)
+            new_t.setDaemon(True)
+            new_t.start()
+            
+            return True
+        finally:
+            self.cond.release()
+
     def dead_thread_callback(self, t):
         """ Call back function called by a thread if it
         dies with an exception. This class then creates
@@ -704,9 +1875,9 @@ class HarvestManCrawlerQueue(object):
                 self.trackers.remove(t)
                 
                 if role == 'fetcher':
-                    self.stateobj.numfetchers -= 1
+                    self.stateobj.add_threads(fetchers=-1)
                 elif role == 'crawler':
-                    self.stateobj.numcrawlers -= 1
+                    self.stateobj.add_threads(crawlers=-1)
 
                 return THREAD_MIGRATION_ERROR
         finally:
@@ -719,12 +1890,15 @@ class HarvestManCrawlerQueue(object):
         
         ntries, status = 0, 0
         ct = threading.currentThread()
+        # Spill queues take the item at the first try
+        maxtries = (self.spill and 1) or 5
         
         if role == 'crawler' or role=='tracker' or role =='downloader':
             # debug('Pushing stuff to buffer',ct)
             self.stateobj.set(ct, crawler.CRAWLER_PUSH_URL)
+            self.record_urls([obj])
             
-            while ntries < 5:
+            while ntries < maxtries:
                 try:
                     ntries += 1
                     self.url_q.put((obj.priority, obj))
@@ -738,8 +1912,9 @@ class HarvestManCrawlerQueue(object):
         elif role == 'fetcher':
             # print 'Pushing stuff to buffer', ct
             self.stateobj.set(ct, crawler.FETCHER_PUSH_URL)                                
+            self.record_data([obj])
             # stuff = (obj[0].priority, (obj[0].index, obj[1]))
-            while ntries < 5:
+            while ntries < maxtries:
                 try:
                     ntries += 1
                     self.data_q.put(obj)
@@ -754,6 +1929,108 @@ class HarvestManCrawlerQueue(object):
 
         return status
     
+    def push_many(self, objs, role):
+        """ Push a list of objects to the queue for the given
+        role, taking the queue lock and updating the state
+        machine once for the whole batch. Returns the number
+        of objects pushed, which are always the leading ones
+        of the list """
+
+        if self.flag or not objs: return 0
+
+        ct = threading.currentThread()
+        
+        if role == 'crawler' or role=='tracker' or role =='downloader':
+            q = self.url_q
+            items = [(obj.priority, obj) for obj in objs]
+            pushstate, pushedstate = crawler.CRAWLER_PUSH_URL, crawler.CRAWLER_PUSHED_URL
+            self.record_urls(objs)
+        elif role == 'fetcher':
+            q = self.data_q
+            items = list(objs)
+            pushstate, pushedstate = crawler.FETCHER_PUSH_URL, crawler.FETCHER_PUSHED_URL
+            self.record_data(items)
+        else:
+            return 0
+
+        self.stateobj.set(ct, pushstate)
+
+        ntries, count = 0, 0
+        maxtries = (self.spill and 1) or 5
+        while ntries < maxtries:
+            ntries += 1
+            count += q.put_many(items[count:])
+            if count == len(items):
+                break
+            self.evnt.sleep()
+
+        if count:
+            self.pushes += count
+            self.stateobj.set(ct, pushedstate, count)
+
+        self.lasttimestamp = time.time()
+
+        return count
+
+    def get_many(self, role, max_items, timeout=None):
+        """ Pop a list of at most 'max_items' url data items
+        for the given role. The lock is taken once and the
+        state machine is updated once for the whole batch.
+        A thread takes no more than its fair share of the
+        items in the queue, so that a batch does not starve
+        the other threads of the same role. Returns an
+        empty list if nothing could be got within 'timeout'
+        seconds (default queuetime) """
+
+        if self.flag: return []
+
+        blk = self.configobj.blocking
+        if timeout is None:
+            timeout = self.configobj.queuetime
+            
+        ct = threading.currentThread()
+
+        if role == 'crawler':
+            q, nthreads = self.data_q, self.stateobj.numcrawlers
+            waitstate, gotstate = crawler.CRAWLER_WAITING, crawler.CRAWLER_GOT_DATA
+        elif role == 'fetcher' or role=='tracker':
+            q, nthreads = self.url_q, self.stateobj.numfetchers
+            waitstate, gotstate = crawler.FETCHER_WAITING, crawler.FETCHER_GOT_DATA
+        else:
+            return []
+
+        n = max(1, min(max_items, q.qsize()/max(nthreads, 1)))
+
+        if not blk:
+            self.stateobj.set(ct, waitstate)
+        try:
+            if blk:
+                items = q.get_many(n)
+            else:
+                items = q.get_many(n, True, timeout)
+            self.stateobj.set(ct, gotstate, len(items))
+        except Empty:
+            items = []
+
+        self.lasttimestamp = time.time()        
+
+        self.requests += 1
+        return items
+        
+    def get_spill_stats(self):
+        """ Return a tuple of the number of items spilled
+        to disk and refilled from disk by the url and
+        data queues """
+
+        spilled, refilled = 0, 0
+        for q in (self.url_q, self.data_q):
+            if isinstance(q, HarvestManSpillQueue):
+                stats = q.get_stats()
+                spilled += stats['spilled']
+                refilled += stats['refilled']
+
+        return spilled, refilled
+    
     def end_threads(self):
         """ Stop all running threads and clean
         up the program. This function is called
@@ -769,11 +2046,21 @@ class HarvestManCrawlerQueue(object):
         # Stop controller
         if self.controller:
             self.controller.stop()
+        if self.balancer:
+            self.balancer.stop()
         
         if self.forcedexit:
             self._kill_tracker_threads()
         else:
-            # Do a regular stop and join
+            # Ask all threads to stop and wake up the ones
+            # which are sleeping or waiting on the queues,
+            # so that they wind down together. Then do a
+            # regular stop and join.
+            for t in self.trackers:
+                t.signal_stop()
+            self.url_q.interrupt()
+            self.data_q.interrupt()
+            
             for t in self.trackers:
                 try:
                     t.stop()
@@ -784,20 +2071,18 @@ class HarvestManCrawlerQueue(object):
             # to the state machine, with a
             # timeout of 5 minutes.
             extrainfo("Waiting for threads to finish up...")
-
-            timeslot, tottime = 0.5, 0
-            while not self.stateobj.exit_state():
-                # print 'Waiting...'
-                self.stateobj.wait2(timeslot)
-                tottime += timeslot
-                if tottime>=300.0:
-                    break
+            self.stateobj.wait_for(self.stateobj.exit_state, 300.0)
 
             pool = objects.datamgr.get_url_threadpool()
             if pool: pool.wait(10.0, 120.0)
             
             extrainfo("Done.")
             # print 'Done.'
+
+        # Remove spill files, if any
+        for q in (self.url_q, self.data_q):
+            if isinstance(q, HarvestManSpillQueue):
+                q.close()
         
         self.trackers = []
         self.basetracker = None
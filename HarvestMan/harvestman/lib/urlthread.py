@@ -179,7 +179,7 @@ class HarvestManUrlThread(threading.Thread):
             extrainfo('%s: Downloading url %s, byte range(%d - %d)' % (str(self),url,startrange,endrange))
 
         # This call will block if we exceed the number of connections
-        self._conn = objects.connfactory.create_connector()
+        self._conn = objects.connfactory.create_connector(url_obj)
         mode = self._conn.get_data_mode()
         
         if not url_obj.trymultipart:
@@ -225,6 +225,8 @@ class HarvestManUrlThread(threading.Thread):
             error('Failed to download URL',url)
 
         objects.datamgr.update_url(url_obj)
+        if not url_obj.trymultipart:
+            objects.queuemgr.mark_fetched(url_obj)
         
     def run(self):
         """ Run this thread """
@@ -33,7 +33,7 @@ from shutil import copy
 
 from harvestman.lib.common.common import *
 from harvestman.lib.common.macros import *
-from harvestman.lib.common.pydblite import Base
+from harvestman.lib.pagecache import HarvestManProjectCache
 
 HARVESTMAN_XML_HEAD1="""<?xml version=\"1.0\" encoding=\"UTF-8\"?>"""
 HARVESTMAN_XML_HEAD2="""<!DOCTYPE HarvestManProject SYSTEM \"HarvestManProject.dtd\">"""
@@ -265,26 +265,39 @@ class HarvestManCacheReaderWriter(object):
             except OSError, e:
                 debug('OS Exception ', e)
 
+        # Cache file written by earlier versions
         self._cachefilename = os.path.join(self._cachedir, 'cache')
         
     def read_project_cache(self):
-        """ Try to read the project cache file """
+        """ Try to open the project cache """
+
+        cache_obj = HarvestManProjectCache(self._cachedir)
+        # Copy the records of a cache file of
+        # an earlier version, if there is one.
+        importing = os.path.isfile(self._cachefilename) and not os.path.isfile(cache_obj.logfilename)
 
         found = False
+        try:
+            found = cache_obj.open()
+            if importing:
+                count = cache_obj.import_pydblite(self._cachefilename)
+                extrainfo('Imported %d records from the old project cache' % count)
+                cache_obj.commit()
+                found = count > 0
+        except Exception, e:
+            logconsole(e)
+            if cache_obj.wfile is None:
+                # A cache which cannot be opened is set aside
+                # and the crawl starts with a new one
+                try:
+                    found = cache_obj.reset()
+                except Exception, e:
+                    logconsole(e)
+                    return (None, False)
 
-        # Get cache filename
-        if not os.path.exists(self._cachefilename):
+        if not found:
             info("Project cache not found")
 
-        cache_obj = Base(self._cachefilename)
-
-        if os.path.isfile(self._cachefilename):
-            try:
-                cache_obj.open()
-                found = True
-            except Exception, e:
-                logconsole(e)
-
         return (cache_obj, found)
 
     def write_project_cache(self, cache):
@@ -0,0 +1,67 @@
+# -- coding: utf-8
+""" Unit test for bandwidth module """
+
+import test_base
+import unittest
+import threading
+import time
+
+test_base.setUp()
+from harvestman.lib.bandwidth import *
+
+class TestHarvestManBandwidth(unittest.TestCase):
+    """ Unit test class for the bandwidth module """
+
+    def read(self, limiter, nbytes, host=None, bs=4096):
+        for i in range(nbytes/bs):
+            limiter.consume(bs, host)
+
+    def test_bucket(self):
+        bucket = HarvestManTokenBucket(1024*1024)
+        # The burst is taken at once
+        assert(bucket.burst==1024*1024*BURST_TIME)
+        assert(bucket.reserve(65536)==0.0)
+        wait = bucket.reserve(65536)
+        assert(abs(wait - (65536 - 1024*1024*BURST_TIME + 65536)/(1024*1024))<0.01)
+
+        # Readers are served in turn
+        bucket = HarvestManTokenBucket(4096, 4096)
+        waits = [bucket.reserve(4096) for i in range(4)]
+        assert(waits[0]==0.0)
+        assert(waits[1]<waits[2]<waits[3])
+
+    def test_limiter(self):
+        rate = 400*1024
+        limiter = HarvestManBandwidthLimiter(rate)
+        threads = [threading.Thread(target=self.read, args=(limiter, 80*1024)) for i in range(4)]
+        t = time.time()
+        for th in threads: th.start()
+        for th in threads: th.join()
+        t = time.time() - t
+        # 320 KB less the burst at 400 KB/sec
+        assert(t > (320*1024 - limiter.bucket.burst)/rate)
+        stats = limiter.get_stats()
+        assert(stats['rate']==rate)
+        assert(abs(stats['achieved'] - rate) < 0.2*rate)
+
+        # Per server
+        limiter = HarvestManBandwidthLimiter(0, 100*1024)
+        threads = [threading.Thread(target=self.read, args=(limiter, 40*1024, host))
+                   for host in ('www.foo.com', 'www.bar.com')]
+        t = time.time()
+        for th in threads: th.start()
+        for th in threads: th.join()
+        t = time.time() - t
+        # The servers are limited apart
+        assert(0.25 < t < 0.5)
+        stats = limiter.get_stats()
+        assert(sorted(stats['hosts'].keys())==['www.bar.com', 'www.foo.com'])
+        assert(limiter.get_bucket(None) is None)
+
+def run(result):
+    return test_base.run_test(TestHarvestManBandwidth, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManBandwidth)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
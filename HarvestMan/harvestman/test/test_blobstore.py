@@ -0,0 +1,77 @@
+# -- coding: utf-8
+""" Unit test for blobstore module """
+
+import test_base
+import unittest
+import os
+import shutil
+import tempfile
+import sha
+
+test_base.setUp()
+from harvestman.lib.blobstore import *
+
+class TestHarvestManBlobStore(unittest.TestCase):
+    """ Unit test class for the HarvestManBlobStore class """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blobs = HarvestManBlobStore(os.path.join(self.directory, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_store(self):
+        blobs = self.blobs
+        assert(blobs.store(self.path('a.html'), 'foo')==False)
+        assert(blobs.store(self.path('b.html'), 'foo')==True)
+        assert(blobs.store(self.path('c.html'), 'bar')==False)
+        assert(open(self.path('b.html')).read()=='foo')
+        assert(os.path.samefile(self.path('a.html'), self.path('b.html')))
+        assert(os.stat(self.path('a.html')).st_nlink==3)
+
+        # From a temporary file
+        f = open(self.path('tmp'), 'wb')
+        f.write('bar')
+        f.close()
+        assert(blobs.store_file(self.path('d.html'), self.path('tmp'))==True)
+        assert(not os.path.exists(self.path('tmp')))
+        assert(os.path.samefile(self.path('c.html'), self.path('d.html')))
+
+        stats = blobs.get_stats()
+        assert(stats['files']==4 and stats['blobs']==2)
+        assert(stats['dupfiles']==2 and stats['dupbytes']==6)
+
+        # Modifying a file leaves the others alone
+        assert(unshare_file(self.path('a.html'))==True)
+        open(self.path('a.html'), 'w').write('baz')
+        assert(open(self.path('b.html')).read()=='foo')
+        assert(unshare_file(self.path('a.html'))==False)
+
+        # The blob of 'bar' is still linked to
+        os.remove(self.path('b.html'))
+        assert(blobs.prune()==1)
+        assert(os.listdir(blobs.directory)==[sha.new('bar').hexdigest()[:2]])
+
+    def test_symlinks(self):
+        blobs = self.blobs
+        blobs.links = 'sym'
+        blobs.store(self.path('a.html'), 'foo')
+        blobs.store(self.path('b.html'), 'foo')
+        assert(os.path.islink(self.path('b.html')))
+        assert(os.path.realpath(self.path('b.html'))==os.path.realpath(blobs.blob_file(sha.new('foo').hexdigest())))
+
+        assert(unshare_file(self.path('b.html'))==True)
+        assert(not os.path.islink(self.path('b.html')))
+        assert(open(self.path('b.html')).read()=='foo')
+
+def run(result):
+    return test_base.run_test(TestHarvestManBlobStore, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManBlobStore)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
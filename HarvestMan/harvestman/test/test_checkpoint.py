@@ -0,0 +1,230 @@
+# -- coding: utf-8
+""" Unit test for checkpoint module """
+
+import test_base
+import unittest
+import os
+import shutil
+import tempfile
+
+test_base.setUp()
+from harvestman.lib.checkpoint import *
+from harvestman.lib.urlparser import HarvestManUrl
+from harvestman.lib.urlcollections import HarvestManAutoUrlCollection
+from harvestman.lib import urltypes
+from harvestman.lib import urlparser
+
+class TestHarvestManCheckpoint(unittest.TestCase):
+    """ Unit test class for the HarvestManCheckpoint class """
+
+    def setUp(self):
+        self.cfg = objects.config
+        self.projdir, self.project = self.cfg.projdir, self.cfg.project
+        self.checkpoint = self.cfg.checkpoint
+        self.cfg.checkpoint = 1
+        self.cfg.projdir = tempfile.mkdtemp(prefix='hm-test-')
+        self.cfg.project = 'test'
+        self.cfg.url = 'http://www.foo.com/index.html'
+
+        objects.datamgr.reset()
+        objects.datamgr.make_databases()
+        objects.rulesmgr.reset()
+        objects.queuemgr.set_state({'pending': {}, 'tocrawl': {}})
+
+        self.cp = HarvestManCheckpoint()
+        SetAlias(self.cp)
+
+    def tearDown(self):
+        self.cp.close()
+        shutil.rmtree(self.cfg.projdir, True)
+        self.cfg.projdir, self.cfg.project = self.projdir, self.project
+        self.cfg.checkpoint = self.checkpoint
+
+    def crawl(self):
+        """ Simulate a crawl of a page with two links """
+
+        dmgr, qmgr = objects.datamgr, objects.queuemgr
+
+        base = HarvestManUrl(self.cfg.url, urltypes.URL_TYPE_WEBPAGE)
+        dmgr.add_url(base)
+        qmgr.record_urls([base])
+
+        coll = HarvestManAutoUrlCollection(base)
+        children = []
+        for name in ('a.html', 'b.html'):
+            child = HarvestManUrl(name, urltypes.URL_TYPE_ANCHOR, 0, base)
+            dmgr.add_url(child)
+            coll.addURL(child)
+            children.append(child)
+
+        dmgr.update_links(base, coll)
+        qmgr.record_data([(base.priority, coll, None)])
+        qmgr.mark_fetched(base)
+        dmgr.savedfiles += 1
+
+        objects.rulesmgr.add_to_filter(children[1].index)
+        children[0].priority = 3
+        qmgr.record_urls(children[:1])
+        qmgr.mark_crawled(base)
+
+        return base, children
+
+    def test_journal(self):
+        self.cp.open()
+        base, children = self.crawl()
+        self.cp.flush()
+
+        state = self.cp.load()
+        dmstate = state['datamanager']
+        assert(sorted(dmstate['urls'].keys())==sorted([base.index] + [c.index for c in children]))
+        assert(dmstate['links'][base.index].getAllURLs()==[c.index for c in children])
+        assert(dmstate['counters']['savedfiles']==1)
+        assert(state['trackerqueue']=={'pending': {children[0].index: (3, 0)}, 'tocrawl': {}})
+        assert(state['ruleschecker']['filter']=={children[1].index: 1})
+        assert(state['config']['url']==self.cfg.url)
+        # The journal matches the state of the objects
+        assert(state['trackerqueue']==objects.queuemgr.get_state())
+
+    def test_changed(self):
+        self.cp.open()
+        base, children = self.crawl()
+        # Changed after it was journalled
+        children[0].priority = 5
+        self.cp.flush()
+
+        state = self.cp.load()
+        assert(state['datamanager']['urls'][children[0].index].priority==0)
+
+    def test_snapshot(self):
+        self.cp.open()
+        base, children = self.crawl()
+        self.cp.snapshot()
+
+        # Journal folded into the snapshot
+        files = sorted(os.listdir(self.cp.directory))
+        assert(files==['journal-000001.log', 'snapshot'])
+        assert(os.path.getsize(os.path.join(self.cp.directory, files[0]))==0)
+
+        objects.queuemgr.mark_fetched(children[0])
+        self.cp.flush()
+        state = self.cp.load()
+        assert(state['journal']==1)
+        assert(state['trackerqueue']['pending']=={})
+        assert(len(state['datamanager']['urls'])==3)
+        assert('extservers' in state['ruleschecker']['caches'])
+
+    def test_truncated(self):
+        self.cp.open()
+        base, children = self.crawl()
+        self.cp.flush()
+        objects.queuemgr.mark_fetched(children[0])
+        self.cp.flush()
+
+        # Cut the last record short, as a crash would
+        jfile = self.cp._journal_file(0)
+        self.cp.save()
+        self.cp.close()
+        size = os.path.getsize(jfile)
+        f = open(jfile, 'r+b')
+        f.truncate(size - 10)
+        f.close()
+
+        state = self.cp.load()
+        assert(state['trackerqueue']['pending']=={children[0].index: (3, 0)})
+
+    def test_restore(self):
+        self.cp.open()
+        base, children = self.crawl()
+        self.cp.save()
+        self.cp.close()
+        # Saved checkpoint is kept at close
+        assert(os.path.isdir(self.cp.directory))
+
+        state = self.cp.load()
+        objects.datamgr.make_databases()
+        objects.rulesmgr.reset()
+        objects.queuemgr.set_state({'pending': {}, 'tocrawl': {}})
+
+        objects.datamgr.set_state(state['datamanager'])
+        objects.rulesmgr.set_state(state['ruleschecker'])
+        objects.queuemgr.set_state(state['trackerqueue'])
+
+        url_obj = objects.datamgr.get_url(children[0].index)
+        assert(url_obj.get_full_url()=='http://www.foo.com/a.html')
+        assert(objects.datamgr.get_links(base.index).getAllURLs()==[c.index for c in children])
+        assert(objects.datamgr.savedfiles==1)
+        assert(objects.rulesmgr.get_state()['filter']=={children[1].index: 1})
+        assert(objects.queuemgr.get_state()==state['trackerqueue'])
+
+        # Resuming continues the journal
+        self.cp.open(resume=True)
+        objects.queuemgr.mark_fetched(url_obj)
+        self.cp.close()
+        assert(not os.path.isdir(self.cp.directory))
+
+    def test_robots(self):
+        from harvestman.lib.hosts import host_id
+
+        rules = objects.rulesmgr
+        rules.set_state({'filter': {},
+                         'caches': {'robots': [(('www.foo.com', 81), 'foo'),
+                                               # Keys of older states
+                                               ('http://www.bar.com:8080', 'bar'),
+                                               ('https://www.baz.com', None),
+                                               ('www.qux.com', 'qux')]}})
+        assert(sorted(rules._robots.keys())==sorted([(host_id('www.foo.com'), 81),
+                                                     (host_id('www.bar.com'), 8080),
+                                                     (host_id('www.baz.com'), 443)]))
+        assert(rules._robots[(host_id('www.bar.com'), 8080)]=='bar')
+        robots = rules.get_caches()['robots']
+        assert(sorted(robots)==sorted([(('www.foo.com', 81), 'foo'), (('www.bar.com', 8080), 'bar'),
+                                       (('www.baz.com', 443), None)]))
+
+    def test_reindex(self):
+        self.cp.open()
+        base, children = self.crawl()
+        self.cp.save()
+        self.cp.close()
+
+        # Make a checkpoint with 24-bit indices, as
+        # saved with the old index scheme
+        state = self.cp.load()
+        fingerprint = urlparser.url_fingerprint
+        urlparser.url_fingerprint = lambda s: fingerprint(s) & 0xffffff
+        try:
+            reindex(state)
+        finally:
+            urlparser.url_fingerprint = fingerprint
+        del state['urlindex']
+        state['journal'] = 1
+        self.cp._write_snapshot(state)
+        assert(state['trackerqueue']['pending'].keys()==[children[0].index & 0xffffff])
+
+        state = self.cp.load()
+        assert(self.cp.reindexed)
+        dmstate = state['datamanager']
+        assert(sorted(dmstate['urls'].keys())==sorted([base.index] + [c.index for c in children]))
+        assert(dmstate['links'][base.index].getAllURLs()==[c.index for c in children])
+        assert(state['trackerqueue']['pending']=={children[0].index: (3, 0)})
+        assert(state['ruleschecker']['filter']=={children[1].index: 1})
+
+        # The re-indexed checkpoint is not continued
+        self.cp.open(resume=True)
+        assert(self.cp._journal_seqs()==[0])
+        assert(self.cp.load()['urlindex']==urlparser.INDEX_SCHEME)
+        assert(not self.cp.reindexed)
+        
+    def test_disabled(self):
+        self.cfg.checkpoint = 0
+        self.cp.open()
+        assert(not self.cp.active)
+        self.crawl()
+        assert(self.cp.records==[])
+
+def run(result):
+    return test_base.run_test(TestHarvestManCheckpoint, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManCheckpoint)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
@@ -11,10 +11,16 @@ import unittest
 import sys, os
 import time
 import random
+import threading
+import zlib
+import gzip
+import cStringIO
+import tempfile
 
 test_base.setUp()
 
-from harvestman.lib.connector import HarvestManUrlConnector
+from harvestman.lib.connector import HarvestManUrlConnector, HarvestManUrlConnectorFactory
+from harvestman.lib.connector import HarvestManFileObject, get_decoder
 from harvestman.lib.urlparser import HarvestManUrl    
 from harvestman.lib.common.macros import *
 from harvestman.lib.common.common import objects
@@ -95,7 +101,93 @@ class TestHarvestManUrlConnector(unittest.TestCase):
             print 'Error in fetching data, skipping tests...'                
         
     def test_connfactory(self):
-        pass
+        factory = HarvestManUrlConnectorFactory(3, 1)
+        url1 = HarvestManUrl('http://www.foo.com/a.html')
+        url2 = HarvestManUrl('http://www.bar.com/b.html')
+        conn1 = factory.create_connector(url1)
+        conn2 = factory.create_connector(url2)
+        assert(factory.get_count()==2)
+
+        # A second connector to the same server waits for
+        # the first, without holding one of the other two
+        conns = []
+        t = threading.Thread(target=lambda: conns.append(factory.create_connector(url1)))
+        t.start()
+        time.sleep(0.2)
+        assert(not conns)
+        conn3 = factory.create_connector()
+        factory.remove_connector(conn1)
+        t.join()
+        assert(len(conns)==1)
+
+        blocked = factory.get_blocked_stats()
+        assert(blocked.keys()==['www.foo.com'] and blocked['www.foo.com'][0]==1)
+        assert(blocked['www.foo.com'][1]>=0.2)
+        for conn in conns + [conn2, conn3]:
+            factory.remove_connector(conn)
+        assert(factory.get_count()==0)
+
+        # The parts of a multipart download take a slot
+        # of the server each
+        factory = HarvestManUrlConnectorFactory(5, 2)
+        parts = []
+        for x in range(3):
+            part = HarvestManUrl('http://www.foo.com/a.html')
+            part.trymultipart = True
+            part.range = (x*100, x*100 + 99)
+            parts.append(part)
+        conns = []
+        threads = [threading.Thread(target=lambda u: conns.append(factory.create_connector(u)),
+                                    args=(part,)) for part in parts]
+        for t in threads: t.setDaemon(True); t.start()
+        time.sleep(0.2)
+        assert(len(conns)==2)
+        factory.remove_connector(conns[0])
+        for t in threads: t.join(5.0)
+        assert(len(conns)==3)
+        for c in conns[1:]:
+            factory.remove_connector(c)
+        assert(factory.get_count()==0)
+        # The slots of the server are free again
+        assert(factory.get_host_semaphore('www.foo.com').acquire(False))
+
+    def test_decoder(self):
+        data = ''.join(['line %d of some text\n' % i for i in range(5000)])
+        buf = cStringIO.StringIO()
+        g = gzip.GzipFile(fileobj=buf, mode='wb')
+        g.write(data)
+        g.close()
+        gzdata = buf.getvalue()
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        rawdata = raw.compress(data) + raw.flush()
+
+        for encoding, encoded in (('gzip', gzdata), ('deflate', zlib.compress(data)),
+                                  ('deflate', rawdata)):
+            decoder = get_decoder(encoding)
+            blocks = [decoder.decompress(encoded[i:i+100]) for i in range(0, len(encoded), 100)]
+            assert(''.join(blocks) + decoder.flush() == data)
+
+        assert(get_decoder('plain')==None)
+        # Data which is not really compressed is kept as it is
+        decoder = get_decoder('gzip')
+        assert(decoder.decompress(data[:100]) + decoder.decompress(data[100:]) + decoder.flush() == data)
+
+        # In the file object, in memory and flushed to a file
+        fo = HarvestManFileObject(cStringIO.StringIO(gzdata), '', len(gzdata),
+                                  CONNECTOR_DATA_MODE_INMEM, None, 'gzip')
+        fo.read()
+        assert(fo.get_data()==data)
+        assert(fo.get_datalen()==len(gzdata))
+
+        fd, tmpfname = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            fo = HarvestManFileObject(cStringIO.StringIO(gzdata), tmpfname, len(gzdata),
+                                      CONNECTOR_DATA_MODE_FLUSH, None, 'gzip')
+            fo.read()
+            assert(open(tmpfname, 'rb').read()==data)
+        finally:
+            os.remove(tmpfname)
 
 def run(result):
     return test_base.run_test(TestHarvestManUrlConnector, result)
@@ -0,0 +1,183 @@
+# -- coding: utf-8
+""" Unit test for datamgr module """
+
+import test_base
+import unittest
+import os
+import shutil
+import tempfile
+import zlib
+import sha
+
+test_base.setUp()
+from harvestman.lib.common.common import *
+from harvestman.lib.urlparser import HarvestManUrl
+from harvestman.lib.common.hashdb import HashDB
+from harvestman.lib.urlcollections import HarvestManUrlCollection
+from harvestman.lib import urlparser, urldb
+from harvestman.lib.pagecache import HarvestManProjectCache
+from harvestman.lib.blobstore import HarvestManBlobStore
+
+class TestHarvestManDataManager(unittest.TestCase):
+    """ Unit test class for the HarvestManDataManager class """
+
+    def setUp(self):
+        self.dmgr = objects.datamgr
+        self.dmgr.reset()
+        self.dmgr.make_databases()
+
+    def tearDown(self):
+        objects.config.urlverify = 0
+
+    def test_check_exists(self):
+        dmgr = self.dmgr
+        u1 = HarvestManUrl('http://www.foo.com/a.html')
+        assert(dmgr.check_exists(u1) is None)
+        dmgr.add_url(u1)
+        assert(dmgr.check_exists(HarvestManUrl('http://www.foo.com/a.html')) is u1)
+        assert(dmgr.check_exists(HarvestManUrl('http://www.foo.com/b.html')) is None)
+
+    def test_verify(self):
+        dmgr = self.dmgr
+        u1 = HarvestManUrl('http://www.foo.com/a.html')
+        dmgr.add_url(u1)
+
+        # Fake a fingerprint collision
+        u2 = HarvestManUrl('http://www.foo.com/b.html')
+        u2.index = u1.index
+        assert(dmgr.check_exists(u2) is u1)
+
+        objects.config.urlverify = 1
+        assert(dmgr.check_exists(u2) is None)
+        assert(u2.index != u1.index)
+        assert(dmgr.collisions.value==1)
+        dmgr.add_url(u2)
+
+        # The same URL is found again at its new index
+        u3 = HarvestManUrl('http://www.foo.com/b.html')
+        u3.index = u1.index
+        assert(dmgr.check_exists(u3) is u2)
+        assert(u3.index==u2.index)
+        # Finding a URL again is not a collision
+        assert(dmgr.collisions.value==1)
+        assert(dmgr.check_exists(HarvestManUrl('http://www.foo.com/a.html')) is u1)
+
+    def test_urldb(self):
+        # Small segments so that segment files fill up
+        db = HashDB(10, prefix='test', segsize=1000, syncsize=7)
+        urls = [HarvestManUrl('http://www.foo.com/%d.html' % x) for x in range(100)]
+        for u in urls:
+            db.insert(u.index, u)
+
+        assert(len(db)==100)
+        assert(len(db.mem)==10)
+        assert(db.spills==90)
+        assert(os.listdir(db.directory))
+
+        # Spilled URLs are loaded back
+        u = db.lookup(urls[0].index)
+        assert(u is not urls[0])
+        assert(u.get_full_url()==urls[0].get_full_url())
+        assert(db.lookup(urls[0].index) is u)
+        assert(db.lookup(12345) is None)
+
+        # Replacing keeps the order of insertion
+        db.insert(urls[50].index, urls[50])
+        assert(db.lookup(urls[50].index) is urls[50])
+        assert([key for key, u in db.iteritems()]==[u.index for u in urls])
+        assert([u.get_full_url() for u in db.itervalues()]==[u.get_full_url() for u in urls])
+
+        # Segments are removed when all their URLs are loaded back
+        first = db._segment_file(0)
+        assert(os.path.isfile(first))
+        for u in urls[:40]:
+            db.lookup(u.index)
+        assert(0 not in db.segments)
+        assert(not os.path.exists(first))
+        assert(len(os.listdir(db.directory))==len(db.segments))
+
+        directory = db.directory
+        db.close()
+        assert(not os.path.exists(directory))
+
+    def test_sqlite_urldb(self):
+        db = urldb.HarvestManSqliteDB(':memory:', batch=10)
+        urls = urldb.HarvestManSqliteUrlDB(db, 5)
+        links = urldb.HarvestManSqliteLinkDB(db, 5)
+
+        objs = [HarvestManUrl('http://www.foo.com/%d.html' % x) for x in range(20)]
+        objs.append(HarvestManUrl('http://www.bar.com/'))
+        for u in objs:
+            urls.insert(u.index, u)
+        assert(len(urls)==21)
+        assert(db.commits==2)
+
+        # URLs in memory are the same objects
+        assert(urls.lookup(objs[-1].index) is objs[-1])
+        u = urls.lookup(objs[0].index)
+        assert(u.get_full_url()==objs[0].get_full_url())
+        assert(urls.lookup(12345) is None)
+        assert([key for key in urls]==[u.index for u in objs])
+
+        objs[3].status = 404
+        objs[4].qstatus = urlparser.URL_DONE_DOWNLOAD
+        objs[4].status = 1
+        urls.update(objs[3].index, objs[3])
+        urls.update(objs[4].index, objs[4])
+        assert([u.index for u in urls.get_broken_urls()]==[objs[3].index])
+        assert(urls.count_status(404)==1)
+        assert([u.index for u in urls.get_failed_urls()]==[objs[4].index])
+        assert(urls.get_host_counts()=={'www.foo.com': 20, 'www.bar.com': 1})
+
+        coll = HarvestManUrlCollection(objs[0])
+        for u in objs[1:4]:
+            coll.addURL(u)
+        links.insert(objs[0].index, coll)
+        assert(links.get_children(objs[0].index)==[u.index for u in objs[1:4]])
+        assert(links.lookup(objs[0].index) is coll)
+
+        links.close()
+        urls.close()
+        assert(db.conn is None)
+
+    def test_write_from_cache(self):
+        dmgr = self.dmgr
+        directory = tempfile.mkdtemp()
+        cache, blobs = dmgr.cache, dmgr.blobs
+        try:
+            dmgr.cache = HarvestManProjectCache(os.path.join(directory, 'cache'))
+            dmgr.cache.open()
+            dmgr.blobs = HarvestManBlobStore(os.path.join(directory, 'blobs'))
+
+            # Two URLs sharing one blob
+            a, b = os.path.join(directory, 'a.html'), os.path.join(directory, 'b.html')
+            dmgr.blobs.store(a, 'foo')
+            dmgr.blobs.store(b, 'foo')
+            assert(os.path.samefile(a, b))
+
+            # One of them rewritten from the cache
+            u = HarvestManUrl('http://www.foo.com/a.html')
+            dmgr.cache.insert(u.get_full_url(), zlib.compress('bar'), location=a)
+            assert(dmgr.write_file_from_cache(u)==True)
+            assert(open(a).read()=='bar')
+            assert(open(b).read()=='foo')
+            assert(open(dmgr.blobs.blob_file(sha.new('foo').hexdigest())).read()=='foo')
+
+            # Links left by an earlier crawl with the blob store
+            dmgr.blobs.store(a, 'foo')
+            dmgr.blobs = None
+            assert(dmgr.write_file_from_cache(u)==True)
+            assert(open(a).read()=='bar')
+            assert(open(b).read()=='foo')
+            dmgr.cache.close()
+        finally:
+            dmgr.cache, dmgr.blobs = cache, blobs
+            shutil.rmtree(directory)
+
+def run(result):
+    return test_base.run_test(TestHarvestManDataManager, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManDataManager)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
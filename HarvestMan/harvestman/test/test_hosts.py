@@ -0,0 +1,82 @@
+# -- coding: utf-8
+""" Unit test for hosts module """
+
+import test_base
+import unittest
+import cPickle
+
+test_base.setUp()
+from harvestman.lib.common.common import *
+from harvestman.lib.hosts import *
+from harvestman.lib.urlparser import HarvestManUrl
+from harvestman.lib.rules import HarvestManRulesChecker
+
+class TestHarvestManHostTable(unittest.TestCase):
+    """ Unit test class for the HarvestManHostTable class """
+
+    def test_ids(self):
+        table = HarvestManHostTable()
+        assert(table.get_id('')==0)
+        i1 = table.get_id('www.foo.com')
+        assert(i1 > 0)
+        assert(table.get_id('WWW.Foo.com')==i1)
+        assert(table.get_id('www.bar.com')==i1 + 1)
+        assert(len(table)==3)
+
+        host = table.get_host(i1)
+        assert(host is table.get_host('www.foo.com'))
+        assert(host.name=='www.foo.com')
+        assert(host.nowww=='foo.com')
+        assert(host.notld=='foo')
+
+    def test_base_server(self):
+        host = get_host('games.mobileworld.mobi.uk')
+        assert(host.base=='mobileworld.mobi.uk')
+        assert(get_host('www.vodka.bar.foo.com').base=='foo.com')
+        assert(get_host('foo.com').base=='foo.com')
+        assert(get_host('www2.foo.co.uk').basenotld=='foo')
+
+    def test_url_hostid(self):
+        u1 = HarvestManUrl('http://www.foo.com/a.html')
+        u2 = HarvestManUrl('b.html', baseurl=u1)
+        u3 = HarvestManUrl('http://WWW.FOO.COM:8080/c.html')
+        assert(u1.hostid==host_id('www.foo.com'))
+        assert(u2.hostid==u1.hostid)
+        assert(u3.hostid==u1.hostid)
+        assert(HarvestManUrl('http://www.bar.com/').hostid != u1.hostid)
+
+        # Ids are not pickled, but set again on loading
+        state = u1.__getstate__()
+        assert('hostid' not in state)
+        assert(cPickle.loads(cPickle.dumps(u1, 2)).hostid==u1.hostid)
+
+    def test_compare(self):
+        rules = HarvestManRulesChecker()
+        cfg = objects.config
+        subdomain, ignoretlds = cfg.subdomain, cfg.ignoretlds
+        try:
+            cfg.subdomain, cfg.ignoretlds = 1, 0
+            assert(rules.compare_domains('www.foo.com', 'foo.com'))
+            assert(rules.compare_domains(host_id('www.foo.com'), host_id('www2.foo.com')))
+            assert(not rules.compare_domains('www.foo.com', 'www.foo.org'))
+            assert(not rules.compare_domains('mail.foo.com', 'www.foo.com'))
+
+            rules.reset()
+            cfg.subdomain = 0
+            assert(rules.compare_domains('mail.foo.com', 'www.foo.com'))
+            assert(not rules.compare_domains('www.foo.com', 'www.foo.org'))
+
+            rules.reset()
+            cfg.ignoretlds = 1
+            assert(rules.compare_domains('www.foo.com', 'www.foo.org'))
+            assert(rules.compare_domains('mail.foo.co.uk', 'www.foo.com'))
+        finally:
+            cfg.subdomain, cfg.ignoretlds = subdomain, ignoretlds
+
+def run(result):
+    return test_base.run_test(TestHarvestManHostTable, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManHostTable)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
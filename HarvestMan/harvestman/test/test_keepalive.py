@@ -0,0 +1,102 @@
+# -- coding: utf-8
+""" Unit test for keepalive module """
+
+import test_base
+import unittest
+import threading
+import time
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+test_base.setUp()
+from harvestman.lib.common import keepalive
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = 'page %s' % self.path
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestHarvestManKeepAlive(unittest.TestCase):
+    """ Unit test class for the connection pool of keepalive """
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, opener, path):
+        f = opener.open(self.url + path)
+        data = f.read()
+        f.close()
+        return data
+
+    def test_reuse(self):
+        handler = keepalive.HTTPHandler(2, 30)
+        opener = urllib2.build_opener(handler)
+        for i in range(5):
+            assert(self.fetch(opener, '/%d' % i)=='page /%d' % i)
+        stats = handler.get_stats()
+        assert(stats['misses']==1 and stats['hits']==4 and stats['open']==1)
+
+        # At most 2 connections are kept to the host
+        files = [opener.open(self.url + '/%d' % i) for i in range(3)]
+        for f in files:
+            f.read()
+            f.close()
+        stats = handler.get_stats()
+        assert(stats['misses']==3 and stats['open']==2)
+        handler.close_all()
+        assert(handler.get_stats()['open']==0)
+
+        # A connection the server closes is not kept
+        assert(self.fetch(opener, '/close')=='page /close')
+        stats = handler.get_stats()
+        assert(stats['misses']==4 and stats['open']==0)
+
+    def test_eviction(self):
+        handler = keepalive.HTTPHandler(0, 0.2)
+        opener = urllib2.build_opener(handler)
+        self.fetch(opener, '/a')
+        time.sleep(0.3)
+        self.fetch(opener, '/b')
+        stats = handler.get_stats()
+        assert(stats['evictions']==1 and stats['misses']==2 and stats['hits']==0)
+
+        # A connection closed by the server is found dead
+        # before it is reused
+        conn = handler._cm.get_all().values()[0][0]
+        conn.sock.shutdown(1)
+        time.sleep(0.1)
+        self.fetch(opener, '/c')
+        stats = handler.get_stats()
+        assert(stats['stale']==1 and stats['misses']==3)
+        handler.close_all()
+
+def run(result):
+    return test_base.run_test(TestHarvestManKeepAlive, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManKeepAlive)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
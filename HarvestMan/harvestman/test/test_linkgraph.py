@@ -0,0 +1,65 @@
+# -- coding: utf-8
+""" Unit test for linkgraph module """
+
+import test_base
+import unittest
+import os
+import tempfile
+
+test_base.setUp()
+from harvestman.lib.linkgraph import *
+
+class TestHarvestManLinkGraph(unittest.TestCase):
+    """ Unit test class for the HarvestManLinkGraph class """
+
+    def setUp(self):
+        self.graph = HarvestManLinkGraph()
+        # Indices as large as URL fingerprints
+        self.big = 1L<<63
+        self.graph.add_links(1, [2, 3, self.big])
+        self.graph.add_links(2, [3, 4])
+        self.graph.add_links(self.big, [1])
+
+    def test_links(self):
+        graph = self.graph
+        assert(len(graph)==5)
+        assert(graph.get_children(1)==[2, 3, self.big])
+        assert(graph.get_children(3)==[])
+        assert(graph.get_children(99)==[])
+        assert(graph.get_parents(3)==[1, 2])
+        assert(graph.get_parents(1)==[self.big])
+        assert(graph.get_parents(99)==[])
+
+        # Links added again replace the earlier ones
+        graph.add_links(2, [4, 5])
+        assert(graph.get_children(2)==[4, 5])
+        assert(graph.get_parents(3)==[1])
+        assert(list(graph.iteritems())==[(1, [2, 3, self.big]), (self.big, [1]), (2, [4, 5])])
+        assert(list(graph.iterlinked())==[2, 3, self.big, 1, 4, 5])
+        stats = graph.get_stats()
+        assert(stats['pages']==3 and stats['nodes']==6)
+
+    def test_save(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.graph.save(filename)
+            for mapped in (False, True):
+                graph = HarvestManLinkGraph.load(filename, mapped)
+                assert(graph.get_children(1)==[2, 3, self.big])
+                assert(graph.get_parents(3)==[1, 2])
+                assert(list(graph.iteritems())==list(self.graph.iteritems()))
+                assert(graph.get_stats()==self.graph.get_stats())
+
+            self.assertRaises(HarvestManLinkGraphError, graph.add_links, 5, [1])
+            graph.mapped.close()
+        finally:
+            os.remove(filename)
+
+def run(result):
+    return test_base.run_test(TestHarvestManLinkGraph, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManLinkGraph)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
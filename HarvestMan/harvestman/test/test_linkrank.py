@@ -0,0 +1,81 @@
+# -- coding: utf-8
+""" Unit test for linkrank module """
+
+import test_base
+import unittest
+
+test_base.setUp()
+from harvestman.lib.linkrank import *
+from harvestman.lib.urlqueue import HarvestManCrawlerQueue
+from harvestman.lib.urlparser import HarvestManUrl
+from harvestman.lib import urltypes
+
+class TestHarvestManLinkRank(unittest.TestCase):
+    """ Unit test class for the HarvestManLinkRank class """
+
+    def setUp(self):
+        self.cfg = objects.config
+        self.cfg.linkrank = 1
+        self.queuemgr = objects.queuemgr
+        SetAlias(HarvestManCrawlerQueue())
+        self.lr = HarvestManLinkRank()
+
+    def tearDown(self):
+        objects.queuemgr.url_q.clear()
+        self.cfg.linkrank = 0
+        SetAlias(self.queuemgr)
+
+    def make_url(self, name):
+        return HarvestManUrl('http://www.foo.com/' + name, urltypes.URL_TYPE_WEBPAGE)
+
+    def test_term(self):
+        lr = self.lr
+        assert(lr.term(1.0)==0)
+        assert(lr.term(0.5)==lr.scale)
+        assert(lr.term(0.25) > lr.term(0.5))
+        assert(lr.term(0.0)==lr.maxterm)
+        assert(lr.term(1e-300)==lr.maxterm)
+
+    def test_cash(self):
+        lr = self.lr
+        # Starting URL gets full cash, which it splits
+        lr.add_links(0, [1, 2, 2, 0])
+        assert(lr.get_cash(1)==0.5 and lr.get_cash(2)==0.5)
+        assert(lr.get_importance(0)==1.0)
+
+        lr.add_links(1, [2, 3])
+        assert(lr.get_cash(2)==0.75)
+        assert(lr.get_cash(3)==0.25)
+        assert(lr.get_cash(1)==0.0)
+        # Links to crawled pages add to their history
+        lr.add_links(2, [0, 1])
+        assert(lr.get_importance(0)==1.375)
+        assert(lr.get_importance(1)==0.875)
+
+    def test_reprioritize(self):
+        lr = self.lr
+        qmgr = objects.queuemgr
+        urls = [self.make_url('%d.html' % x) for x in range(3)]
+
+        lr.add_links(100, [url.index for url in urls])
+        for url in urls:
+            url.priority = lr.priority(url)
+        qmgr.url_q.put_many([(url.priority, url) for url in urls])
+        qmgr.record_urls(urls)
+
+        # More links to the last URL move it up in the queue
+        lr.add_links(urls[0].index, [urls[2].index])
+        assert(urls[2].priority < urls[1].priority)
+        assert(lr.nreprioritized==1)
+        assert(qmgr.pending[urls[2].index][0]==urls[2].priority)
+
+        items = qmgr.url_q.get_many(3, False)
+        assert([url_obj for prio, url_obj in items]==[urls[2], urls[0], urls[1]])
+
+def run(result):
+    return test_base.run_test(TestHarvestManLinkRank, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManLinkRank)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
@@ -0,0 +1,87 @@
+# -- coding: utf-8
+""" Unit test for localiser module """
+
+import test_base
+import unittest
+import os
+import shutil
+import tempfile
+
+test_base.setUp()
+from harvestman.lib import localiser
+from harvestman.lib.localiser import *
+
+PAGE = """<html><head><base href="http://www.foo.com/docs/"></head><body>
+<a href="a.html">a</a> <a href='a.html#top'>a</a> <a href=/b.html>b</a>
+<img src="http://WWW.FOO.COM:80/img/x.png"> <a href="c.html?x=1&amp;y=2">c</a>
+<a href="http://www.bar.com/">bar</a> <a href="#top">top</a>
+<img data-src="/b.html" src="/b.html"> <svg><use xlink:href="/b.html"/></svg>
+</body></html>"""
+
+class TestHarvestManLocaliser(unittest.TestCase):
+    """ Unit test class for the localiser module """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.page = os.path.join(self.directory, 'docs', 'index.html')
+        self.linkmap = {link_key('http://www.foo.com/docs/a.html'): os.path.join(self.directory, 'docs', 'a.html'),
+                        link_key('http://www.foo.com/b.html'): os.path.join(self.directory, 'b.html'),
+                        link_key('http://www.foo.com/img/x.png'): os.path.join(self.directory, 'img', 'x.png'),
+                        link_key('http://www.foo.com/docs/c.html?x=1&y=2'): ''}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_relative_dir(self):
+        docs = os.path.join(self.directory, 'docs')
+        assert(relative_dir(docs, docs)=='')
+        assert(relative_dir(self.directory, docs)=='../')
+        assert(relative_dir(os.path.join(self.directory, 'img', 'x'), docs)=='../img/x/')
+        assert(relative_dir(os.path.join(docs, 'img'), docs + os.sep)=='img/')
+        assert(relative_dir(os.sep, docs)=='../'*len(docs.strip(os.sep).split(os.sep)))
+
+    def test_localise_data(self):
+        data, count = localise_data(PAGE, 'http://www.foo.com/', self.page, self.linkmap)
+        assert(count==6)
+        assert('<base' not in data)
+        assert('<a href="a.html">a</a> <a href="a.html#top">a</a> <a href="../b.html">b</a>' in data)
+        assert('<img src="../img/x.png">' in data)
+        assert('<a href="http://www.foo.com/docs/c.html?x=1&y=2">c</a>' in data)
+        # Links not in the map are left alone
+        assert('<a href="http://www.bar.com/">bar</a> <a href="#top">top</a>' in data)
+        # Attributes ending in href or src are not links
+        assert('<img data-src="/b.html" src="../b.html"> <svg><use xlink:href="/b.html"/></svg>' in data)
+
+        data, count = localise_data(PAGE, 'http://www.foo.com/', self.page, self.linkmap, 1)
+        assert('<a href="file://%s/b.html">' % self.directory in data)
+
+    def test_localise_files(self):
+        os.makedirs(os.path.dirname(self.page))
+        tasks = []
+        for x in range(10):
+            filename = os.path.join(self.directory, 'docs', '%d.html' % x)
+            open(filename, 'w').write(PAGE)
+            tasks.append((filename, 'http://www.foo.com/', False))
+
+        # With a pool of processes
+        minpages = localiser.MIN_POOL_PAGES
+        localiser.MIN_POOL_PAGES = 5
+        try:
+            results = list(localise_files(tasks, self.linkmap, 2, 2))
+        finally:
+            localiser.MIN_POOL_PAGES = minpages
+
+        assert(sorted(results)==sorted([(task[0], 6, '') for task in tasks]))
+        for task in tasks:
+            assert(open(task[0]).read()==localise_data(PAGE, 'http://www.foo.com/', self.page, self.linkmap)[0])
+
+        results = list(localise_files([(self.page, '', False)], self.linkmap))
+        assert(results[0][1]==0 and results[0][2])
+
+def run(result):
+    return test_base.run_test(TestHarvestManLocaliser, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManLocaliser)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
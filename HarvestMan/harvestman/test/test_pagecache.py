@@ -0,0 +1,127 @@
+# -- coding: utf-8
+""" Unit test for pagecache module """
+
+import test_base
+import unittest
+import os
+import shutil
+import tempfile
+
+test_base.setUp()
+from harvestman.lib.pagecache import *
+from harvestman.lib.common.pydblite import Base
+
+class TestHarvestManProjectCache(unittest.TestCase):
+    """ Unit test class for the HarvestManProjectCache class """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = HarvestManProjectCache(self.directory, memsize=2)
+        self.urls = ['http://www.foo.com/%d.html' % x for x in range(10)]
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def fill(self):
+        cache = self.cache
+        assert(cache.open()==False)
+        for url in self.urls:
+            cache.insert(url, 'data of ' + url, etag=url[-6:], location='/tmp/' + url[-6:])
+
+    def test_lookup(self):
+        self.fill()
+        cache = self.cache
+        assert(len(cache)==10)
+        item = cache.lookup(self.urls[0])
+        assert(item['etag']=='0.html' and item['checksum']=='')
+        assert(cache.get_data(self.urls[0])=='data of ' + self.urls[0])
+        assert(cache.lookup('http://www.foo.com/')==None)
+        assert(cache.get_data('http://www.foo.com/')=='')
+
+        # Reopened, from the index
+        cache.close()
+        assert(cache.open()==True)
+        assert(cache.mapped is not None and not cache.new)
+        assert(len(cache)==10)
+        for url in self.urls:
+            assert(cache.lookup(url)['location']=='/tmp/' + url[-6:])
+            assert(cache.get_data(url)=='data of ' + url)
+
+    def test_recover(self):
+        self.fill()
+        cache = self.cache
+        cache.commit()
+        cache.insert('http://www.bar.com/', 'bar')
+        cache.insert(self.urls[0], 'new data')
+        # Killed while writing a record
+        cache.wfile.write('\1'*10)
+        cache.wfile.close()
+        cache.wfile = None
+        size = cache.logsize
+
+        cache = self.cache = HarvestManProjectCache(self.directory)
+        assert(cache.open()==True)
+        assert(len(cache)==11)
+        assert(os.path.getsize(cache.logfilename)==size)
+        assert(cache.get_data('http://www.bar.com/')=='bar')
+        assert(cache.get_data(self.urls[0])=='new data')
+        assert(cache.get_data(self.urls[1])=='data of ' + self.urls[1])
+
+    def test_compact(self):
+        self.fill()
+        cache = self.cache
+        size = cache.logsize
+        for x in range(3):
+            for url in self.urls:
+                cache.insert(url, 'x'*x, etag=str(x))
+        assert(len(cache)==10)
+        assert(cache.stale > size)
+
+        cache.commit()
+        assert(cache.stale==0)
+        assert(os.path.getsize(cache.logfilename)==cache.logsize < size)
+        assert([key for key, where in cache.iteritems()]==[url_fingerprint(url) for url in self.urls])
+        for url in self.urls:
+            assert(cache.lookup(url)['etag']=='2')
+            assert(cache.get_data(url)=='xx')
+
+    def test_import(self):
+        filename = os.path.join(self.directory, 'cache')
+        base = Base(filename)
+        base.create('url','last_modified','etag', 'updated','location','checksum',
+                    'content_length','data','headers')
+        base.create_index('url')
+        base.insert(url=self.urls[0], etag='abc', data='compressed', updated=True)
+        base.commit()
+
+        cache = self.cache
+        cache.open()
+        assert(cache.import_pydblite(filename)==1)
+        assert(cache.lookup(self.urls[0])['etag']=='abc')
+        assert(cache.get_data(self.urls[0])=='compressed')
+
+    def test_reset(self):
+        from harvestman.lib.utils import HarvestManCacheReaderWriter
+
+        # A log of another program and a log cut short in its header
+        for junk in ('GIF89a not a cache log', 'HM'):
+            f = open(os.path.join(self.directory, 'cache.log'), 'wb')
+            f.write(junk)
+            f.close()
+
+            cache, found = HarvestManCacheReaderWriter(self.directory).read_project_cache()
+            assert(cache is not None and found==False)
+            assert(open(os.path.join(self.directory, 'cache.log.bad'), 'rb').read()==junk)
+            cache.insert(self.urls[0], 'data', etag='abc')
+            assert(cache.lookup(self.urls[0])['etag']=='abc')
+            cache.close()
+            os.remove(os.path.join(self.directory, 'cache.log'))
+
+def run(result):
+    return test_base.run_test(TestHarvestManProjectCache, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestHarvestManProjectCache)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()
@@ -11,10 +11,12 @@ Copyright (C) 2007, Anand B Pillai.
 import test_base
 import unittest
 import sys, os
+import copy
+import cPickle
 
 test_base.setUp()
 
-from harvestman.lib.urlparser import HarvestManUrl, HarvestManUrlError
+from harvestman.lib.urlparser import HarvestManUrl, HarvestManUrlError, HarvestManLinkCache, url_fingerprint, resolve_links
 
 class TestHarvestManUrl(unittest.TestCase):
     """ Unit test class for HarvestManUrl class """
@@ -263,6 +265,117 @@ class TestHarvestManUrl(unittest.TestCase):
 
     def test_canonical_url(self):
         assert(self.l[21].get_canonical_url()=='http://example.com/display%3C%5D%2F?article=fred&country=in&lang=en&size=100&weight=1.0')
+
+    def test_fingerprint(self):
+        u1 = HarvestManUrl('http://www.foo.com/bar/baz.html')
+        u2 = HarvestManUrl(u'http://www.foo.com/bar/baz.html')
+        u3 = HarvestManUrl('http://www.foo.com/bar/baz2.html')
+        assert(u1.index==u2.index)
+        assert(u1.index!=u3.index)
+        assert(u1.index==url_fingerprint(u1.get_canonical_url()))
+        assert(0 < u1.index < 2**64)
+
+    def test_fingerprint_million(self):
+        # Crawl a million synthetic URLs, every tenth
+        # one seen twice, checking for false duplicates
+        seen = {}
+        dups, falsedups = 0, 0
+        for x in xrange(1000000):
+            url = 'http://www%d.site%d.com/dir%d/page%d.html?id=%d' % (x%7, x%1000, x%97, x, x%13)
+            for y in range(1 + (x%10==0)):
+                index = url_fingerprint(url)
+                other = seen.get(index)
+                if other is None:
+                    seen[index] = url
+                elif other == url:
+                    dups += 1
+                else:
+                    falsedups += 1
+
+        assert(len(seen)==1000000)
+        assert(dups==100000)
+        assert(falsedups==0)
+        
+    def test_slots(self):
+        parent = HarvestManUrl('http://www.foo.com/bar/index.html')
+        u = HarvestManUrl('baz.html', 'generic', 0, parent)
+        assert(not hasattr(u, '__dict__'))
+        assert(u.baseurl is parent)
+        assert(u.domain is parent.domain)
+        
+        # Rare attributes have defaults until set
+        assert(u.range is None and u.clength==0 and not u.mirrored)
+        u.range = (0, 99)
+        assert(u.range==(0, 99))
+        assert(parent.range is None)
+        try:
+            u.nosuchattribute = 1
+            self.fail('attribute not in slots set')
+        except AttributeError:
+            pass
+
+        # The parent is not pickled, but found by index
+        u2 = cPickle.loads(cPickle.dumps(u))
+        assert(u2.get_full_url()=='http://www.foo.com/bar/baz.html')
+        assert(u2.index==u.index and u2.range==(0, 99))
+        assert(u2._parentindex==parent.index)
+        u3 = copy.copy(u)
+        u3.range = None
+        assert(u.range==(0, 99))
+
+        # Parents made from strings are kept
+        u4 = cPickle.loads(cPickle.dumps(HarvestManUrl('baz.html', 'generic', 0, 'http://www.foo.com/bar/')))
+        assert(u4.baseurl.get_full_url()=='http://www.foo.com/bar/')
+        
+    def test_linkcache(self):
+        cache = HarvestManLinkCache(2)
+        page1 = HarvestManUrl('http://www.foo.com/bar/a.html')
+        page2 = HarvestManUrl('http://www.foo.com/bar/b.html')
+        page3 = HarvestManUrl('http://www.foo.com:8080/bar/b.html')
+        key1, key2, key3 = [cache.base_key(page) for page in (page1, page2, page3)]
+        # Pages in the same directory share the key
+        assert(key1==key2)
+        assert(key1!=key3)
+
+        u = HarvestManUrl('../baz.html', 'webpage', 0, page1)
+        assert(cache.get(key1, '../baz.html', 'webpage') is None)
+        cache.put(key1, '../baz.html', 'webpage', u)
+        assert(cache.get(key2, '../baz.html', 'webpage')==('http://foo.com/baz.html', u.index))
+        assert(cache.get(key3, '../baz.html', 'webpage') is None)
+        assert(cache.get(key1, '../baz.html', 'image') is None)
+        assert(cache.get_stats()==(1, 3))
+
+        # Anchors are not cached
+        cache.put(key1, '#top', 'anchor', HarvestManUrl('#top', 'anchor', 0, page1))
+        assert(cache.get(key1, '#top', 'anchor') is None)
+
+        # Least recently used links are dropped
+        cache.put(key1, 'x.html', 'webpage', HarvestManUrl('x.html', 'webpage', 0, page1))
+        cache.put(key1, 'y.html', 'webpage', HarvestManUrl('y.html', 'webpage', 0, page1))
+        assert(cache.get(key1, '../baz.html', 'webpage') is None)
+        assert(cache.get(key1, 'y.html', 'webpage') is not None)
+        
+    def test_resolve_links(self):
+        links = ['a.html', 'b/c.php?y=2&x=1', '/d/', '../e.html', 'www.bar.com/f.html',
+                 'HTTP://www.Bar.com/g', 'http://Bar.com', 'https://bar.com:8443/h',
+                 '#top', 'i.ars', 'j.', 'k/./l.html', 'mailto:x@y.com', 'file://n']
+        for base in ('http://www.foo.com/bar/index.html', 'https://foo.com:8443/bar/',
+                     'http://www.foo.com/a/?/b/c.html'):
+            page = HarvestManUrl(base)
+            records = resolve_links(page, [('anchor', link, False) for link in links[8:9]] + \
+                                    [('generic', link, False) for link in links[:8] + links[9:]])
+            for record in records:
+                u = HarvestManUrl(record.link, record.typ, False, HarvestManUrl(base))
+                assert(record.error is None)
+                assert(record.index==u.index)
+                assert(record.get_canonical_url()==u.get_canonical_url())
+                assert(record.get_url_object().get_full_url()==u.get_full_url())
+
+        # Plain links are resolved without url objects
+        page = HarvestManUrl('http://www.foo.com/bar/index.html')
+        records = resolve_links(page, [('generic', link, False) for link in links])
+        assert([r.link for r in records if r.urlobj is None]==links[:3] + links[6:7])
+        
     def test_invalid_urls(self):
 
         # Make sure invalid URLs do raise an error
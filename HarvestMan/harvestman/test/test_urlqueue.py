@@ -0,0 +1,529 @@
+# -- coding: utf-8
+""" Unit test for urlqueue module """
+
+import test_base
+import unittest
+import time
+import os
+import sys
+import random
+import threading
+
+test_base.setUp()
+from harvestman.lib.urlqueue import *
+from harvestman.lib.urlparser import HarvestManUrl
+from harvestman.lib import urltypes
+from harvestman.lib import crawler
+from harvestman.lib.urlcollections import HarvestManUrlCollection
+
+class Item(object):
+    """ Objects which should never get compared """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __cmp__(self, other):
+        raise AssertionError, 'queued object compared'
+
+class TestPriorityQueue(unittest.TestCase):
+    """ Unit test class for the PriorityQueue class """
+
+    def test_order(self):
+        q = PriorityQueue()
+        for prio in (5, -1, 3, 0, 2):
+            q.put((prio, Item(str(prio))))
+
+        assert(len(q)==5)
+        assert([q.get()[0] for x in range(5)]==[-1, 0, 2, 3, 5])
+        assert(q.qsize()==0)
+
+    def test_fifo_ties(self):
+        q = PriorityQueue()
+        items = [Item(str(x)) for x in range(10)]
+        for item in items:
+            q.put((1, item))
+        q.put((0, Item('first')))
+
+        assert(q.get()[1].name=='first')
+        assert([q.get()[1] for x in range(10)]==items)
+
+    def test_buckets(self):
+        q = PriorityQueue()
+        for prio in (1, 1, 2, 3, 3, 3):
+            q.put((prio, Item('')))
+
+        assert(q.bucket_counts()=={1: 2, 2: 1, 3: 3})
+        q.get()
+        q.get()
+        assert(q.bucket_counts()=={2: 1, 3: 3})
+        q.clear()
+        assert(q.qsize()==0)
+        assert(q.bucket_counts()=={})
+
+    def test_many(self):
+        q = PriorityQueue(5)
+        items = [(x % 2, Item(str(x))) for x in range(8)]
+        assert(q.put_many(items)==5)
+        assert(q.qsize()==5)
+        batch = q.get_many(3)
+        assert([prio for prio, item in batch]==[0, 0, 0])
+        assert([item.name for prio, item in q.get_many(10)]==['1', '3'])
+        self.assertRaises(Empty, q.get_many, 10, False)
+        self.assertRaises(Empty, q.get_many, 10, True, 0.05)
+
+    def test_interrupt(self):
+        q = PriorityQueue()
+        t = threading.Timer(0.05, q.interrupt)
+        t.start()
+        start = time.time()
+        self.assertRaises(Empty, q.get_many, 1, True, 5.0)
+        assert(time.time() - start < 1.0)
+        # Cleared queues wait again
+        q.clear()
+        self.assertRaises(Empty, q.get, True, 0.05)
+
+    def test_full(self):
+        q = PriorityQueue(2)
+        q.put((1, Item('')))
+        q.put((1, Item('')))
+        self.assertRaises(Full, q.put, (1, Item('')), False)
+        q.clear()
+        q.put((1, Item('')), False)
+
+    def test_reprioritize(self):
+        q = PriorityQueue(key=lambda (prio, item): item.name)
+        items = [Item(str(x)) for x in range(5)]
+        for item in items:
+            q.put((5, item))
+
+        updated = q.reprioritize({'3': -4, '1': -2, 'x': -1})
+        assert(sorted(updated)==[(1, items[3]), (3, items[1])])
+        assert(q.qsize()==5)
+        assert(q.bucket_counts()=={1: 1, 3: 1, 5: 3})
+        # Stale entries are dropped once they are the majority
+        q.reprioritize({'0': 1, '2': 1, '4': 1, '1': 2})
+        assert(q.nstale==0)
+        assert(len(q.queue)==5)
+
+        assert([q.get()[1] for x in range(5)]==[items[3], items[1], items[0], items[2], items[4]])
+        assert(q.entries=={})
+        assert(q.reprioritize({'3': -1})==[])
+        
+class TestHarvestManHostFrontier(unittest.TestCase):
+    """ Unit test class for the HarvestManHostFrontier class """
+
+    def make_url(self, url):
+        return HarvestManUrl(url, urltypes.URL_TYPE_ANY)
+
+    def fetch(self, q, timeout=0.1):
+        """ Get an item and report its fetch done """
+
+        item = q.get(timeout=timeout)
+        q.mark_done(item[1])
+        return item
+
+    def test_hosts(self):
+        q = HarvestManHostFrontier(delay=0.2)
+        for url in ('http://www.foo.com/a.html','http://www.foo.com/b.html',
+                    'http://www.bar.com/a.html','http://www.bar.com:8080/a.html'):
+            q.put((0, self.make_url(url)))
+
+        assert(q.qsize()==4)
+        assert(q.host_counts()=={'http://www.foo.com': 2,
+                                 'http://www.bar.com': 1,
+                                 'http://www.bar.com:8080': 1})
+
+        # Three different hosts are ready at once
+        hosts = [self.fetch(q)[1].get_full_domain_with_port() for x in range(3)]
+        assert(len(set(hosts))==3)
+        # The second URL of www.foo.com has to wait for the delay
+        self.assertRaises(Empty, q.get, False)
+        t = time.time()
+        prio, url_obj = self.fetch(q, 1.0)
+        assert(time.time() - t >= 0.15)
+        assert(url_obj.get_full_url()=='http://www.foo.com/b.html')
+        assert(q.qsize()==0)
+
+    def test_priority(self):
+        q = HarvestManHostFrontier(delay=0)
+        q.put((2, self.make_url('http://www.foo.com/c.html')))
+        q.put((1, self.make_url('http://www.foo.com/b.html')))
+        q.put((1, self.make_url('http://www.foo.com/a.html')))
+
+        urls = [self.fetch(q)[1].get_full_url() for x in range(3)]
+        assert(urls==['http://www.foo.com/b.html',
+                      'http://www.foo.com/a.html',
+                      'http://www.foo.com/c.html'])
+        assert(q.bucket_counts()=={})
+
+    def test_many(self):
+        q = HarvestManHostFrontier(delay=10.0)
+        urls = ['http://www.foo.com/a.html','http://www.foo.com/b.html',
+                'http://www.bar.com/a.html','http://www.baz.com/a.html']
+        assert(q.put_many([(0, self.make_url(url)) for url in urls])==4)
+        # Only one URL per host is ready
+        batch = q.get_many(10, False)
+        assert(len(batch)==3)
+        assert(len(set([url_obj.get_full_domain() for prio, url_obj in batch]))==3)
+        self.assertRaises(Empty, q.get_many, 10, False)
+        assert(q.qsize()==1)
+
+    def test_mark_done(self):
+        q = HarvestManHostFrontier(delay=0.2, holdtime=0.5)
+        for url in ('http://www.foo.com/a.html', 'http://www.foo.com/b.html',
+                    'http://www.foo.com/c.html'):
+            q.put((0, self.make_url(url)))
+
+        # The delay runs from the end of the fetch, not
+        # from the time the URL was handed out
+        prio, url_obj = q.get(False)
+        time.sleep(0.3)
+        self.assertRaises(Empty, q.get, False)
+        # Reports for other URLs are ignored
+        q.mark_done(self.make_url('http://www.foo.com/b.html'))
+        self.assertRaises(Empty, q.get, False)
+        q.mark_done(url_obj)
+        self.assertRaises(Empty, q.get, False)
+        t = time.time()
+        prio, url_obj = q.get(timeout=1.0)
+        assert(time.time() - t >= 0.15)
+        assert(url_obj.get_full_url()=='http://www.foo.com/b.html')
+
+        # A fetch never reported done holds the
+        # host only till the hold runs out
+        t = time.time()
+        prio, url_obj = q.get(timeout=1.0)
+        assert(time.time() - t >= 0.4)
+        assert(url_obj.get_full_url()=='http://www.foo.com/c.html')
+        q.mark_done(url_obj)
+        assert(q.busy=={} and q.qsize()==0)
+
+    def test_full(self):
+        q = HarvestManHostFrontier(2, delay=0)
+        q.put((0, self.make_url('http://www.foo.com/a.html')))
+        q.put((0, self.make_url('http://www.bar.com/a.html')))
+        self.assertRaises(Full, q.put, (0, self.make_url('http://www.baz.com/')), False)
+        q.clear()
+        assert(q.qsize()==0)
+        self.assertRaises(Empty, q.get, True, 0.05)
+
+    def test_reprioritize(self):
+        q = HarvestManHostFrontier(delay=0, key=lambda (prio, url): url.get_full_url())
+        for url in ('http://www.foo.com/a.html', 'http://www.foo.com/b.html',
+                    'http://www.bar.com/a.html'):
+            q.put((2, self.make_url(url)))
+
+        updated = q.reprioritize({'http://www.foo.com/b.html': -1})
+        assert([prio for prio, url_obj in updated]==[1])
+        assert(q.host_counts()=={'http://www.foo.com': 2, 'http://www.bar.com': 1})
+
+        urls = [self.fetch(q)[1].get_full_url() for x in range(3)]
+        assert(urls.index('http://www.foo.com/b.html') < urls.index('http://www.foo.com/a.html'))
+        assert(q.qsize()==0 and q.nstale==0)
+        assert(q.bucket_counts()=={})
+
+class TestHarvestManSpillQueue(unittest.TestCase):
+    """ Unit test class for the HarvestManSpillQueue class """
+
+    def test_spill(self):
+        q = HarvestManSpillQueue(PriorityQueue(4), batch=3, name='test')
+        for x in range(20):
+            q.put((x % 3, x), False)
+
+        assert(q.qsize()==20)
+        stats = q.get_stats()
+        assert(stats['spilled']==16)
+        assert(stats['ondisk']==16)
+        assert(os.path.isdir(q.log.directory))
+
+        items = [q.get(False) for x in range(20)]
+        # Every item comes back exactly once
+        assert(sorted([x for prio, x in items])==range(20))
+        # Items in memory keep their priority order
+        assert([prio for prio, x in items[:2]]==[0, 0])
+        assert(q.qsize()==0)
+        assert(q.get_stats()=={'spilled': 16, 'refilled': 16, 'ondisk': 0})
+        self.assertRaises(Empty, q.get, False)
+
+        directory = q.log.directory
+        q.close()
+        assert(not os.path.exists(directory))
+
+    def test_many(self):
+        q = HarvestManSpillQueue(PriorityQueue(4), batch=4, name='test')
+        assert(q.put_many([(0, x) for x in range(10)])==10)
+        assert(q.get_stats()['spilled']==6)
+        items = []
+        while q.qsize():
+            items.extend(q.get_many(3, False))
+        assert([x for prio, x in items]==range(10))
+        q.close()
+
+    def test_dump_load(self):
+        objs = dict([(x, Item(str(x))) for x in range(5)])
+        q = HarvestManSpillQueue(PriorityQueue(1), name='test',
+                                 dump=lambda (prio, item): (prio, int(item.name)),
+                                 load=lambda (prio, x): (prio, objs[x]))
+        for x in range(5):
+            q.put((0, objs[x]))
+
+        # Spilled items are refilled as the same objects
+        assert([q.get(False)[1] for x in range(5)]==[objs[x] for x in range(5)])
+        q.close()
+
+    def test_queuemgr(self):
+        cfg, qmgr, dmgr = objects.config, objects.queuemgr, objects.datamgr
+        saved = cfg.queuespill, cfg.queuesize
+        cfg.queuespill, cfg.queuesize = 1, 1
+        try:
+            qmgr.reset()
+            dmgr.reset()
+            dmgr.make_databases()
+
+            items = []
+            for x in range(3):
+                base = HarvestManUrl('http://www.foo.com/%d.html' % x)
+                dmgr.add_url(base)
+                coll = HarvestManUrlCollection(base)
+                dmgr.update_links(base, coll)
+                items.append((0, coll, Item(str(x))))
+
+            # The queues spill, so pushes are neither retried nor buffered
+            assert(qmgr.spill)
+            assert(qmgr.data_q.put_many(items)==3)
+            assert(qmgr.data_q.get_stats()['spilled']==2)
+            refilled = [qmgr.data_q.get(False) for x in range(3)]
+            # The first is the item in memory
+            assert(refilled[0] is items[0])
+            for x in (1, 2):
+                prio, coll, document = refilled[x]
+                # Collections come back as the data manager's
+                # own objects and documents are not spilled
+                assert(coll is dmgr.get_links(items[x][1].getSourceURL()))
+                assert(coll is items[x][1])
+                assert(document is None)
+            qmgr.data_q.close()
+            qmgr.url_q.close()
+        finally:
+            cfg.queuespill, cfg.queuesize = saved
+            qmgr.reset()
+
+class StateWorker(threading.Thread):
+    """ A tracker thread stand-in which mimics the queue and
+    state machine usage of the fetchers and crawlers """
+
+    def __init__(self, role, index, state, getq, putq, fanout, depth):
+        threading.Thread.__init__(self, None, None, role + str(index))
+        self._role = role
+        self.resuming = False
+        self.exception = None
+        self.state = state
+        self.getq, self.putq = getq, putq
+        self.fanout, self.depth = fanout, depth
+        self.processed = 0
+        self.stopped = False
+        if role=='fetcher':
+            self.states = (crawler.FETCHER_WAITING, crawler.FETCHER_GOT_DATA,
+                           crawler.FETCHER_PUSH_URL, crawler.FETCHER_PUSHED_URL)
+        else:
+            self.states = (crawler.CRAWLER_WAITING, crawler.CRAWLER_GOT_DATA,
+                           crawler.CRAWLER_PUSH_URL, crawler.CRAWLER_PUSHED_URL)
+        
+    def run(self):
+        waiting, gotdata, push, pushed = self.states
+        self.state.set(self, crawler.THREAD_STARTED)
+        
+        while not self.stopped:
+            self.state.set(self, waiting)
+            try:
+                items = self.getq.get_many(random.randint(1, 4), True, 0.01)
+            except Empty:
+                continue
+            self.state.set(self, gotdata, len(items))
+
+            for prio, level in items:
+                if random.random()<0.2: time.sleep(0.001)
+                self.processed += 1
+                if self._role=='fetcher':
+                    children = [(prio, level)]
+                elif level<self.depth:
+                    children = [(prio+1, level+1)]*self.fanout
+                else:
+                    continue
+                
+                self.state.set(self, push)
+                self.putq.put_many(children)
+                self.state.set(self, pushed, len(children))
+
+            self.state.set(self, crawler.THREAD_SLEEPING)
+            
+        self.state.set(self, crawler.THREAD_STOPPED)
+        
+class TestHarvestManCrawlerState(unittest.TestCase):
+    """ Unit test class for the HarvestManCrawlerState class """
+
+    def make_state(self):
+        # Don't disturb the singleton used by the queue manager
+        state = object.__new__(HarvestManCrawlerState)
+        state.__init__(None)
+        return state
+
+    def test_counts(self):
+        state = self.make_state()
+        f = StateWorker('fetcher', 0, state, None, None, 0, 0)
+        c = StateWorker('crawler', 0, state, None, None, 0, 0)
+        state.numfetchers, state.numcrawlers = 1, 1
+        
+        state.set(f, crawler.FETCHER_WAITING)
+        state.set(c, crawler.CRAWLER_WAITING)
+        assert(state.end_state())
+        assert(state.get(f)==(crawler.FETCHER_WAITING, 'fetcher'))
+
+        # An item in flight
+        state.cpush.add()
+        assert(not state.end_state())
+        state.set(f, crawler.FETCHER_GOT_DATA)
+        assert(not state.end_state())
+        state.set(f, crawler.FETCHER_WAITING)
+        assert(state.end_state())
+
+        # Dead threads are left out
+        state.set(c, crawler.THREAD_DIED)
+        assert(state.get(c) is None)
+        assert(state.nidle.value==1)
+        
+        state.set(f, crawler.THREAD_STOPPED)
+        assert(state.exit_state())
+
+    def test_thread_counts(self):
+        state = self.make_state()
+        state.numfetchers, state.numcrawlers = 10, 10
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+
+        def convert():
+            for x in range(5000):
+                state.add_threads(fetchers=1, crawlers=-1)
+                state.add_threads(fetchers=-1, crawlers=1)
+
+        def die(role):
+            for x in range(2):
+                t = StateWorker(role, x, state, None, None, 0, 0)
+                state.set(t, crawler.THREAD_STARTED)
+                state.set(t, crawler.THREAD_DIED)
+
+        # Threads converted by the balancer while
+        # others die update the counts together
+        threads = [threading.Thread(target=convert) for x in range(4)]
+        threads += [threading.Thread(target=die, args=(role,)) for role in ('fetcher', 'crawler')]
+        try:
+            for t in threads: t.start()
+            for t in threads: t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        assert((state.numfetchers, state.numcrawlers)==(8, 8))
+
+    def test_wait_for(self):
+        state = self.make_state()
+        f = StateWorker('fetcher', 0, state, None, None, 0, 0)
+        state.numfetchers, state.numcrawlers = 1, 1
+        state.set(f, crawler.FETCHER_DOWNLOADING)
+
+        # The transition to waiting wakes up the waiter
+        # well before the poll interval.
+        t = threading.Timer(0.05, state.set, (f, crawler.FETCHER_WAITING))
+        t.start()
+        start = time.time()
+        assert(state.wait_for(state.end_state, 10.0, 5.0))
+        assert(time.time() - start < 1.0)
+        # Times out otherwise
+        assert(not state.wait_for(lambda: False, 0.05))
+
+    def test_role_stats(self):
+        state = self.make_state()
+        f = StateWorker('fetcher', 0, state, None, None, 0, 0)
+        state.set(f, crawler.THREAD_STARTED)
+        state.set(f, crawler.FETCHER_WAITING)
+        time.sleep(0.1)
+        state.set(f, crawler.FETCHER_DOWNLOADING)
+        time.sleep(0.1)
+        state.set(f, crawler.THREAD_STOPPED)
+
+        nthreads, util = state.get_role_stats()['fetcher']
+        assert(nthreads==1)
+        assert(0.3 < util < 0.7)
+
+    def test_balancer(self):
+        class Queue(object):
+            pass
+        
+        queue = Queue()
+        queue.stateobj = state = self.make_state()
+        state.numfetchers, state.numcrawlers = 3, 2
+        balancer = HarvestManThreadBalancer(queue, minfetchers=1, mincrawlers=2)
+        
+        # Samples are (url_q size, data_q size, waiting fetchers, waiting crawlers)
+        # Idle crawlers and a url backlog, but crawlers are at their minimum
+        assert(balancer.decide([(50, 0, 0, 2)]*4)==None)
+        state.numfetchers, state.numcrawlers = 2, 3
+        assert(balancer.decide([(50, 0, 0, 2)]*4)==('crawler', 'fetcher'))
+        # Idle fetchers and a data backlog
+        assert(balancer.decide([(0, 20, 2, 0)]*4)==('fetcher', 'crawler'))
+        # Balanced
+        assert(balancer.decide([(1, 1, 0, 0)]*4)==None)
+        
+    def test_stress(self):
+        """ Check that the end state is signalled only
+        after all the work is done, and always is """
+
+        fanout, depth = 3, 5
+        expected = sum([fanout**x for x in range(depth+1)])
+        
+        for round in range(3):
+            state = self.make_state()
+            url_q, data_q = PriorityQueue(), PriorityQueue()
+            workers = [StateWorker('fetcher', x, state, url_q, data_q, fanout, depth) for x in range(8)]
+            workers += [StateWorker('crawler', x, state, data_q, url_q, fanout, depth) for x in range(8)]
+            state.numfetchers, state.numcrawlers = 8, 8
+            for w in workers:
+                state.set(w, crawler.THREAD_IDLE)
+
+            url_q.put((0, 0))
+            state.cpush.add()
+            for w in workers:
+                w.setDaemon(True)
+                w.start()
+
+            done, endtime = False, time.time() + 60.0
+            while time.time()<endtime:
+                if state.end_state():
+                    done = True
+                    break
+                time.sleep(0)
+
+            # Snapshot the work done at the time of the end state
+            fetched = sum([w.processed for w in workers if w._role=='fetcher'])
+            qsizes = url_q.qsize(), data_q.qsize()
+            for w in workers:
+                w.stopped = True
+            for w in workers:
+                w.join()
+
+            assert(done)
+            assert(fetched==expected)
+            assert(qsizes==(0, 0))
+            assert(state.exit_state())
+
+def run(result):
+    test_base.run_test(TestPriorityQueue, result)
+    test_base.run_test(TestHarvestManHostFrontier, result)
+    test_base.run_test(TestHarvestManSpillQueue, result)
+    return test_base.run_test(TestHarvestManCrawlerState, result)
+
+if __name__=="__main__":
+    s = unittest.TestSuite([unittest.makeSuite(TestPriorityQueue),
+                            unittest.makeSuite(TestHarvestManHostFrontier),
+                            unittest.makeSuite(TestHarvestManSpillQueue),
+                            unittest.makeSuite(TestHarvestManCrawlerState)])
+    unittest.TextTestRunner(verbosity=2).run(s)
+    test_base.clean_up()